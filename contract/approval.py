@@ -0,0 +1,103 @@
+import logging
+import time
+
+from django.db import InterfaceError, OperationalError, transaction
+
+from contract.models import Contract
+
+logger = logging.getLogger(__name__)
+
+
+class ApprovalStageError(Exception):
+    """
+    A stage of the approval failed. The stages before it are checkpointed, so
+    the approval can be retried and resumes at the failed stage.
+    """
+
+    def __init__(self, stage, exception):
+        super().__init__(f"approval stage {stage} failed: {exception}")
+        self.stage = stage
+        self.exception = exception
+
+
+# failures an approval retry can recover from: a failed stage, which is resumed,
+# and lost/unavailable database connections. The others (permissions, contract
+# state, validation) would fail the same way again.
+RETRYABLE_APPROVAL_ERRORS = (ApprovalStageError, OperationalError, InterfaceError)
+
+
+def is_retryable_approval_error(exception):
+    return isinstance(exception, RETRYABLE_APPROVAL_ERRORS)
+
+
+class ApprovalStage(object):
+    """
+    One step of the contract approval. `function(context)` does the work,
+    `checkpoint` is the Contract.ProcessStatus stored once it is done and
+    `fields` are the contract fields it changed that are saved with the
+    checkpoint.
+    """
+
+    def __init__(self, name, function, checkpoint, fields=()):
+        self.name = name
+        self.function = function
+        self.checkpoint = checkpoint
+        self.fields = tuple(fields)
+
+
+class ApprovalPipeline(object):
+    """
+    Runs the approval stages of a contract in order. Every stage runs in its own
+    transaction together with the write of its checkpoint on the contract
+    (process_status), so a retried approval resumes after the last completed
+    stage instead of running the whole approval again. Stages are timed and
+    the durations are kept in `timings`.
+    """
+
+    def __init__(self, contract, stages):
+        self.contract = contract
+        self.stages = list(stages)
+        self.timings = {}
+
+    @property
+    def checkpoints(self):
+        return [stage.checkpoint for stage in self.stages]
+
+    def is_resumable(self):
+        # an interrupted approval: some stages done, not the last one
+        return self.contract.process_status in self.checkpoints[:-1]
+
+    def pending_stages(self):
+        if not self.is_resumable():
+            return self.stages
+        done = self.checkpoints.index(self.contract.process_status) + 1
+        return self.stages[done:]
+
+    def _checkpoint(self, stage):
+        self.contract.process_status = stage.checkpoint
+        values = {field: getattr(self.contract, field) for field in stage.fields}
+        if Contract.EFFECTIVE_AMOUNT_FIELDS.intersection(stage.fields):
+            values["effective_amount"] = self.contract.amount
+        Contract.objects.filter(id=self.contract.id).update(
+            process_status=stage.checkpoint, **values
+        )
+
+    def run(self, context):
+        pending_stages = self.pending_stages()
+        if len(pending_stages) < len(self.stages):
+            logger.info(
+                f"approval pipeline : contract {self.contract.id} resumed after {self.contract.process_status}"
+            )
+        for stage in pending_stages:
+            start = time.perf_counter()
+            try:
+                with transaction.atomic():
+                    stage.function(context)
+                    self._checkpoint(stage)
+            except Exception as exc:
+                raise ApprovalStageError(stage.name, exc) from exc
+            self.timings[stage.name] = time.perf_counter() - start
+            logger.info(
+                f"approval pipeline : contract {self.contract.id} : {stage.name} done in {self.timings[stage.name]:.3f}s"
+            )
+        return context
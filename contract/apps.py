@@ -26,6 +26,11 @@ DEFAULT_CFG = {
     "gql_mutation_submit_contract_policyholder_portal_perms": ["154207"],
     "gql_mutation_amend_contract_policyholder_portal_perms": ["154209"],
     "gql_invoice_create_perms": ["155102"],
+    # maximum number of subtasks a bulk approve/counter is split into
+    "bulk_max_parallel_tasks": 8,
+    # user recorded on the contracts terminated by the scheduled
+    # contract.tasks.terminate_expired_contracts task
+    "terminate_contracts_username": "admin",
 }
 
 
@@ -51,6 +56,8 @@ class ContractConfig(AppConfig):
     gql_mutation_submit_contract_policyholder_portal_perms = []
     gql_mutation_amend_contract_policyholder_portal_perms = []
     gql_invoice_create_perms = []
+    bulk_max_parallel_tasks = 8
+    terminate_contracts_username = "admin"
 
     def _configure_permissions(selfself, cfg):
         ContractConfig.gql_query_contract_perms = cfg[
@@ -109,8 +116,16 @@ class ContractConfig(AppConfig):
             "gql_invoice_create_perms"
         ]
 
+    def _configure_tasks(self, cfg):
+        for key in (
+            "bulk_max_parallel_tasks",
+            "terminate_contracts_username",
+        ):
+            setattr(ContractConfig, key, cfg.get(key, DEFAULT_CFG[key]))
+
     def ready(self):
         from core.models import ModuleConfiguration
         cfg = ModuleConfiguration.get_or_default(MODULE_NAME, DEFAULT_CFG)
         self._configure_permissions(cfg)
+        self._configure_tasks(cfg)
         import contract.signals
\ No newline at end of file
@@ -0,0 +1,59 @@
+import logging
+import uuid
+
+from core.models import User
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
+
+logger = logging.getLogger(__name__)
+
+BULK_BATCH_SIZE = 1000
+
+
+def _get_history_user(username):
+    return User.objects.get(username=username)
+
+
+def bulk_create_history_objects(model, objects, username, batch_size=BULK_BATCH_SIZE):
+    """
+    bulk_create counterpart of HistoryModel.save(username=...) for new records:
+    sets the primary key and the audit fields that save() would set and inserts
+    the history rows with one bulk insert per batch.
+    """
+    if not objects:
+        return objects
+    from core import datetime
+
+    user = _get_history_user(username)
+    now = datetime.datetime.now()
+    for obj in objects:
+        if obj.id is None:
+            obj.id = uuid.uuid4()
+        obj.user_created = user
+        obj.user_updated = user
+        obj.date_created = now
+        obj.date_updated = now
+    bulk_create_with_history(objects, model, batch_size=batch_size, default_user=user)
+    logger.debug(f"bulk_create_history_objects : {len(objects)} {model.__name__} created")
+    return objects
+
+
+def bulk_update_history_objects(model, objects, fields, username, batch_size=BULK_BATCH_SIZE):
+    """
+    bulk_update counterpart of HistoryModel.save(username=...) for existing records:
+    bumps the version and the audit fields of every object and writes the
+    history rows with one bulk insert per batch.
+    """
+    if not objects:
+        return objects
+    from core import datetime
+
+    user = _get_history_user(username)
+    now = datetime.datetime.now()
+    for obj in objects:
+        obj.user_updated = user
+        obj.date_updated = now
+        obj.version = obj.version + 1
+    fields = list(dict.fromkeys([*fields, "user_updated", "date_updated", "version"]))
+    bulk_update_with_history(objects, model, fields, batch_size=batch_size, default_user=user)
+    logger.debug(f"bulk_update_history_objects : {len(objects)} {model.__name__} updated")
+    return objects
@@ -0,0 +1,205 @@
+import json
+import logging
+
+import numpy as np
+from calculation.services import run_calculation_rules
+from contribution_plan.models import ContributionPlanBundleDetails
+from django.core.serializers.json import DjangoJSONEncoder
+
+from contract.bulk_utils import bulk_update_history_objects
+
+logger = logging.getLogger(__name__)
+
+
+def split_amount(amount, parts):
+    """
+    Split an integer amount into `parts` integer shares that sum exactly to the
+    amount. Every share gets the floor of the division and the remainder is
+    spread one unit at a time over the first shares (largest remainder method).
+    """
+    if parts <= 0:
+        return []
+    base, remainder = divmod(int(round(amount)), parts)
+    return [base + 1] * remainder + [base] * (parts - remainder)
+
+
+def forfait_json_ext(share):
+    return {
+        "calculation_rule": {"rate": 0, "income": 0},
+        "forfait_rule": {
+            "total": share,
+            "employerContribution": 0,
+            "salaryShare": 0,
+        },
+    }
+
+
+def distribute_forfait_amount(contract_details, amount, username):
+    """
+    Distribute the contract amount over the given contract details as forfait
+    shares and confirm them. The details are written with one bulk update and
+    one bulk history insert per batch instead of one save per detail.
+    """
+    contract_details = list(contract_details)
+    if not contract_details:
+        logger.info("distribute_forfait_amount : no contract details to update")
+        return []
+    shares = split_amount(amount, len(contract_details))
+    for contract_detail, share in zip(contract_details, shares):
+        contract_detail.is_confirmed = True
+        contract_detail.json_ext = forfait_json_ext(share)
+    bulk_update_history_objects(
+        type(contract_details[0]),
+        contract_details,
+        ["json_ext", "is_confirmed"],
+        username,
+    )
+    logger.info(
+        f"distribute_forfait_amount : {amount} distributed over {len(contract_details)} contract details"
+    )
+    return shares
+
+
+def custom_round_array(values):
+    """
+    Element-wise contract.utils.custom_round: rounds away from zero when the first
+    digit after the decimal point is 5 or more, truncates otherwise.
+    Returns an int64 array.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    integer_part = np.trunc(values)
+    first_decimal_digit = np.floor(np.abs(values - integer_part) * 10)
+    step = np.where(values >= 0, 1.0, -1.0)
+    return np.where(first_decimal_digit >= 5, integer_part + step, integer_part).astype(np.int64)
+
+
+def contribution_rates(contribution_plan):
+    """
+    Employer and employee percentages of the calculation_rule of a contribution plan.
+    """
+    employer_rate, employee_rate = 0.0, 0.0
+    if contribution_plan and contribution_plan.json_ext:
+        calculation_rule = contribution_plan.json_ext.get("calculation_rule")
+        if calculation_rule:
+            employer_rate = float(calculation_rule.get("employerContribution", 0.0))
+            employee_rate = float(calculation_rule.get("employeeContribution", 0.0))
+    return employer_rate, employee_rate
+
+
+def contribution_rates_by_bundle(contribution_plan_bundle_ids):
+    """
+    contribution_rates of the first contribution plan of every bundle, loaded with
+    one query. Bundles without details get zero rates.
+    """
+    contribution_plan_bundle_ids = set(contribution_plan_bundle_ids)
+    rates = {}
+    for cpbd in (
+        ContributionPlanBundleDetails.objects.filter(
+            contribution_plan_bundle_id__in=contribution_plan_bundle_ids, is_deleted=False
+        )
+        .select_related("contribution_plan")
+        .order_by("pk")
+    ):
+        rates.setdefault(
+            cpbd.contribution_plan_bundle_id, contribution_rates(cpbd.contribution_plan)
+        )
+    for contribution_plan_bundle_id in contribution_plan_bundle_ids:
+        rates.setdefault(contribution_plan_bundle_id, (0.0, 0.0))
+    return rates
+
+
+def percentage_contributions(incomes, employer_rates, employee_rates):
+    """
+    Batch version of the percentage contribution rule: computes the employer part,
+    the salary share and the total for arrays of incomes and rates (rates may also
+    be scalars) and applies custom_round element-wise, as the row by row code did.
+    """
+    incomes = np.asarray(incomes, dtype=np.float64)
+    employer_rates = np.broadcast_to(np.asarray(employer_rates, dtype=np.float64), incomes.shape)
+    employee_rates = np.broadcast_to(np.asarray(employee_rates, dtype=np.float64), incomes.shape)
+    employer_contribution = np.where(employer_rates != 0, incomes * employer_rates / 100, 0.0)
+    salary_share = np.where(employee_rates != 0, incomes * employee_rates / 100, 0.0)
+    total = salary_share + employer_contribution
+    return {
+        "total": custom_round_array(total),
+        "employerContribution": custom_round_array(employer_contribution),
+        "salaryShare": custom_round_array(salary_share),
+    }
+
+
+def percentage_contribution(income, employer_rate, employee_rate):
+    """
+    Single row of percentage_contributions as the custom field dictionary,
+    computed with plain float arithmetic: arrays only pay off for many rows.
+    """
+    from contract.utils import custom_round
+
+    employer_contribution = (income * employer_rate / 100) if employer_rate and income is not None else 0.0
+    salary_share = (income * employee_rate / 100) if employee_rate and income is not None else 0.0
+    total = salary_share + employer_contribution
+    return {
+        "total": custom_round(total),
+        "employerContribution": custom_round(employer_contribution),
+        "salaryShare": custom_round(salary_share),
+    }
+
+
+def percentage_contribution_rows(incomes, employer_rates, employee_rates):
+    """
+    percentage_contributions returned as a list of custom field dictionaries.
+    """
+    result = percentage_contributions(incomes, employer_rates, employee_rates)
+    return [
+        {"total": int(total), "employerContribution": int(employer), "salaryShare": int(salary)}
+        for total, employer, salary in zip(
+            result["total"].tolist(),
+            result["employerContribution"].tolist(),
+            result["salaryShare"].tolist(),
+        )
+    ]
+
+
+class ValuationEngine(object):
+    """
+    Evaluates the calculation rules of a contract valuation once per distinct
+    (contribution plan, calculation input) signature. The calculation input of a
+    contract detail is its json_ext (calculation_rule income/rate or forfait_rule),
+    which is the only per-detail data the contribution rules read, so details
+    sharing a signature share the result of a single run_calculation_rules call.
+    Bundle details are loaded once per bundle.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self._bundle_details = {}
+        self._results = {}
+        self.rule_invocations = 0
+
+    def bundle_details(self, contribution_plan_bundle_id):
+        key = str(contribution_plan_bundle_id)
+        if key not in self._bundle_details:
+            self._bundle_details[key] = list(
+                ContributionPlanBundleDetails.objects.filter(
+                    contribution_plan_bundle__id=key,
+                    is_deleted=False,
+                ).select_related("contribution_plan__benefit_plan")
+            )
+        return self._bundle_details[key]
+
+    @staticmethod
+    def signature(contribution_plan_id, contract_details):
+        if "json_ext" not in contract_details:
+            # without the calculation input the detail can't be grouped
+            return str(contribution_plan_id), "id", str(contract_details["id"])
+        return (
+            str(contribution_plan_id),
+            "json_ext",
+            json.dumps(contract_details["json_ext"], sort_keys=True, cls=DjangoJSONEncoder),
+        )
+
+    def run(self, ccpd, contract_details, method="create"):
+        key = (method,) + self.signature(ccpd.contribution_plan_id, contract_details)
+        if key not in self._results:
+            self._results[key] = run_calculation_rules(ccpd, method, self.user)
+            self.rule_invocations += 1
+        return self._results[key]
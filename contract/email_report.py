@@ -7,11 +7,14 @@ import logging
 
 from django.http import Http404
 
-from contract.models import Contract, ContractContributionPlanDetails
+from contract.models import Contract
+from contract.calculations import contribution_rates, percentage_contribution
+from contract.schedules import get_product_schedule
+from contract.utils import get_payment_product
 from contract.views import get_contract_custom_field_data
 from contribution_plan.models import ContributionPlanBundleDetails
 from insuree.reports.code_converstion_for_report import convert_activity_data
-from payment.models import Payment, PaymentDetail
+from payment.models import Payment
 from policyholder.models import PolicyHolder, PolicyHolderContributionPlan, PolicyHolderInsuree
 from report.apps import ReportConfig
 from report.services import get_report_definition, generate_report
@@ -21,33 +24,21 @@ def get_product_date(payment):
     new_date = ''
     now = datetime.now()
 
-    payment_details = PaymentDetail.objects.filter(payment=payment, legacy_id__isnull=True).first()
+    product = get_payment_product(payment)
+    if product:
+        last_date_to_create_payment = get_product_schedule(product).payment_end_date
 
-    if payment_details:
-        ccpd = ContractContributionPlanDetails.objects.filter(contribution__id=payment_details.premium.id).first()
+        if last_date_to_create_payment:
+            print('DAY:', last_date_to_create_payment.strftime('%d'))
 
-        if ccpd:
-            product_config = ccpd.contribution_plan.benefit_plan.config_data
+            year = last_date_to_create_payment.year
+            print('YEAR:', year)
 
-            if product_config:
-                last_date_to_create_payment = product_config.get("PaymentEndDate", '')
+            next_month_date = now + relativedelta(months=1)
+            if next_month_date.month == 12:
+                year += 1
 
-                if last_date_to_create_payment:
-                    last_date_to_create_payment = datetime.strptime(last_date_to_create_payment, '%Y-%m-%d').date()
-                    formatted_day = last_date_to_create_payment.strftime('%d')
-                    print('DAY:', formatted_day)
-
-                    year = last_date_to_create_payment.year
-                    print('YEAR:', year)
-
-                    next_month_date = now + relativedelta(months=1)
-                    new_month_str = next_month_date.strftime('%b')
-
-                    if new_month_str == 'Dec':
-                        year += 1
-
-                    new_date_str = f'{formatted_day}-{new_month_str}-{year}'
-                    new_date = datetime.strptime(new_date_str, '%d-%b-%Y').date()
+            new_date = last_date_to_create_payment.replace(month=next_month_date.month, year=year)
 
     return new_date.strftime('%d-%m-%Y') if new_date else ''
 
@@ -84,8 +75,6 @@ def generate_report_for_employee_declaration(contract_id, code, uuid, contract_a
         cpbd = ContributionPlanBundleDetails.objects.filter(contribution_plan_bundle=cpb, is_deleted=False).first()
 
         conti_plan = cpbd.contribution_plan if cpbd else None
-        ercp = 0
-        eecp = 0
         phn_json = PolicyHolderInsuree.objects.filter(contribution_plan_bundle__id=cpb.id,
                                                       policy_holder__code=policyholder.code,
                                                       policy_holder__date_valid_to__isnull=True,
@@ -95,15 +84,11 @@ def generate_report_for_employee_declaration(contract_id, code, uuid, contract_a
         if phn_json and phn_json.json_ext:
             json_data = phn_json.json_ext
             ei = float(json_data.get('calculation_rule', {}).get('income', 0))
-        if conti_plan and conti_plan.json_ext:
-            json_data = conti_plan.json_ext
-            calculation_rule = json_data.get('calculation_rule')
-            if calculation_rule:
-                ercp = float(calculation_rule.get('employerContribution', 0))
-                eecp = float(calculation_rule.get('employeeContribution', 0))
-        employer_contribution = round(ei * ercp / 100, 2) if ercp and ei is not None else 0
-        salary_share = round(ei * eecp / 100, 2) if eecp and ei is not None else 0
-        total = salary_share + employer_contribution
+        ercp, eecp = contribution_rates(conti_plan)
+        custom_field = percentage_contribution(ei, ercp, eecp)
+        employer_contribution = custom_field["employerContribution"]
+        salary_share = custom_field["salaryShare"]
+        total = custom_field["total"]
         logging.info("Data preparation successful")
         data = {
             "data": {
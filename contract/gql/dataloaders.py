@@ -0,0 +1,30 @@
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from contract.calculations import contribution_rates_by_bundle
+
+
+class ContributionRatesLoader(DataLoader):
+    """
+    Loads the (employer, employee) contribution rates of contribution plan bundles.
+    All the bundles requested while resolving a page are fetched with their
+    contribution plans in one query.
+    """
+
+    def batch_load_fn(self, bundle_ids):
+        rates = contribution_rates_by_bundle(bundle_ids)
+        return Promise.resolve([rates[bundle_id] for bundle_id in bundle_ids])
+
+
+def get_loader(info, loader_class):
+    """
+    Request scoped loader instance: loaders are cached on the request (info.context)
+    so the batches and their caches don't leak between requests.
+    """
+    loaders = getattr(info.context, "_contract_dataloaders", None)
+    if loaders is None:
+        loaders = {}
+        setattr(info.context, "_contract_dataloaders", loaders)
+    if loader_class not in loaders:
+        loaders[loader_class] = loader_class()
+    return loaders[loader_class]
@@ -28,10 +28,9 @@ from contract.gql.gql_types import ContractGQLType
 from contract.models import Contract
 from contract.tasks import (
     approve_contract_async,
-    approve_contracts,
-    counter_contracts,
     create_contract_async,
     create_invoice_from_contracts,
+    dispatch_bulk_contract_operation,
 )
 from contract.utils import generate_report_for_contract_receipt
 
@@ -223,12 +222,13 @@ class ApproveContractBulkMutation(ContractApproveMutationMixin, BaseMutation):
     )
     def async_mutate(cls, user, **data):
         error_message = None
-        if "client_mutation_id" in data:
-            data.pop("client_mutation_id")
+        client_mutation_id = data.pop("client_mutation_id", None)
         if "client_mutation_label" in data:
             data.pop("client_mutation_label")
         if "contract_uuids" in data or "uuids" in data:
-            error_message = cls.approve_contracts(user=user, contracts=data)
+            error_message = cls.approve_contracts(
+                user=user, contracts=data, client_mutation_id=client_mutation_id
+            )
         return error_message
 
     def _check_celery_status(cls):
@@ -246,7 +246,7 @@ class ApproveContractBulkMutation(ContractApproveMutationMixin, BaseMutation):
             )
 
     @classmethod
-    def approve_contracts(cls, user, contracts):
+    def approve_contracts(cls, user, contracts, client_mutation_id=None):
         try:
             cls._check_celery_status(cls)
         except CeleryWorkerError as e:
@@ -254,12 +254,13 @@ class ApproveContractBulkMutation(ContractApproveMutationMixin, BaseMutation):
         if "uuids" in contracts:
             contracts["uuids"] = list(
                 contracts["uuids"].values_list("id", flat=True))
-            approve_contracts.delay(
-                user_id=f"{user.id}", contracts=contracts["uuids"])
+            dispatch_bulk_contract_operation(
+                f"{user.id}", contracts["uuids"], "approve", client_mutation_id
+            )
         else:
             if "contract_uuids" in contracts:
-                approve_contracts.delay(
-                    user_id=f"{user.id}", contracts=contracts["contract_uuids"]
+                dispatch_bulk_contract_operation(
+                    f"{user.id}", contracts["contract_uuids"], "approve", client_mutation_id
                 )
 
     class Input(ContractApproveBulkInputType):
@@ -359,25 +360,27 @@ class CounterContractBulkMutation(ContractCounterMutationMixin, BaseMutation):
         Contract, ContractGQLType, "extended_filters", {}
     )
     def async_mutate(cls, user, **data):
-        if "client_mutation_id" in data:
-            data.pop("client_mutation_id")
+        client_mutation_id = data.pop("client_mutation_id", None)
         if "client_mutation_label" in data:
             data.pop("client_mutation_label")
         if "contract_uuids" in data or "uuids" in data:
-            cls.counter_contracts(user=user, contracts=data)
+            cls.counter_contracts(
+                user=user, contracts=data, client_mutation_id=client_mutation_id
+            )
         return None
 
     @classmethod
-    def counter_contracts(cls, user, contracts):
+    def counter_contracts(cls, user, contracts, client_mutation_id=None):
         if "uuids" in contracts:
             contracts["uuids"] = list(
                 contracts["uuids"].values_list("id", flat=True))
-            counter_contracts.delay(
-                user_id=f"{user.id}", contracts=contracts["uuids"])
+            dispatch_bulk_contract_operation(
+                f"{user.id}", contracts["uuids"], "counter", client_mutation_id
+            )
         else:
             if "contract_uuids" in contracts:
-                counter_contracts.delay(
-                    user_id=f"{user.id}", contracts=contracts["contract_uuids"]
+                dispatch_bulk_contract_operation(
+                    f"{user.id}", contracts["contract_uuids"], "counter", client_mutation_id
                 )
 
     class Input(ContractCounterBulkInputType):
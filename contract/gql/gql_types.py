@@ -6,18 +6,19 @@ from contract.models import (
     ContractDetailsMutation,
     ContractMutation,
 )
-from contract.utils import custom_round
+from contract.calculations import percentage_contribution
+from contract.gql.dataloaders import ContributionRatesLoader, get_loader
 from contribution.gql_queries import PremiumGQLType
 from contribution_plan.gql.gql_types import (
     ContributionPlanBundleGQLType,
     ContributionPlanGQLType,
 )
-from contribution_plan.models import ContributionPlanBundleDetails
 from core import ExtendedConnection, prefix_filterset
 from graphene_django import DjangoObjectType
 from insuree.schema import InsureeGQLType
 from policyholder.gql.gql_types import PolicyHolderGQLType
 from policyholder.models import PolicyHolderInsuree
+from promise import Promise
 
 
 class ContractGQLType(DjangoObjectType):
@@ -52,8 +53,17 @@ class ContractGQLType(DjangoObjectType):
     amount = graphene.Float()
 
 
+class ContractDetailsCustomFieldGQLType(graphene.ObjectType):
+    total = graphene.Float()
+    employer_contribution = graphene.Float()
+    salary_share = graphene.Float()
+
+
 class ContractDetailsGQLType(DjangoObjectType):
-    custom_field = graphene.String()
+    custom_field = graphene.String(
+        deprecation_reason="Use customFieldData, the same values as an object."
+    )
+    custom_field_data = graphene.Field(ContractDetailsCustomFieldGQLType)
 
     class Meta:
         model = ContractDetails
@@ -76,70 +86,36 @@ class ContractDetailsGQLType(DjangoObjectType):
             return ContractDetails.get_queryset(queryset, info)
 
     def resolve_custom_field(self, info):
+        return self._custom_field(info).then(
+            lambda custom_field: custom_field if custom_field is None else str(custom_field)
+        )
+
+    def resolve_custom_field_data(self, info):
+        return self._custom_field(info).then(
+            lambda custom_field: ContractDetailsCustomFieldGQLType(
+                total=custom_field.get("total"),
+                employer_contribution=custom_field.get("employerContribution"),
+                salary_share=custom_field.get("salaryShare"),
+            ) if custom_field is not None else None
+        )
+
+    def _custom_field(self, info):
+        # get forfait rule from json_ext
+        json_ext = self.json_ext if self.json_ext else None
+        if json_ext:
+            forfait_rule = json_ext.get('forfait_rule', None)
+            if forfait_rule:
+                return Promise.resolve(forfait_rule)
         try:
-            print(f"============================> resolve custom field self {self}")
-            cpb = self.contribution_plan_bundle
-            cpbd = ContributionPlanBundleDetails.objects.filter(
-                contribution_plan_bundle=cpb,
-                is_deleted=False
-            ).first()
-            conti_plan = cpbd.contribution_plan if cpbd else None
-            ercp = 0
-            eecp = 0
-            
-            # get forfait rule from json_ext
-            json_ext = self.json_ext if self.json_ext else None
-            if json_ext:
-                forfait_rule = json_ext.get('forfait_rule', None)
-                print(f"============================> forfait_rule {forfait_rule}")
-                if forfait_rule:
-                    return forfait_rule
-                
-            if conti_plan and conti_plan.json_ext:
-                json_data = conti_plan.json_ext
-
-                calculation_rule = json_data.get('calculation_rule')
-                if calculation_rule:
-                    ercp = float(calculation_rule.get(
-                        'employerContribution', 0.0))
-                    eecp = float(calculation_rule.get(
-                        'employeeContribution', 0.0))
-
-            # Uncommented lines can be used if needed for future logic
-            # insuree = self.insuree
-            # policy_holder = self.contract.policy_holder
-            # phn_json = PolicyHolderInsuree.objects.filter(
-            #     insuree_id=insuree.id,
-            #     policy_holder__code=policy_holder.code,
-            #     policy_holder__date_valid_to__isnull=True,
-            #     policy_holder__is_deleted=False,
-            #     date_valid_to__isnull=True,
-            #     is_deleted=False
-            # ).first()
-            # if phn_json and phn_json.json_ext:
-            #     json_data = phn_json.json_ext
-            #     ei = float(json_data.get('calculation_rule', {}).get('income', 0))
-            self_json = self.json_ext if self.json_ext else None
             ei = 0.0
-            if self_json:
+            if json_ext:
                 ei = float(
-                    self_json.get('calculation_rule', {}).get('income', 0.0))
-
-            # Use integer arithmetic to avoid floating-point issues
-            employer_contribution = (
-                ei * ercp / 100) if ercp and ei is not None else 0.0
-            salary_share = (
-                ei * eecp / 100) if eecp and ei is not None else 0.0
-            total = salary_share + employer_contribution
-
-            response = {
-                'total': custom_round(total),
-                'employerContribution': custom_round(employer_contribution),
-                'salaryShare': custom_round(salary_share),
-            }
-            return response
-        except Exception as e:
-            return None
+                    json_ext.get('calculation_rule', {}).get('income', 0.0))
+        except Exception:
+            return Promise.resolve(None)
+        return get_loader(info, ContributionRatesLoader).load(
+            self.contribution_plan_bundle_id
+        ).then(lambda rates: percentage_contribution(ei, *rates))
 
 
 class ContractContributionPlanDetailsGQLType(DjangoObjectType):
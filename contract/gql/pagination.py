@@ -0,0 +1,181 @@
+import base64
+import hashlib
+import json
+
+import graphene
+from core.schema import OrderedDjangoFilterConnectionField
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import F, Q
+from graphene.relay import PageInfo
+
+KEYSET_DEFAULT_ORDER = "-date_created"
+KEYSET_DEFAULT_PAGE_SIZE = 100
+KEYSET_COUNT_CACHE_TIMEOUT = 300
+KEYSET_COUNT_CACHE_PREFIX = "contract_keyset_count"
+
+
+def keyset_order(queryset):
+    """
+    Order of a keyset page: the orderBy columns of the queryset (date_created by
+    default) and the id, in the direction of the first column, as the tie breaker.
+    """
+    ordering = list(queryset.query.order_by) or [KEYSET_DEFAULT_ORDER]
+    if not all(isinstance(column, str) for column in ordering):
+        raise ValueError("Keyset pagination is only supported on orderBy columns")
+    if "id" not in [column.lstrip("-") for column in ordering]:
+        ordering.append("-id" if ordering[0].startswith("-") else "id")
+    return ordering
+
+
+def _nullable(model, column):
+    # columns that aren't model fields (annotations) are considered nullable
+    for name in column.lstrip("-").split("__"):
+        if model is None:
+            return True
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return True
+        if getattr(field, "null", False):
+            return True
+        model = field.related_model
+    return False
+
+
+def keyset_order_by(model, order):
+    """
+    order_by arguments of a keyset page. NULLs of nullable columns are sorted
+    last in both directions, so keyset_filter knows where they are.
+    """
+    order_by = []
+    for column in order:
+        if _nullable(model, column):
+            name = column.lstrip("-")
+            if column.startswith("-"):
+                order_by.append(F(name).desc(nulls_last=True))
+            else:
+                order_by.append(F(name).asc(nulls_last=True))
+        else:
+            order_by.append(column)
+    return order_by
+
+
+def _value(node, column):
+    value = node
+    for attribute in column.lstrip("-").split("__"):
+        if value is None:
+            return None
+        value = getattr(value, attribute)
+    # related objects are compared on their primary key
+    return getattr(value, "pk", value)
+
+
+def encode_keyset_cursor(node, order):
+    values = [_value(node, column) for column in order]
+    values = [None if value is None else f"{value}" for value in values]
+    return base64.b64encode(json.dumps(values).encode("utf-8")).decode("utf-8")
+
+
+def decode_keyset_cursor(cursor):
+    try:
+        return json.loads(base64.b64decode(cursor.encode("utf-8")).decode("utf-8"))
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid keyset cursor: {cursor}")
+
+
+def _equal(column, value):
+    name = column.lstrip("-")
+    if value is None:
+        return Q(**{f"{name}__isnull": True})
+    return Q(**{name: value})
+
+
+def _after(model, column, value):
+    name = column.lstrip("-")
+    if value is None:
+        # NULLs are sorted last: nothing follows them in this column
+        return Q(pk__in=[])
+    lookup = "lt" if column.startswith("-") else "gt"
+    after = Q(**{f"{name}__{lookup}": value})
+    if _nullable(model, column):
+        after |= Q(**{f"{name}__isnull": True})
+    return after
+
+
+def keyset_filter(model, order, values):
+    """
+    Rows after the cursor values in the given order, e.g. for (-date_created, -id):
+    date_created < d or (date_created = d and id < i). NULL values are
+    matched with isnull, as the last values of their column.
+    """
+    if len(values) != len(order):
+        raise ValueError("The keyset cursor doesn't match the ordering")
+    after = Q(pk__in=[])
+    for index, column in enumerate(order):
+        condition = _after(model, column, values[index])
+        for previous, value in zip(order[:index], values[:index]):
+            condition &= _equal(previous, value)
+        after |= condition
+    return after
+
+
+def approximate_count(queryset, timeout=KEYSET_COUNT_CACHE_TIMEOUT):
+    """
+    Count of the queryset cached for `timeout` seconds, per query: scrolling
+    through the pages of the same query doesn't count the rows again.
+    """
+    sql = f"{queryset.model._meta.db_table}:{queryset.order_by().query}"
+    key = f"{KEYSET_COUNT_CACHE_PREFIX}:{hashlib.md5(sql.encode('utf-8')).hexdigest()}"
+    return cache.get_or_set(key, queryset.order_by().count, timeout)
+
+
+class KeysetConnectionField(OrderedDjangoFilterConnectionField):
+    """
+    OrderedDjangoFilterConnectionField with an opt-in keyset pagination mode.
+    With keyset: true, the edge cursors hold the ordering values of the node
+    and `after` returns the rows following them: a page is an index range scan
+    of `first` rows, whatever its depth, instead of an OFFSET. The ordering is
+    the orderBy columns (date_created by default) and the id, with NULLs last.
+    totalCount is only computed with approximateCount: true, from a count
+    cached for a while.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("keyset", graphene.Boolean())
+        kwargs.setdefault("approximate_count", graphene.Boolean())
+        super().__init__(*args, **kwargs)
+
+    @classmethod
+    def resolve_connection(cls, connection, args, iterable, max_limit=None):
+        if not args.get("keyset"):
+            return super().resolve_connection(connection, args, iterable, max_limit=max_limit)
+        model = iterable.model
+        order = keyset_order(iterable)
+        queryset = iterable.order_by(*keyset_order_by(model, order))
+        after = args.get("after")
+        if after:
+            queryset = queryset.filter(
+                keyset_filter(model, order, decode_keyset_cursor(after))
+            )
+        first = args.get("first") or max_limit or KEYSET_DEFAULT_PAGE_SIZE
+        if max_limit:
+            first = min(first, max_limit)
+        # one extra row tells whether there is a next page
+        nodes = list(queryset[: first + 1])
+        edges = [
+            connection.Edge(node=node, cursor=encode_keyset_cursor(node, order))
+            for node in nodes[:first]
+        ]
+        result = connection(
+            edges=edges,
+            page_info=PageInfo(
+                start_cursor=edges[0].cursor if edges else None,
+                end_cursor=edges[-1].cursor if edges else None,
+                has_previous_page=bool(after),
+                has_next_page=len(nodes) > first,
+            ),
+        )
+        result.iterable = iterable
+        result.length = approximate_count(iterable) if args.get("approximate_count") else None
+        return result
@@ -0,0 +1,66 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:12
+
+import re
+import uuid
+
+from django.db import migrations, models
+
+CONTRACT_CODE_PATTERN = re.compile(r"^D([A-Z]{3})(\d{2})(\d{4})(\d{6})$")
+
+
+def seed_code_counters(apps, schema_editor):
+    Contract = apps.get_model("contract", "Contract")
+    ContractCodeCounter = apps.get_model("contract", "ContractCodeCounter")
+    counters = {}
+    # the pattern is matched here rather than with a database regex lookup
+    codes = (
+        Contract.objects.filter(code__startswith="D")
+        .values_list("code", flat=True)
+        .iterator()
+    )
+    for code in codes:
+        match = CONTRACT_CODE_PATTERN.match(code)
+        if not match:
+            continue
+        department_code, month, year, increment = match.groups()
+        key = (department_code, int(month), int(year))
+        counters[key] = max(counters.get(key, 0), int(increment))
+    ContractCodeCounter.objects.bulk_create(
+        [
+            ContractCodeCounter(
+                id=uuid.uuid4(),
+                department_code=department_code,
+                month=month,
+                year=year,
+                last_value=last_value,
+            )
+            for (department_code, month, year), last_value in counters.items()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contract', '0029_auto_20250513_1311'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContractCodeCounter',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('department_code', models.CharField(max_length=8)),
+                ('month', models.PositiveSmallIntegerField()),
+                ('year', models.PositiveSmallIntegerField()),
+                ('last_value', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'tblContractCodeCounter',
+                'managed': True,
+                'unique_together': {('department_code', 'month', 'year')},
+            },
+        ),
+        migrations.RunPython(seed_code_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:02
+
+from django.db import migrations, models
+
+PROCESS_STATUS_CHOICES = [
+    ('processing', 'Processing'),
+    ('created', 'Created'),
+    ('uploading', 'Uploading'),
+    ('uploaded', 'Uploaded'),
+    ('processing_uploaded_data', 'Processing Uploaded Data'),
+    ('failed_to_create', 'Failed to Create'),
+    ('failed_to_upload', 'Failed to Upload'),
+    ('approval_contributions_created', 'Approval: Contributions Created'),
+    ('approval_penalty_evaluated', 'Approval: Penalty Evaluated'),
+    ('approval_payment_created', 'Approval: Payment Created'),
+    ('approval_contract_approved', 'Approval: Contract Approved'),
+    ('approval_notified', 'Approval: Notified'),
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contract', '0030_contractcodecounter'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='contract',
+            name='process_status',
+            field=models.CharField(blank=True, choices=PROCESS_STATUS_CHOICES, max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name='historicalcontract',
+            name='process_status',
+            field=models.CharField(blank=True, choices=PROCESS_STATUS_CHOICES, max_length=50, null=True),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contract', '0031_contract_approval_process_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContractNotification',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('notification_type', models.CharField(max_length=50)),
+                ('recipient', models.CharField(blank=True, max_length=255, null=True)),
+                ('payload', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=16)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_sent', models.DateTimeField(blank=True, null=True)),
+                ('contract', models.ForeignKey(db_column='ContractUUID', on_delete=django.db.models.deletion.CASCADE, to='contract.contract')),
+            ],
+            options={
+                'db_table': 'tblContractNotificationOutbox',
+                'managed': True,
+            },
+        ),
+        migrations.AddIndex(
+            model_name='contractnotification',
+            index=models.Index(fields=['status', 'date_created'], name='contract_notif_status_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-18 12:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contract', '0032_contractnotification'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='contract',
+            index=models.Index(fields=['state', 'date_valid_to'], name='contract_state_valid_to_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:05
+
+from django.db import migrations, models
+from django.db.models import Case, F, When
+
+
+def backfill_effective_amount(apps, schema_editor):
+    # same rule as the Contract.amount property, in a single UPDATE
+    Contract = apps.get_model("contract", "Contract")
+    Contract.objects.update(
+        effective_amount=Case(
+            When(state__in=[1, 2], then=F("amount_notified")),
+            When(state__in=[4, 11, 3], then=F("amount_rectified")),
+            default=F("amount_due"),
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contract', '0033_contract_state_valid_to_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contract',
+            name='effective_amount',
+            field=models.FloatField(blank=True, db_column='EffectiveAmount', null=True),
+        ),
+        migrations.AddField(
+            model_name='historicalcontract',
+            name='effective_amount',
+            field=models.FloatField(blank=True, db_column='EffectiveAmount', null=True),
+        ),
+        migrations.RunPython(backfill_effective_amount, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='contract',
+            index=models.Index(fields=['state', 'effective_amount'], name='contract_state_eff_amount_idx'),
+        ),
+    ]
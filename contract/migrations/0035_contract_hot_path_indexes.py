@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contract', '0034_contract_effective_amount'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='contract',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['policy_holder', '-date_created'], name='contract_ph_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='contract',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['code'], name='contract_code_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='contractdetails',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['contract', 'is_confirmed'], name='cd_contract_confirmed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='contractcontributionplandetails',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['contract_details'], name='ccpd_details_active_idx'),
+        ),
+    ]
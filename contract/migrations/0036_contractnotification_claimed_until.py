@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contract', '0035_contract_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contractnotification',
+            name='claimed_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='contractnotification',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=16),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contract', '0036_contractnotification_claimed_until'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='contract',
+            name='contract_state_eff_amount_idx',
+        ),
+        migrations.AddIndex(
+            model_name='contract',
+            index=models.Index(fields=['effective_amount', 'state'], name='contract_eff_amount_state_idx'),
+        ),
+    ]
@@ -30,6 +30,12 @@ class Contract(core_models.HistoryBusinessModel):
         PROCESSING_UPLOADED_DATA = "processing_uploaded_data", "Processing Uploaded Data"
         FAILED_TO_CREATE = "failed_to_create", "Failed to Create"
         FAILED_TO_UPLOAD = "failed_to_upload", "Failed to Upload"
+        # checkpoints of the approval pipeline (contract.approval)
+        APPROVAL_CONTRIBUTIONS_CREATED = "approval_contributions_created", "Approval: Contributions Created"
+        APPROVAL_PENALTY_EVALUATED = "approval_penalty_evaluated", "Approval: Penalty Evaluated"
+        APPROVAL_PAYMENT_CREATED = "approval_payment_created", "Approval: Payment Created"
+        APPROVAL_CONTRACT_APPROVED = "approval_contract_approved", "Approval: Contract Approved"
+        APPROVAL_NOTIFIED = "approval_notified", "Approval: Notified"
 
     code = models.CharField(db_column="Code", max_length=64, null=False)
     policy_holder = models.ForeignKey(
@@ -47,6 +53,10 @@ class Contract(core_models.HistoryBusinessModel):
     )
     amount_due = models.FloatField(
         db_column="AmountDue", blank=True, null=True)
+    # stored value of the amount property, kept in sync in save()
+    effective_amount = models.FloatField(
+        db_column="EffectiveAmount", blank=True, null=True
+    )
     date_approved = fields.DateTimeField(
         db_column="DateApproved", blank=True, null=True
     )
@@ -102,19 +112,28 @@ class Contract(core_models.HistoryBusinessModel):
 
     objects = ContractManager()
 
+    # states in which the contract amount is the notified or rectified amount,
+    # the amount due otherwise
+    AMOUNT_NOTIFIED_STATES = [1, 2]
+    AMOUNT_RECTIFIED_STATES = [4, 11, 3]
+    # fields the effective_amount depends on
+    EFFECTIVE_AMOUNT_FIELDS = {"state", "amount_notified", "amount_rectified", "amount_due"}
+
     @property
     def amount(self):
         amount = 0
-        if self.state in [1, 2]:
+        if self.state in self.AMOUNT_NOTIFIED_STATES:
             amount = self.amount_notified
-        elif self.state in [4, 11, 3]:
+        elif self.state in self.AMOUNT_RECTIFIED_STATES:
             amount = self.amount_rectified
-        elif self.state in [5, 6, 7, 8, 9, 10]:
-            amount = self.amount_due
         else:
             amount = self.amount_due
         return amount
 
+    def save(self, *args, **kwargs):
+        self.effective_amount = self.amount
+        return super().save(*args, **kwargs)
+
     @classmethod
     def get_queryset(cls, queryset, user):
         queryset = cls.filter_queryset(queryset)
@@ -128,6 +147,30 @@ class Contract(core_models.HistoryBusinessModel):
 
     class Meta:
         db_table = "tblContract"
+        indexes = [
+            # expired contracts lookup of the scheduled termination
+            models.Index(
+                fields=["state", "date_valid_to"],
+                name="contract_state_valid_to_idx",
+            ),
+            # amount range search and ordering of the contract list
+            models.Index(
+                fields=["effective_amount", "state"],
+                name="contract_eff_amount_state_idx",
+            ),
+            # contracts of a policy holder, latest first
+            models.Index(
+                fields=["policy_holder", "-date_created"],
+                name="contract_ph_created_idx",
+                condition=models.Q(is_deleted=False),
+            ),
+            # contract code lookups
+            models.Index(
+                fields=["code"],
+                name="contract_code_active_idx",
+                condition=models.Q(is_deleted=False),
+            ),
+        ]
 
     STATE_REQUEST_FOR_INFORMATION = 1
     STATE_DRAFT = 2
@@ -186,6 +229,14 @@ class ContractDetails(core_models.HistoryModel):
 
     class Meta:
         db_table = "tblContractDetails"
+        indexes = [
+            # (confirmed) details of a contract
+            models.Index(
+                fields=["contract", "is_confirmed"],
+                name="cd_contract_confirmed_idx",
+                condition=models.Q(is_deleted=False),
+            )
+        ]
 
 
 class ContractContributionPlanDetailsManager(models.Manager):
@@ -237,6 +288,14 @@ class ContractContributionPlanDetails(core_models.HistoryBusinessModel):
 
     class Meta:
         db_table = "tblContractContributionPlanDetails"
+        indexes = [
+            # ccpd of contract details, the policy has its foreign key index
+            models.Index(
+                fields=["contract_details"],
+                name="ccpd_details_active_idx",
+                condition=models.Q(is_deleted=False),
+            )
+        ]
 
 
 class ContractMutation(core_models.UUIDModel, core_models.ObjectMutation):
@@ -294,3 +353,72 @@ class ContractPolicy(core_models.UUIDModel):
 
     def __str__(self):
         return f"{self.contract.id} - {self.policy.id}"
+
+
+class ContractCodeCounter(core_models.UUIDModel):
+    """
+    Last contract code increment handed out for a department and a month.
+    Codes are allocated with an atomic upsert (or a row lock) on this row, see
+    contract.services.allocate_contract_codes.
+    """
+    department_code = models.CharField(max_length=8)
+    month = models.PositiveSmallIntegerField()
+    year = models.PositiveSmallIntegerField()
+    last_value = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        managed = True
+        db_table = "tblContractCodeCounter"
+        unique_together = ("department_code", "month", "year")
+
+    def __str__(self):
+        return f"{self.department_code} {self.month:02d}/{self.year} - {self.last_value}"
+
+
+class ContractNotification(core_models.UUIDModel):
+    """
+    Outbox of the contract emails. The approval only enqueues a row, the
+    message and its attachments are rendered and sent by
+    contract.notifications.send_pending_notifications (celery worker).
+    """
+    TYPE_APPROVED_PAYMENT = "approved_payment"
+
+    STATUS_PENDING = "pending"
+    STATUS_SENDING = "sending"
+    STATUS_SENT = "sent"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = (
+        (STATUS_PENDING, "Pending"),
+        (STATUS_SENDING, "Sending"),
+        (STATUS_SENT, "Sent"),
+        (STATUS_FAILED, "Failed"),
+    )
+
+    contract = models.ForeignKey(
+        Contract, db_column="ContractUUID", on_delete=models.deletion.CASCADE
+    )
+    notification_type = models.CharField(max_length=50)
+    recipient = models.CharField(max_length=255, null=True, blank=True)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(
+        max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING
+    )
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # lease of the worker sending the notification, see status sending
+    claimed_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(null=True, blank=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        managed = True
+        db_table = "tblContractNotificationOutbox"
+        indexes = [
+            models.Index(
+                fields=["status", "date_created"],
+                name="contract_notif_status_idx",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.notification_type} {self.contract_id} - {self.status}"
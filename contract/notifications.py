@@ -0,0 +1,179 @@
+import logging
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from contract.config import get_message_approved_contract
+from contract.models import ContractNotification
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATION_BATCH_SIZE = 50
+NOTIFICATION_MAX_ATTEMPTS = 5
+# a claimed notification not sent within the lease (crashed worker) is claimable again
+NOTIFICATION_CLAIM_LEASE = timedelta(minutes=15)
+XLSX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def enqueue_payment_notification(contract, contract_approved_date):
+    """
+    Queue the payment notification of an approved contract. Only the outbox row
+    is written here; the worker is started once the transaction is committed.
+    """
+    policy_holder = contract.policy_holder
+    contact_name = (
+        policy_holder.contact_name["contactName"]
+        if policy_holder.contact_name and "contactName" in policy_holder.contact_name
+        else policy_holder.contact_name
+    )
+    notification = ContractNotification.objects.create(
+        contract=contract,
+        notification_type=ContractNotification.TYPE_APPROVED_PAYMENT,
+        recipient=policy_holder.email,
+        payload={
+            "code": contract.code,
+            "name": policy_holder.trade_name,
+            "contact_name": contact_name,
+            "amount_due": contract.amount_due,
+            "payment_reference": contract.payment_reference,
+            "policy_holder_id": f"{policy_holder.id}",
+            "contract_approved_date": f"{contract_approved_date.isoformat()}",
+        },
+    )
+    transaction.on_commit(_start_worker)
+    return notification
+
+
+def _start_worker():
+    from contract.tasks import send_contract_notifications
+
+    try:
+        send_contract_notifications.delay()
+    except Exception as exc:
+        # the notification stays in the outbox for the next run
+        logger.error(f"Failed to start the contract notification worker: {exc}")
+
+
+def build_payment_email(notification, connection=None):
+    from contract.email_report import generate_report_for_employee_declaration
+    from contract.views import send_contract
+
+    payload = notification.payload
+    contract_approved_date = datetime.fromisoformat(
+        payload["contract_approved_date"]
+    )
+    email_message = EmailMessage(
+        subject="Contract payment notification",
+        body=get_message_approved_contract(
+            language=settings.LANGUAGE_CODE.split("-")[0],
+            code=payload["code"],
+            name=payload["name"],
+            contact_name=payload["contact_name"],
+            due_amount=payload["amount_due"],
+            payment_reference=payload["payment_reference"],
+        ),
+        from_email=settings.EMAIL_HOST_USER,
+        to=[notification.recipient],
+        connection=connection,
+    )
+    # Attach the PDF file
+    pdf_file = generate_report_for_employee_declaration(
+        notification.contract_id,
+        payload["code"],
+        payload["policy_holder_id"],
+        contract_approved_date,
+    )
+    email_message.attach("payment_receipt.pdf", pdf_file, "application/pdf")
+    # Attach the Excel file
+    excel_file = send_contract(notification.contract_id)
+    email_message.attach("employee_declaration.xlsx", excel_file, XLSX_CONTENT_TYPE)
+    return email_message
+
+
+NOTIFICATION_BUILDERS = {
+    ContractNotification.TYPE_APPROVED_PAYMENT: build_payment_email,
+}
+
+
+def _claim_batch(batch_size, processed_ids):
+    """
+    Move a batch of pending notifications (or sending ones whose lease expired)
+    to sending under a lease, so no other worker picks them up while this one
+    sends them.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        notifications = list(
+            ContractNotification.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status=ContractNotification.STATUS_PENDING)
+                | Q(
+                    status=ContractNotification.STATUS_SENDING,
+                    claimed_until__lt=now,
+                )
+            )
+            .exclude(id__in=processed_ids)
+            .order_by("date_created")[:batch_size]
+        )
+        # claimed rows count an attempt so a crashed worker can't loop forever
+        for notification in notifications:
+            notification.attempts += 1
+            notification.status = ContractNotification.STATUS_SENDING
+            notification.claimed_until = now + NOTIFICATION_CLAIM_LEASE
+        ContractNotification.objects.bulk_update(
+            notifications, ["attempts", "status", "claimed_until"]
+        )
+    return notifications
+
+
+def send_pending_notifications(batch_size=NOTIFICATION_BATCH_SIZE):
+    """
+    Render and send the pending outbox notifications batch by batch. A batch
+    is claimed (status sending) before it is sent over a single mail server
+    connection, so concurrent workers never send the same notification.
+    Failed notifications go back to pending until NOTIFICATION_MAX_ATTEMPTS
+    and are then marked failed. Returns the number of notifications sent.
+    """
+    total_sent = 0
+    # failed notifications are retried by the next run, not in this one
+    processed_ids = set()
+    while True:
+        notifications = _claim_batch(batch_size, processed_ids)
+        if not notifications:
+            return total_sent
+        processed_ids.update(notification.id for notification in notifications)
+        connection = get_connection()
+        connection.open()
+        try:
+            for notification in notifications:
+                try:
+                    builder = NOTIFICATION_BUILDERS[notification.notification_type]
+                    builder(notification, connection=connection).send()
+                    notification.status = ContractNotification.STATUS_SENT
+                    notification.date_sent = timezone.now()
+                    notification.last_error = None
+                    total_sent += 1
+                except Exception as exc:
+                    logger.exception(
+                        f"send_pending_notifications : notification {notification.id} failed"
+                    )
+                    notification.last_error = f"{exc}"
+                    if notification.attempts >= NOTIFICATION_MAX_ATTEMPTS:
+                        notification.status = ContractNotification.STATUS_FAILED
+                    else:
+                        notification.status = ContractNotification.STATUS_PENDING
+                notification.claimed_until = None
+        finally:
+            connection.close()
+        ContractNotification.objects.bulk_update(
+            notifications, ["status", "date_sent", "last_error", "claimed_until"]
+        )
+        logger.info(
+            f"send_pending_notifications : batch of {len(notifications)} processed"
+        )
+        if len(notifications) < batch_size:
+            return total_sent
@@ -0,0 +1,299 @@
+import csv
+import io
+import logging
+
+from django.db import transaction
+
+from contract.bulk_utils import BULK_BATCH_SIZE, bulk_update_history_objects
+from contract.models import ContractDetails
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_CHUNK_SIZE = 1000
+HEADER_CHF_ID = "Numéro CAMU temporaire"
+HEADER_INSUREE_NAME = "Assuré"
+HEADER_GROSS_SALARY = "Gross Salary"
+
+
+XLS_SIGNATURE = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+
+
+def _is_xlsx(file_data):
+    # xlsx files are zip archives
+    return file_data[:2] == b"PK"
+
+
+def _is_xls(file_data):
+    # legacy xls files are OLE2 compound documents
+    return file_data[:8] == XLS_SIGNATURE
+
+
+def _empty(value):
+    return value is None or (isinstance(value, str) and not value.strip()) or value != value
+
+
+def _normalize_chf_id(value):
+    if _empty(value):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def _to_int(value):
+    if isinstance(value, str):
+        value = value.strip().replace(" ", "").replace(",", ".")
+    return int(float(value))
+
+
+def _xlsx_rows(file_data):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(io.BytesIO(file_data), read_only=True, data_only=True)
+    try:
+        worksheet = workbook.worksheets[0]
+        rows = worksheet.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        header = [str(col).strip() if col is not None else "" for col in header]
+        for row in rows:
+            if row is None or all(_empty(value) for value in row):
+                continue
+            yield dict(zip(header, row))
+    finally:
+        workbook.close()
+
+
+def _xls_rows(file_data):
+    # legacy format read with pandas as before, an xls sheet is at most 65536 rows
+    import pandas as pd
+
+    df = pd.read_excel(io.BytesIO(file_data))
+    df.columns = [str(col).strip() for col in df.columns]
+    for row in df.to_dict("records"):
+        if all(_empty(value) for value in row.values()):
+            continue
+        yield row
+
+
+def _csv_rows(file_data):
+    text = io.TextIOWrapper(io.BytesIO(file_data), encoding="utf-8-sig", newline="")
+    sample = text.read(4096)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(text, dialect)
+    header = next(reader, None)
+    if header is None:
+        return
+    header = [col.strip() for col in header]
+    for row in reader:
+        if not row or all(_empty(value) for value in row):
+            continue
+        yield dict(zip(header, row))
+
+
+def count_salary_rows(file_data):
+    """
+    Number of data rows of the upload, used as the progress total. Read-only
+    workbooks take it from the sheet dimensions when they are recorded.
+    """
+    if _is_xlsx(file_data):
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(io.BytesIO(file_data), read_only=True)
+        try:
+            max_row = workbook.worksheets[0].max_row
+        finally:
+            workbook.close()
+        if max_row:
+            return max(max_row - 1, 0)
+    return sum(1 for _ in iter_salary_rows(file_data))
+
+
+def iter_salary_rows(file_data):
+    """
+    Rows of an xlsx (openpyxl read-only mode) or CSV salary upload as dictionaries
+    keyed by the stripped header, without loading the whole sheet in memory.
+    Legacy xls uploads are still read, through pandas.
+    """
+    if _is_xlsx(file_data):
+        return _xlsx_rows(file_data)
+    if _is_xls(file_data):
+        return _xls_rows(file_data)
+    return _csv_rows(file_data)
+
+
+def iter_salary_chunks(file_data, chunk_size=UPLOAD_CHUNK_SIZE):
+    chunk = []
+    for row in iter_salary_rows(file_data):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class SalaryUpload(object):
+    """
+    Applies a salary upload to the details of a contract chunk by chunk. The
+    contract details of the chf_ids of a chunk are resolved with one query and
+    the changed salaries are written with one bulk update (plus history) per chunk.
+    Only the chf_ids and insuree ids already seen are kept between chunks.
+    """
+
+    def __init__(self, contract, policy_holder, cpb, user, progress_recorder=None):
+        self.contract = contract
+        self.policy_holder = policy_holder
+        self.cpb = cpb
+        self.enrolment_type = cpb.name if cpb else None
+        self.user = user
+        self.progress_recorder = progress_recorder
+        self.total_lines = 0
+        self.total_salaries_updated = 0
+        self.total_validation_errors = 0
+        self.processed_chf_ids = set()
+        self.confirmed_insuree_ids = set()
+
+    def _contract_details_by_chf_id(self, chf_ids):
+        return {
+            detail.insuree.chf_id: detail
+            for detail in ContractDetails.objects.filter(
+                contract_id=self.contract.id,
+                is_deleted=False,
+                insuree__chf_id__in=chf_ids,
+            ).select_related("insuree")
+        }
+
+    def _create_insuree(self, insuree_name):
+        from contract.utils import create_new_insuree_and_add_contract_details
+
+        return create_new_insuree_and_add_contract_details(
+            insuree_name,
+            self.policy_holder,
+            self.cpb,
+            self.contract,
+            self.user.id_for_audit,
+            None,  # No request object in async task
+            self.enrolment_type,
+        )
+
+    def _new_gross_salary(self, row):
+        if self.contract.use_bundle_contribution_plan_amount is not False:
+            return 0
+        gross_salary = row.get(HEADER_GROSS_SALARY)
+        if _empty(gross_salary):
+            return None
+        new_gross_salary = _to_int(gross_salary)
+        if new_gross_salary <= 0:
+            return None
+        return new_gross_salary
+
+    def process_chunk(self, rows):
+        from contract.views import update_salary
+
+        resolved_rows = []
+        for row in rows:
+            self.total_lines += 1
+            chf_id = _normalize_chf_id(row.get(HEADER_CHF_ID))
+            if not chf_id:
+                insuree_name = row.get(HEADER_INSUREE_NAME)
+                if _empty(insuree_name):
+                    continue
+                chf_id = self._create_insuree(str(insuree_name))
+                if not chf_id:
+                    continue
+            resolved_rows.append((chf_id, row))
+
+        details_by_chf_id = self._contract_details_by_chf_id(
+            {chf_id for chf_id, _ in resolved_rows}
+        )
+        to_update = []
+        for chf_id, row in resolved_rows:
+            if chf_id in self.processed_chf_ids:
+                continue
+            self.processed_chf_ids.add(chf_id)
+            new_gross_salary = self._new_gross_salary(row)
+            if new_gross_salary is None:
+                continue
+
+            contract_detail = details_by_chf_id.get(chf_id)
+            if not contract_detail:
+                self.total_validation_errors += 1
+                logger.info(f"salary upload : {chf_id} : contract detail not found")
+                continue
+
+            current_salary = (
+                int(contract_detail.json_ext.get("calculation_rule", {}).get("income", 0))
+                if contract_detail.json_ext
+                else 0
+            )
+            if current_salary == 0:
+                contract_detail.json_ext = {
+                    "calculation_rule": {"rate": 0, "income": new_gross_salary}
+                }
+            self.confirmed_insuree_ids.add(contract_detail.insuree_id)
+            if current_salary != new_gross_salary:
+                json_data = update_salary(contract_detail.json_ext, new_gross_salary)
+                if json_data is None:
+                    raise ValueError(f"Failed to update salary for chf_id {chf_id}")
+                contract_detail.json_ext = json_data
+                to_update.append(contract_detail)
+
+        bulk_update_history_objects(
+            ContractDetails, to_update, ["json_ext"], self.user.username
+        )
+        self.total_salaries_updated += len(to_update)
+
+    def update_confirmation(self):
+        """
+        Confirm the details of the uploaded insurees and unconfirm the others,
+        writing only the details whose flag changes.
+        """
+        batch = []
+        for contract_detail in ContractDetails.objects.filter(
+            contract_id=self.contract.id, is_deleted=False
+        ).iterator(chunk_size=BULK_BATCH_SIZE):
+            is_confirmed = contract_detail.insuree_id in self.confirmed_insuree_ids
+            if contract_detail.is_confirmed is not is_confirmed:
+                contract_detail.is_confirmed = is_confirmed
+                batch.append(contract_detail)
+            if len(batch) == BULK_BATCH_SIZE:
+                bulk_update_history_objects(
+                    ContractDetails, batch, ["is_confirmed"], self.user.username
+                )
+                batch = []
+        bulk_update_history_objects(
+            ContractDetails, batch, ["is_confirmed"], self.user.username
+        )
+
+    def run(self, file_data, chunk_size=UPLOAD_CHUNK_SIZE):
+        from contract.services import set_waiting_period_for_insurees
+
+        total_rows = count_salary_rows(file_data)
+        self.set_progress(0, total_rows, "Starting salary updates...")
+        with transaction.atomic():
+            for rows in iter_salary_chunks(file_data, chunk_size):
+                self.process_chunk(rows)
+                self.set_progress(
+                    self.total_lines,
+                    max(total_rows, self.total_lines),
+                    f"Processing row {self.total_lines} of {total_rows}",
+                )
+            set_waiting_period_for_insurees(
+                self.confirmed_insuree_ids, self.policy_holder.id
+            )
+            self.update_confirmation()
+        logger.info(
+            f"salary upload : contract {self.contract.id} : {self.total_lines} lines, "
+            f"{self.total_salaries_updated} salaries updated, "
+            f"{self.total_validation_errors} errors"
+        )
+
+    def set_progress(self, current, total, description):
+        if self.progress_recorder:
+            self.progress_recorder.set_progress(current, total, description)
@@ -0,0 +1,192 @@
+import calendar
+import datetime
+import logging
+import threading
+
+from dateutil.relativedelta import relativedelta
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLICY_START_DAY = 6
+DEFAULT_POLICY_WAITING_PERIOD = 4
+CONFIG_DATE_FORMAT = "%Y-%m-%d"
+
+
+def _config_date(product_config, key):
+    value = product_config.get(key, None)
+    if not value:
+        return None
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(value, CONFIG_DATE_FORMAT).date()
+
+
+def _config_day(product_config, key):
+    # same as utils.get_period_from_date: a day of month or a date string
+    value = product_config.get(key, None)
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value:
+        try:
+            return datetime.datetime.strptime(value, CONFIG_DATE_FORMAT).date().day
+        except ValueError as exc:
+            logger.error(f"Error getting period from date: {exc}")
+    return None
+
+
+class ProductSchedule(object):
+    """
+    CAMU date rules of a product (benefit plan) compiled from its config_data:
+    the policy start day and waiting period, the monthly declaration window and
+    the payment due date. The config is parsed once per product version, the
+    methods only do date arithmetic and can be applied to many dates at once.
+    """
+
+    def __init__(self, product):
+        product_config = product.config_data or {}
+        self.product_id = product.id
+        self.insurance_period = product.insurance_period
+        self.policy_waiting_period = getattr(product, "policy_waiting_period", None)
+        self.payment_end_date = _config_date(product_config, "PaymentEndDate")
+        self.payment_end_day = _config_day(product_config, "paymentEndDate")
+        self.declaration_start_date = _config_date(product_config, "declarationStartDate")
+        self.declaration_end_date = _config_date(product_config, "declarationEndDate")
+        # desired_start_policy_day is a policy start day in month: the day after
+        # the product PaymentEndDate, the 6th by default
+        self.policy_start_day = (
+            self.payment_end_date.day + 1
+            if self.payment_end_date
+            else DEFAULT_POLICY_START_DAY
+        )
+
+    @property
+    def policy_month_gap(self):
+        return self.policy_waiting_period or DEFAULT_POLICY_WAITING_PERIOD
+
+    def policy_start(self, date_valid_from):
+        """
+        Start date of the first policy of a contract starting on date_valid_from.
+        """
+        policy_start_date = date_valid_from.replace(day=self.policy_start_day)
+        return policy_start_date + relativedelta(months=self.policy_month_gap)
+
+    def policy_window(self, start, parent=False, has_other_contracts=False):
+        """
+        (start date, expiry date) of the policy covering from `start` for a
+        contract with or without parent (insurance period 3) and for a policy
+        holder with or without other contracts (insurance period 12).
+        """
+        start_day = self.policy_start_day
+        expiry_date = start + relativedelta(months=self.insurance_period)
+        # Changing start date and end date of policy with insurance period 1 as per CAMU Requirement
+        if self.insurance_period == 1:
+            start = start.replace(day=start_day) + relativedelta(months=1)
+            expiry_date = start + relativedelta(months=self.insurance_period)
+            expiry_date = expiry_date.replace(day=start_day - 1)
+
+        # Changing start date and end date of policy with insurance period 3 as per CAMU Requirement
+        if self.insurance_period == 3:
+            if parent:
+                month_gap, extra_months = 1, 1
+            else:
+                month_gap, extra_months = self.policy_waiting_period or 3, 0
+            start = start.replace(day=start_day) + relativedelta(months=month_gap)
+            expiry_date = start + relativedelta(
+                months=self.insurance_period + extra_months
+            )
+            expiry_date = expiry_date.replace(day=start_day - 1)
+
+        if self.insurance_period == 12:
+            month_gap = self.policy_month_gap
+            start = start + relativedelta(months=month_gap)
+            if has_other_contracts:
+                start = start + relativedelta(months=month_gap - 6)
+            start = start.replace(day=start_day)
+            expiry_date = start + relativedelta(months=self.insurance_period)
+            expiry_date = expiry_date.replace(day=start_day - 1)
+        return start, expiry_date
+
+    def policy_windows(self, starts, parent=False, has_other_contracts=False):
+        return [
+            self.policy_window(start, parent, has_other_contracts) for start in starts
+        ]
+
+    def declaration_window(self, create_date):
+        """
+        (start, end) of the declaration period the contract created on
+        `create_date` falls in, None when the product has no declaration dates.
+        The configured dates are moved to the month of the creation date;
+        when the configured period spans two months, the one overlapping the
+        creation day is used.
+        """
+        if not self.declaration_start_date or not self.declaration_end_date:
+            return None
+        start_date, end_date = self.declaration_start_date, self.declaration_end_date
+        start_day, end_day = start_date.day, end_date.day
+        day, month, year = create_date.day, create_date.month, create_date.year
+        if start_day < end_day and day < end_day and start_day != day:
+            start_date = start_date.replace(day=start_day, month=month, year=year)
+            end_day = min(end_day, calendar.monthrange(year, month)[1])
+            end_date = end_date.replace(day=end_day, month=month, year=year)
+        elif start_day > end_day and start_day < day and day > end_day:
+            start_date = start_date.replace(day=start_day, month=month, year=year)
+            next_month = create_date + relativedelta(months=1)
+            end_date = end_date.replace(
+                day=end_day, month=next_month.month, year=next_month.year
+            )
+        elif start_day > end_day and start_day > day and day < end_day:
+            end_date = end_date.replace(day=end_day, month=month, year=year)
+            previous_month = create_date - relativedelta(months=1)
+            start_date = start_date.replace(
+                day=start_day, month=previous_month.month, year=previous_month.year
+            )
+        return start_date, end_date
+
+    def declaration_windows(self, create_dates):
+        return [self.declaration_window(create_date) for create_date in create_dates]
+
+    def payment_due(self, date):
+        """
+        Payment due date of a contract starting on `date`: the paymentEndDate day
+        of the following month.
+        """
+        if self.payment_end_day is None or date is None:
+            return None
+        try:
+            due_date = date.replace(day=self.payment_end_day) + relativedelta(months=1)
+        except ValueError as exc:
+            logger.error(f"Error getting next month limit date: {exc}")
+            return None
+        return due_date
+
+
+class ProductScheduleCache(object):
+    """
+    Process level cache of the compiled ProductSchedule, keyed by product id
+    and version (validity_from), so a new product version is compiled again.
+    `invalidate` is connected to the Product save/delete signals.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._schedules = {}
+
+    def invalidate(self, *args, **kwargs):
+        with self._lock:
+            self._schedules = {}
+
+    def get(self, product):
+        key = (product.id, getattr(product, "validity_from", None))
+        with self._lock:
+            schedule = self._schedules.get(key)
+            if schedule is None:
+                schedule = ProductSchedule(product)
+                self._schedules[key] = schedule
+            return schedule
+
+
+product_schedules = ProductScheduleCache()
+
+
+def get_product_schedule(product):
+    return product_schedules.get(product)
@@ -7,15 +7,12 @@ import graphene
 import graphene_django_optimizer as gql_optimizer
 from dateutil.relativedelta import relativedelta
 
-from django.db.models import Q
+from django.db.models import F, Q
 
 from policyholder.models import PolicyHolder, PolicyHolderContributionPlan
 from .services import check_unique_code
 from core.gql_queries import ValidationMessageGQLType
-from core.schema import (
-    signal_mutation_module_before_mutating,
-    OrderedDjangoFilterConnectionField,
-)
+from core.schema import signal_mutation_module_before_mutating
 from core.utils import append_validity_filter
 from contract.models import (
     Contract,
@@ -23,6 +20,7 @@ from contract.models import (
     ContractContributionPlanDetails,
     ContractMutation,
 )
+from contract.gql.pagination import KeysetConnectionField
 from contract.gql.gql_types import (
     ContractGQLType,
     ContractDetailsGQLType,
@@ -50,14 +48,19 @@ from contract.gql.gql_mutations.contract_details_mutations import (
     CreateContractDetailByPolicyHolderInsureeMutation,
 )
 from contract.apps import ContractConfig
-from contract.utils import filter_amount_contract
+from contract.utils import (
+    filter_amount_contract,
+    filter_contract_client_mutation_id,
+    filter_contract_details_client_mutation_id,
+    filter_contract_insuree,
+)
 
 logger = logging.getLogger(__name__)
 erp_url = os.environ.get("ERP_HOST", "https://camu-staging-15480786.dev.odoo.com")
 
 
 class Query(graphene.ObjectType):
-    contract = OrderedDjangoFilterConnectionField(
+    contract = KeysetConnectionField(
         ContractGQLType,
         client_mutation_id=graphene.String(),
         insuree=graphene.UUID(),
@@ -69,14 +72,14 @@ class Query(graphene.ObjectType):
         applyDefaultValidityFilter=graphene.Boolean(),
     )
 
-    contract_details = OrderedDjangoFilterConnectionField(
+    contract_details = KeysetConnectionField(
         ContractDetailsGQLType,
         client_mutation_id=graphene.String(),
         orderBy=graphene.List(of_type=graphene.String),
         is_confirmed=graphene.Boolean(),
     )
 
-    contract_contribution_plan_details = OrderedDjangoFilterConnectionField(
+    contract_contribution_plan_details = KeysetConnectionField(
         ContractContributionPlanDetailsGQLType,
         insuree=graphene.UUID(),
         contributionPlanBundle=graphene.UUID(),
@@ -212,22 +215,24 @@ class Query(graphene.ObjectType):
                 raise PermissionError("Unauthorized")
 
         filters = append_validity_filter(**kwargs)
+        # reverse relations are filtered with EXISTS: no duplicated contract rows
+        # to count and paginate over
         client_mutation_id = kwargs.get("client_mutation_id", None)
         if client_mutation_id:
-            filters.append(
-                Q(mutations__mutation__client_mutation_id=client_mutation_id)
-            )
+            filters.append(filter_contract_client_mutation_id(client_mutation_id))
 
         insuree = kwargs.get("insuree", None)
         if insuree:
-            filters.append(Q(contractdetails__insuree__uuid=insuree))
+            filters.append(filter_contract_insuree(insuree))
 
         # amount filters
         amount_from = kwargs.get("amount_from", None)
         amount_to = kwargs.get("amount_to", None)
         if amount_from or amount_to:
             filters.append(filter_amount_contract(**kwargs))
-        return gql_optimizer.query(Contract.objects.filter(*filters).all(), info)
+        # orderBy amount sorts on the stored effective amount
+        query = Contract.objects.alias(amount=F("effective_amount"))
+        return gql_optimizer.query(query.filter(*filters).all(), info)
 
     def resolve_contract_details(self, info, **kwargs):
         if not info.context.user.has_perms(ContractConfig.gql_query_contract_perms):
@@ -240,7 +245,7 @@ class Query(graphene.ObjectType):
         client_mutation_id = kwargs.get("client_mutation_id", None)
         if client_mutation_id:
             filters.append(
-                Q(mutations__mutation__client_mutation_id=client_mutation_id)
+                filter_contract_details_client_mutation_id(client_mutation_id)
             )
         is_confirmed = kwargs.get("is_confirmed", None)
         if is_confirmed:
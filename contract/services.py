@@ -1,6 +1,9 @@
+import bisect
 import calendar
 import json
 import logging
+import time
+import uuid
 from copy import copy
 from datetime import datetime
 from decimal import Decimal
@@ -16,7 +19,7 @@ from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.core.mail import BadHeaderError, send_mail
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models.query import Q
 from django.forms.models import model_to_dict
 from django.utils import timezone
@@ -31,66 +34,41 @@ from policy.models import Policy
 from policyholder.models import PolicyHolder, PolicyHolderInsuree
 
 from contract.apps import ContractConfig
+from contract.bulk_utils import (
+    BULK_BATCH_SIZE,
+    bulk_create_history_objects,
+    bulk_update_history_objects,
+)
+from contract.approval import is_retryable_approval_error
+from contract.calculations import ValuationEngine, distribute_forfait_amount
 from contract.models import Contract as ContractModel
 from contract.models import (
     ContractContributionPlanDetails as ContractContributionPlanDetailsModel,
 )
+from contract.models import ContractCodeCounter
 from contract.models import ContractDetails as ContractDetailsModel
 from contract.models import ContractPolicy
-from contract.signals import signal_contract, signal_contract_approve
-from contract.utils import get_due_payment_date
+from contract.schedules import get_product_schedule
+from contract.signals import (
+    get_contract_approval_pipeline,
+    signal_contract,
+    signal_contract_approve,
+)
+from contract.utils import (
+    DEPARTMENT_CODES,
+    get_due_payment_date,
+    location_department_index,
+)
 
 from .config import get_message_counter_contract
 
 logger = logging.getLogger("openimis." + __file__)
 
-# Map of department names to codes
-DEPARTMENT_CODES = {
-    "BOUENZA": "BOA",
-    "CUVETTE": "CVT",
-    "CUVETTE-OUEST": "CVO",
-    "KOUILOU": "KLO",
-    "LEKOUMOU": "LKM",
-    "LIKOUALA": "LKA",
-    "NIARI": "NRI",
-    "PLATEAUX": "PTX",
-    "POOL": "POL",
-    "SANGHA": "SGH",
-    "POINTE-NOIRE": "PNR",
-    "BRAZZAVILLE": "BZV",
-    "DJOUE-LEFINI": "DJL",
-    "NKENI-ALIMA": "NKA",
-    "CONGO-OUBANGUI": "COB",
-}
-
-
-def generate_contract_code(policy_holder, date):
-    # Get department code from policy holder location
-    department_code = None
-    location = policy_holder.locations
-    while location:
-        if hasattr(location, "type") and location.type == "R":
-            # Normalize location name - remove accents, convert to uppercase
-            import unicodedata
-
-            loc_name = "".join(
-                c
-                for c in unicodedata.normalize("NFD", location.name)
-                if unicodedata.category(c) != "Mn"
-            ).upper()
-            # Find best matching department code
-            for dept_name, code in DEPARTMENT_CODES.items():
-                dept_name_clean = "".join(
-                    c
-                    for c in unicodedata.normalize("NFD", dept_name)
-                    if unicodedata.category(c) != "Mn"
-                )
-                if dept_name_clean in loc_name or loc_name in dept_name_clean:
-                    department_code = code
-                    break
-            break
-        location = location.parent if hasattr(location, "parent") else None
 
+def get_department_code(policy_holder):
+    department_code = location_department_index.department_code(
+        policy_holder.locations_id
+    )
     if not department_code:
         logger.error(
             f"No valid department (type 'R') found in location hierarchy for policy holder {policy_holder.id}"
@@ -98,38 +76,69 @@ def generate_contract_code(policy_holder, date):
         raise ValueError(
             f"Could not find valid department (type 'R') in location hierarchy for policy holder {policy_holder.id}"
         )
+    return department_code
+
+
+def _upsert_code_counter(department_code, date, count):
+    # PostgreSQL: bump the counter in one INSERT ... ON CONFLICT round trip
+    counter_table = connection.ops.quote_name(ContractCodeCounter._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO {counter_table} (id, department_code, month, year, last_value)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (department_code, month, year)
+            DO UPDATE SET last_value = {counter_table}.last_value + EXCLUDED.last_value
+            RETURNING last_value
+            """,
+            [uuid.uuid4(), department_code, date.month, date.year, count],
+        )
+        return cursor.fetchone()[0]
+
 
-    # Get month and year from current date
+def _lock_code_counter(department_code, date, count):
+    # other backends: lock the counter row (created on first use) and bump it
+    with transaction.atomic():
+        counter, _ = ContractCodeCounter.objects.select_for_update().get_or_create(
+            department_code=department_code,
+            month=date.month,
+            year=date.year,
+            defaults={"last_value": 0},
+        )
+        counter.last_value += count
+        counter.save(update_fields=["last_value"])
+        return counter.last_value
+
+
+def allocate_contract_codes(department_code, date, count=1):
+    """
+    Reserve `count` consecutive contract codes for the department and the
+    month/year of `date`. The per (department, month, year) counter is bumped
+    with a single upsert on PostgreSQL and under a row lock on the other
+    backends; either way concurrent workers get their own range of increments.
+    """
+    if count < 1:
+        raise ValueError("At least one contract code has to be reserved")
+    if connection.vendor == "postgresql":
+        last_value = _upsert_code_counter(department_code, date, count)
+    else:
+        last_value = _lock_code_counter(department_code, date, count)
     month = date.strftime("%m")
     year = date.strftime("%Y")
-    # Get increment by checking last contract from same month/year that starts with 'D'
-    # Find contracts from same month/year and get highest increment
-    contracts_this_month = ContractModel.objects.filter(
-        code__startswith="D",
-        date_created__month=date.month,
-        date_created__year=date.year,
-        is_deleted=False,
-    ).order_by("-code")
-
-    increment = 1
-    if contracts_this_month.exists():
-        # Get highest increment from existing contracts this month
-        highest_contract = contracts_this_month.first()
-        increment = int(highest_contract.code[-6:]) + 1
-
-    # Format the new contract code and check if it exists
-    while True:
-        new_code = f"D{department_code}{month}{year}{increment:06d}"
-        if not ContractModel.objects.filter(code=new_code, is_deleted=False).exists():
-            break
-        increment += 1
-    logger.debug(f"====> Generated new contract code: {new_code}")
-    # with connection.cursor() as cursor:
-    #    cursor.execute("SELECT nextval('public.contract_code_seq')")
-    #    sequence_value = cursor.fetchone()[0]
-
-    # new_code = f"CONT{sequence_value:09}"
-    return new_code
+    codes = [
+        f"D{department_code}{month}{year}{increment:06d}"
+        for increment in range(last_value - count + 1, last_value + 1)
+    ]
+    logger.debug(f"====> Reserved contract codes: {codes[0]} - {codes[-1]}")
+    return codes
+
+
+def reserve_contract_codes(policy_holder, date, count=1):
+    return allocate_contract_codes(get_department_code(policy_holder), date, count)
+
+
+def generate_contract_code(policy_holder, date):
+    return reserve_contract_codes(policy_holder, date)[0]
 
 
 class ContractUpdateError(Exception):
@@ -161,10 +170,6 @@ class Contract(object):
 
     @check_authentication
     def create(self, contract):
-        from policyholder.gql.gql_mutations.create_mutations import (
-            get_and_set_waiting_period_for_insuree,
-        )
-
         try:
             if contract["policy_holder_id"]:
                 logger.debug(
@@ -220,19 +225,13 @@ class Contract(object):
                     }
                 )
 
-                # get_and_set_waiting_period_for_insuree
-                contract_details_to_update = ContractDetailsModel.objects.filter(
-                    contract_id=uuid_string, is_deleted=False
+                set_waiting_period_for_insurees(
+                    ContractDetailsModel.objects.filter(
+                        contract_id=uuid_string, is_deleted=False
+                    ).values_list("insuree_id", flat=True),
+                    policy_holder.id,
                 )
-                for contract_detail in contract_details_to_update:
-                    logger.info(
-                        f"-----------------------------------*****----------- get_and_set_waiting_period_for_insuree: {contract_detail.insuree.id}, {policy_holder.id}"
-                    )
-                    get_and_set_waiting_period_for_insuree(
-                        contract_detail.insuree.id, policy_holder.id
-                    )
 
-                # get_and_set_waiting_period_for_insuree
 
                 print(
                     f"---------------------------result_ph_insuree: {result_ph_insuree}"
@@ -255,38 +254,14 @@ class Contract(object):
                     c.amount_notified = rounded_total_amount
                     c.use_bundle_contribution_plan_amount = True
 
-                    contract_details_to_update = ContractDetailsModel.objects.filter(
-                        contract_id=uuid_string, is_confirmed=False, is_deleted=False
+                    distribute_forfait_amount(
+                        ContractDetailsModel.objects.filter(
+                            contract_id=uuid_string, is_confirmed=False, is_deleted=False
+                        ).order_by("date_created", "id"),
+                        rounded_total_amount,
+                        self.user.username,
                     )
 
-                    forfait_total = 0
-
-                    if rounded_total_amount > 0:
-                        total_contract_detail = len(contract_details_to_update)
-                        forfait_total = rounded_total_amount / total_contract_detail
-
-                    print(
-                        f"============================> forfait_total {forfait_total}")
-
-                    for contract_detail in contract_details_to_update:
-                        contract_detail.is_confirmed = True
-
-                        contract_detail.json_ext = {
-                            "calculation_rule": {"rate": 0, "income": 0},
-                            "forfait_rule": {
-                                "total": round(forfait_total),
-                                "employerContribution": 0,
-                                "salaryShare": 0,
-                            },
-                        }
-                        contract_detail.save(username=self.user.username)
-                        # logger.info(
-                        #     f"-----------------------------------*****----------- get_and_set_waiting_period_for_insuree: {contract_detail.insuree.id}, {policy_holder.id}"
-                        # )
-                        # get_and_set_waiting_period_for_insuree(
-                        #     contract_detail.insuree.id, policy_holder.id
-                        # )
-
             print(f"---------------------------c-1: {c}")
             historical_record = c.history.all().last()
             print(
@@ -586,8 +561,13 @@ class Contract(object):
             )
             state_right = self.__check_rights_by_status(
                 contract_to_approve.state)
-            # check if we can submit
-            if state_right != "approvable":
+            # check if we can submit, an interrupted approval can always be resumed
+            if (
+                state_right != "approvable"
+                and not get_contract_approval_pipeline(
+                    contract_to_approve
+                ).is_resumable()
+            ):
                 raise ContractUpdateError(
                     "You cannot approve this contract! The status of contract is not Negotiable!"
                 )
@@ -663,9 +643,12 @@ class Contract(object):
             return _output_result_success(dict_representation=dict_representation)
         except Exception as exc:
             logger.exception("Exception in approve contract")
-            return _output_exception(
+            result = _output_exception(
                 model_name="Contract", method="approve", exception=exc
             )
+            # tells the async approval whether a retry can succeed
+            result["retryable"] = is_retryable_approval_error(exc)
+            return result
 
     @check_authentication
     def counter(self, contract):
@@ -944,28 +927,9 @@ class Contract(object):
     @check_authentication
     def terminate_contract(self):
         try:
-            # TODO - add this service to the tasks.py in apscheduler once a day
-            #  to check if contract might be terminated
-            from core import datetime
-
-            contracts_to_terminate = list(
-                ContractModel.objects.filter(
-                    Q(date_valid_to__lt=datetime.datetime.now(), state=7)
-                )
-            )
-            if len(contracts_to_terminate) > 0:
-                for contract in contracts_to_terminate:
-                    # we can marked that contract as a terminated
-                    contract.state = ContractModel.STATE_TERMINATED
-                    contract.save(username=self.user.username)
-                    historical_record = contract.history.all().first()
-                    contract.json_ext = _save_json_external(
-                        user_id=str(historical_record.user_updated.id),
-                        datetime=str(historical_record.date_updated),
-                        message=f"contract terminated - state "
-                        f"{historical_record.state}",
-                    )
-                    contract.save(username=self.user.username)
+            # scheduled once a day, see tasks.terminate_expired_contracts
+            result = terminate_expired_contracts(username=self.user.username)
+            if result["terminated"] > 0:
                 return {
                     "success": True,
                     "message": "Ok",
@@ -1042,142 +1006,61 @@ class ContractDetails(object):
     def update_from_ph_insuree(self, contract_details):
         try:
             contract_insuree_list = []
-            policy_holder_insuree = PolicyHolderInsuree.objects.filter(
-                policy_holder__id=contract_details["policy_holder_id"],
+            contract = ContractModel.objects.get(id=contract_details["contract_id"])
+            policy_holder_insuree = list(
+                PolicyHolderInsuree.objects.filter(
+                    policy_holder__id=contract_details["policy_holder_id"],
+                ).select_related("contribution_plan_bundle")
             )
-            print("policy_holder_insuree : ", policy_holder_insuree)
             logger.info(
-                f"update_from_ph_insuree : policy_holder_insuree : {policy_holder_insuree}"
+                f"update_from_ph_insuree : policy_holder_insuree : {len(policy_holder_insuree)}"
             )
             if (
                 len(policy_holder_insuree) > 0
                 and policy_holder_insuree[0].contribution_plan_bundle.periodicity == 12
             ):
-                exclude_phi = []
-                for phi in policy_holder_insuree:
-                    phi_cd = (
-                        ContractDetailsModel.objects.filter(
-                            insuree_id=phi.insuree.id,
-                            contract__policy_holder__id=contract_details[
-                                "policy_holder_id"
-                            ],
-                            contribution_plan_bundle_id=phi.contribution_plan_bundle.id,
-                            contract__is_deleted=False,
-                            is_deleted=False,
-                        )
-                        .order_by("insuree__id", "-date_created")
-                        .distinct("insuree__id")
-                    )
-                    print("phi_cd : ", phi_cd)
-                    logger.info(f"update_from_ph_insuree : phi_cd : {phi_cd}")
-
-                    if phi_cd and len(phi_cd) > 0:
-                        for cd in phi_cd:
-                            print("cd : ", cd)
-                            logger.info(f"update_from_ph_insuree : cd : {cd}")
-                            ccpd = ContractContributionPlanDetailsModel.objects.filter(
-                                contract_details_id=cd.id, is_deleted=False
-                            ).first()
-                            contract = ContractModel.objects.filter(
-                                id=contract_details["contract_id"]
-                            ).first()
-
-                            desired_start_policy_day = 6
-                            try:
-                                product_config = (
-                                    ccpd.contribution_plan.benefit_plan.config_data
-                                )
-                            except Exception as e:
-                                product_config = None
-                            print("product_config : ", product_config)
-                            if product_config:
-                                last_date_to_create_payment = product_config.get(
-                                    "PaymentEndDate", None
-                                )
-                                if last_date_to_create_payment:
-                                    last_date_to_create_payment = datetime.strptime(
-                                        last_date_to_create_payment, "%Y-%m-%d"
-                                    ).date()
-                                    last_date_day_to_create_payment = (
-                                        last_date_to_create_payment.day
-                                    )
-                                    desired_start_policy_day = (
-                                        last_date_day_to_create_payment + 1
-                                    )
-
-                            desired_month_gap_policy_contract = 4
-                            if ccpd.contribution_plan.benefit_plan.policy_waiting_period:
-                                desired_month_gap_policy_contract = ccpd.contribution_plan.benefit_plan.policy_waiting_period
-
-                            # last_date_covered is the policy Start date
-                            policy_start_date = contract.date_valid_from.date()
-                            policy_start_date = policy_start_date.replace(
-                                day=desired_start_policy_day
-                            )
-                            policy_start_date = policy_start_date + relativedelta(
-                                months=desired_month_gap_policy_contract
-                            )
-
-                            print("policy_start_date : ", policy_start_date)
-                            print("ccpd.policy.expiry_date : ",
-                                  ccpd.policy.expiry_date)
-                            print("ccpd.policy.id : ", ccpd.policy.id)
-                            print("phi.insuree.id : ", phi.insuree.id)
-                            print("phi.id : ", phi.id)
-
-                            logger.info(
-                                f"update_from_ph_insuree : policy_start_date : {policy_start_date}"
-                            )
-                            logger.info(
-                                f"update_from_ph_insuree : ccpd.policy.expiry_date : {ccpd.policy.expiry_date}"
-                            )
-                            logger.info(
-                                f"update_from_ph_insuree : ccpd.policy.id : {ccpd.policy.id}"
-                            )
-                            logger.info(
-                                f"update_from_ph_insuree : phi.insuree.id : {phi.insuree.id}"
-                            )
-                            logger.info(
-                                f"update_from_ph_insuree : phi.id : {phi.id}")
-
-                            if ccpd.policy.expiry_date > policy_start_date:
-                                exclude_phi.append(phi.id)
-
-                print("exclude_phi : ", exclude_phi)
+                exclude_phi = self.__get_still_covered_ph_insurees(
+                    policy_holder_insuree=policy_holder_insuree,
+                    policy_holder_id=contract_details["policy_holder_id"],
+                    contract=contract,
+                )
                 logger.info(
                     f"update_from_ph_insuree : exclude_phi : {exclude_phi}")
                 if len(exclude_phi) > 0:
-                    policy_holder_insuree = policy_holder_insuree.exclude(
-                        id__in=exclude_phi
-                    )
+                    policy_holder_insuree = [
+                        phi for phi in policy_holder_insuree if phi.id not in exclude_phi
+                    ]
 
+            new_contract_details = []
             for phi in policy_holder_insuree:
                 # TODO add the validity condition also!
                 if phi.is_deleted is False and phi.contribution_plan_bundle:
+                    # TODO add only the caclulation_rule section
                     cd = ContractDetailsModel(
                         **{
-                            "contract_id": contract_details["contract_id"],
-                            "insuree_id": phi.insuree.id,
-                            "contribution_plan_bundle_id": f"{phi.contribution_plan_bundle.id}",
+                            "contract": contract,
+                            "insuree_id": phi.insuree_id,
+                            "contribution_plan_bundle_id": phi.contribution_plan_bundle_id,
                             "json_ext": phi.json_ext,
                         }
                     )
-                    # TODO add only the caclulation_rule section
-                    cd.save(username=self.user.username)
-                    uuid_string = f"{cd.id}"
-                    dict_representation = model_to_dict(cd)
-                    dict_representation["id"], dict_representation["uuid"] = (
-                        uuid_string,
-                        uuid_string,
-                    )
-                    dict_representation["policy_id"] = (
-                        phi.last_policy.id if phi.last_policy else None
-                    )
-                    dict_representation["amendment"] = contract_details["amendment"]
-                    dict_representation["contract_date_valid_from"] = (
-                        cd.contract.date_valid_from
-                    )
-                    contract_insuree_list.append(dict_representation)
+                    new_contract_details.append((cd, phi.last_policy_id))
+            bulk_create_history_objects(
+                ContractDetailsModel,
+                [cd for cd, _ in new_contract_details],
+                self.user.username,
+            )
+            for cd, last_policy_id in new_contract_details:
+                uuid_string = f"{cd.id}"
+                dict_representation = model_to_dict(cd)
+                dict_representation["id"], dict_representation["uuid"] = (
+                    uuid_string,
+                    uuid_string,
+                )
+                dict_representation["policy_id"] = last_policy_id
+                dict_representation["amendment"] = contract_details["amendment"]
+                dict_representation["contract_date_valid_from"] = contract.date_valid_from
+                contract_insuree_list.append(dict_representation)
         except Exception as exc:
             return _output_exception(
                 model_name="ContractDetails",
@@ -1186,6 +1069,59 @@ class ContractDetails(object):
             )
         return _output_result_success(dict_representation=contract_insuree_list)
 
+    def __get_still_covered_ph_insurees(self, policy_holder_insuree, policy_holder_id, contract):
+        """
+        Return the ids of the PolicyHolderInsuree whose policy from the last contract
+        of the policy holder still runs after the policy start of the new contract.
+        The latest ContractDetails and their first CCPD are loaded for the whole
+        policy holder at once and the comparison is done in memory.
+        """
+        latest_contract_details = {
+            (insuree_id, contribution_plan_bundle_id): cd_id
+            for insuree_id, contribution_plan_bundle_id, cd_id in ContractDetailsModel.objects.filter(
+                contract__policy_holder__id=policy_holder_id,
+                contract__is_deleted=False,
+                is_deleted=False,
+            )
+            .order_by("insuree_id", "contribution_plan_bundle_id", "-date_created")
+            .distinct("insuree_id", "contribution_plan_bundle_id")
+            .values_list("insuree_id", "contribution_plan_bundle_id", "id")
+        }
+        if not latest_contract_details:
+            return set()
+        ccpd_by_contract_details = {
+            ccpd.contract_details_id: ccpd
+            for ccpd in ContractContributionPlanDetailsModel.objects.filter(
+                contract_details_id__in=list(latest_contract_details.values()),
+                is_deleted=False,
+            )
+            .select_related("policy", "contribution_plan__benefit_plan")
+            .order_by("contract_details_id", "id")
+            .distinct("contract_details_id")
+        }
+        policy_start_dates = {}
+        exclude_phi = set()
+        for phi in policy_holder_insuree:
+            cd_id = latest_contract_details.get(
+                (phi.insuree_id, phi.contribution_plan_bundle_id)
+            )
+            ccpd = ccpd_by_contract_details.get(cd_id)
+            if not ccpd:
+                continue
+            product = ccpd.contribution_plan.benefit_plan
+            if product.id not in policy_start_dates:
+                policy_start_dates[product.id] = self.__get_policy_start_date(
+                    product, contract
+                )
+            if ccpd.policy.expiry_date > policy_start_dates[product.id]:
+                exclude_phi.add(phi.id)
+        return exclude_phi
+
+    def __get_policy_start_date(self, product, contract):
+        return get_product_schedule(product).policy_start(
+            contract.date_valid_from.date()
+        )
+
     @check_authentication
     def ph_insuree_to_contract_details(self, contract, ph_insuree):
         try:
@@ -1236,6 +1172,157 @@ class ContractDetails(object):
             )
 
 
+def _as_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+class _PolicyCoverageIndex(object):
+    """
+    Policies of the family heads of a contract, loaded with one query and kept
+    per (head insuree, product) as lists sorted by start date, so the coverage
+    lookups of __get_policy are answered in memory. Policies generated while
+    creating the contract are added to the index as they are created.
+    """
+
+    def __init__(self, insurees, products, date_valid_from, date_valid_to):
+        self._start_dates = {}
+        self._policies = {}
+        if not insurees or not products:
+            return
+        for policy in Policy.objects.filter(
+            family__head_insuree_id__in={insuree.id for insuree in insurees},
+            product_id__in={product.id for product in products},
+            start_date__lte=date_valid_to,
+            expiry_date__gte=date_valid_from,
+        ).select_related("family").order_by("start_date", "id"):
+            self._append(policy.family.head_insuree_id, policy)
+
+    def _append(self, head_insuree_id, policy):
+        key = (head_insuree_id, policy.product_id)
+        start_date = _as_date(policy.start_date)
+        start_dates = self._start_dates.setdefault(key, [])
+        position = bisect.bisect_right(start_dates, start_date)
+        start_dates.insert(position, start_date)
+        self._policies.setdefault(key, []).insert(position, policy)
+
+    def add(self, insuree, policy):
+        # the policy covers the family, whichever member it was generated for
+        if insuree.family:
+            self._append(insuree.family.head_insuree_id, policy)
+
+    def covering(self, insuree, product, date_valid_from, date_valid_to):
+        """
+        Policies of the family headed by the insuree for the product that overlap
+        [date_valid_from, date_valid_to], sorted by start date.
+        """
+        key = (insuree.id, product.id)
+        if key not in self._policies:
+            return []
+        date_valid_from = _as_date(date_valid_from)
+        end = bisect.bisect_right(self._start_dates[key], _as_date(date_valid_to))
+        return [
+            policy
+            for policy in self._policies[key][:end]
+            if _as_date(policy.expiry_date) >= date_valid_from
+        ]
+
+
+class _PolicyGenerator(object):
+    """
+    Builds the policies of the insurees of one contract in memory and inserts
+    them with their ContractPolicy rows in bulk. The policy windows (from the
+    cached product schedule) and the "policy holder has other contracts" flag
+    are computed once and reused for every insuree.
+    """
+
+    def __init__(self, contract, families_with_policy):
+        self.contract = contract
+        self.policy_holder = contract.policy_holder
+        self.families_with_policy = families_with_policy
+        self.policies = []
+        self.contract_policies = []
+        self._has_other_contracts = None
+        self._windows = {}
+
+    @property
+    def has_other_contracts(self):
+        if self._has_other_contracts is None:
+            self._has_other_contracts = self.policy_holder.contract_set.exclude(
+                id=self.contract.id
+            ).exists()
+        return self._has_other_contracts
+
+    def policy_window(self, product, last_date_covered):
+        """
+        (start date, expiry date) of the policy of `product` starting from
+        `last_date_covered`, before the first policy shift of 12 months products.
+        """
+        key = (product.id, last_date_covered)
+        if key not in self._windows:
+            self._windows[key] = get_product_schedule(product).policy_window(
+                last_date_covered,
+                parent=bool(self.contract.parent),
+                has_other_contracts=(
+                    product.insurance_period == 12 and self.has_other_contracts
+                ),
+            )
+        return self._windows[key]
+
+    def generate(self, insuree, product, last_date_covered, date_valid_to):
+        policy_output = []
+        while last_date_covered < date_valid_to:
+            last_date_covered, expiry_date = self.policy_window(
+                product, last_date_covered
+            )
+            if (
+                product.insurance_period == 12
+                and insuree.family_id not in self.families_with_policy
+            ):
+                # first policy of the family starts 3 months later
+                last_date_covered = last_date_covered + relativedelta(months=3)
+            cur_policy = Policy(
+                **{
+                    "family": insuree.family,
+                    "is_valid": False,
+                    "product": product,
+                    "status": Policy.STATUS_LOCKED,
+                    "stage": Policy.STAGE_NEW,
+                    "enroll_date": last_date_covered,
+                    "start_date": last_date_covered,
+                    "validity_from": last_date_covered,
+                    "effective_date": last_date_covered,
+                    "expiry_date": expiry_date,
+                    "validity_to": None,
+                    "audit_user_id": -1,
+                }
+            )
+            if insuree.family_id:
+                self.families_with_policy.add(insuree.family_id)
+            self.policies.append((cur_policy, insuree))
+            last_date_covered = expiry_date
+            policy_output.append(cur_policy)
+        return policy_output, last_date_covered
+
+    def save(self):
+        if not self.policies:
+            return
+        Policy.objects.bulk_create(
+            [policy for policy, _ in self.policies], batch_size=BULK_BATCH_SIZE
+        )
+        ContractPolicy.objects.bulk_create(
+            [
+                ContractPolicy(
+                    contract=self.contract,
+                    policy=policy,
+                    insuree=insuree,
+                    policy_holder=self.policy_holder,
+                )
+                for policy, insuree in self.policies
+            ],
+            batch_size=BULK_BATCH_SIZE,
+        )
+
+
 class ContractContributionPlanDetails(object):
     def __init__(self, user, contract=None):
         self.user = user
@@ -1251,66 +1338,97 @@ class ContractContributionPlanDetails(object):
         print(
             f"---------------------------ContractContributionPlanDetails ccpd: {ccpd}"
         )
-        # get the relevant policy from the related product of contribution plan
-        # policy objects get all related to this product
-        insuree = Insuree.objects.filter(id=insuree_id).first()
-        # @TODO : remove policies
-        policies = self.__get_policy(
-            insuree=insuree,
-            date_valid_from=ccpd.date_valid_from,
-            date_valid_to=ccpd.date_valid_to,
-            product=ccpd.contribution_plan.benefit_plan,
-            ccpd=ccpd,
-        )
-        return self.__create_contribution_from_policy(ccpd, policies)
+        return [self.create_ccpds([(ccpd, insuree_id)])[0][0]]
 
-    def __create_contribution_from_policy(self, ccpd, policies):
-        print(
-            f"---------------------------ContractContributionPlanDetails policies: {policies}"
+    def create_ccpds(self, ccpds):
+        """
+        Batch version of create_ccpd for all the CCPDs of a contract.
+        `ccpds` is a list of (ccpd, insuree_id). The policy windows are computed in
+        memory once per product, the new Policy and ContractPolicy rows are inserted
+        with bulk_create and the CCPDs are then created with their policy.
+        Returns the list of (ccpd, policies) in the order of `ccpds`.
+        """
+        if not ccpds:
+            return []
+        ccpds = [(ccpd, int(insuree_id)) for ccpd, insuree_id in ccpds]
+        insurees = Insuree.objects.select_related("family").in_bulk(
+            {insuree_id for _, insuree_id in ccpds}
+        )
+        contract_details = ContractDetailsModel.objects.select_related(
+            "contract__policy_holder"
+        ).in_bulk({ccpd.contract_details_id for ccpd, _ in ccpds})
+        for ccpd, _ in ccpds:
+            ccpd.contract_details = contract_details[
+                uuid.UUID(str(ccpd.contract_details_id))
+            ]
+        family_ids = {
+            insuree.family_id for insuree in insurees.values() if insuree.family_id
+        }
+        coverage_index = _PolicyCoverageIndex(
+            insurees=list(insurees.values()),
+            products={ccpd.contribution_plan.benefit_plan for ccpd, _ in ccpds},
+            date_valid_from=min(_as_date(ccpd.date_valid_from) for ccpd, _ in ccpds),
+            date_valid_to=max(_as_date(ccpd.date_valid_to) for ccpd, _ in ccpds),
         )
+        policy_generator = _PolicyGenerator(
+            contract=self.contract["contract"],
+            families_with_policy=set(
+                Policy.objects.filter(family_id__in=family_ids)
+                .values_list("family_id", flat=True)
+                .distinct()
+            ),
+        )
+
+        results = []
+        for ccpd, insuree_id in ccpds:
+            insuree = insurees[insuree_id]
+            policies = self.__get_policy(
+                insuree=insuree,
+                date_valid_from=ccpd.date_valid_from,
+                date_valid_to=ccpd.date_valid_to,
+                product=ccpd.contribution_plan.benefit_plan,
+                ccpd=ccpd,
+                policy_generator=policy_generator,
+                coverage_index=coverage_index,
+            )
+            if not policies:
+                raise Exception(
+                    f"No policy covers contract details {ccpd.contract_details_id}"
+                )
+            results.append((ccpd, policies))
 
-        if policies:
+        policy_generator.save()
+        for ccpd, policies in results:
             ccpd.policy = policies[0]
-            ccpd.save(username=self.user.username)
-            return [ccpd]
-        # if len(policies) == 1:
-        #     ccpd.policy = policies[0]
-        #     ccpd.save(username=self.user.username)
-        #     return [ccpd]
-        # else:
-        #     # create second ccpd because another policy was created - copy object and save
-        #     ccpd_new = copy(ccpd)
-        #     ccpd_new.date_valid_from = ccpd.date_valid_from
-        #     ccpd_new.date_valid_to = policies[0].expiry_date
-        #     ccpd_new.policy = policies[0]
-        #     ccpd.date_valid_from = policies[0].expiry_date
-        #     ccpd.date_valid_to = ccpd.date_valid_to
-        #     ccpd.policy = policies[1]
-        #     ccpd_new.save(username=self.user.username)
-        #     ccpd.save(username=self.user.username)
-        #     return [ccpd_new, ccpd]
-
-    def __get_policy(self, insuree, date_valid_from, date_valid_to, product, ccpd):
+        bulk_create_history_objects(
+            ContractContributionPlanDetailsModel,
+            [ccpd for ccpd, _ in results],
+            self.user.username,
+        )
+        logger.info(
+            f"create_ccpds : {len(results)} ccpd, {len(policy_generator.policies)} policies created"
+        )
+        return results
+
+    def __get_policy(
+        self,
+        insuree,
+        date_valid_from,
+        date_valid_to,
+        product,
+        ccpd,
+        policy_generator,
+        coverage_index,
+    ):
         logger.info(f"__get_policy : date_valid_from : {date_valid_from}")
         logger.info(f"__get_policy : date_valid_to : {date_valid_to}")
-        print(
-            f"------------------------ ContractContributionPlanDetails : get_policy : date_valid_from : {date_valid_from}"
-        )
-        from core import datetime
 
         policy_output = []
-        # get all policies related to the product and insuree
-        policies = (
-            Policy.objects.filter(product=product)
-            .filter(family__head_insuree=insuree)
-            .filter(start_date__lte=date_valid_to, expiry_date__gte=date_valid_from)
+        # get all policies related to the product and insuree, including the ones
+        # generated earlier for this contract
+        policies_covered = coverage_index.covering(
+            insuree, product, date_valid_from, date_valid_to
         )
-        # get covered policy, use count to run a COUNT query
-        if policies.count() > 0:
-            policies_covered = list(policies.order_by("start_date"))
-        else:
-            policies_covered = []
-        missing_coverage = []
         # make sure the policies covers the contract :
         last_date_covered = date_valid_from
         # get the start date of the new contract by updating last_date_covered to the policy.stop_date
@@ -1327,30 +1445,18 @@ class ContractContributionPlanDetails(object):
                 # last_date_covered = cur_policy.expiry_date #commented by ajay for new requirement
                 policy_output.append(cur_policy)
 
-        for data in missing_coverage:
-            print(
-                f"----------------------- missing_coverage {missing_coverage}")
-            logger.info(f"__get_policy : data['start'] : {data['start']}")
-            logger.info(f"__get_policy : data['stop'] : {data['stop']}")
-            policy_created, last_date_covered = self.create_contract_details_policies(
-                insuree, product, data["start"], data["stop"], ccpd
-            )
-            if policy_created is not None and len(policy_created) > 0:
-                policy_output += policy_created
-
         # now we create new policy
         # @Note: Code commented temporary for CAMU Requirement
         while last_date_covered < date_valid_to:
-            print(
-                f"----------------------- last_date_covered {last_date_covered}")
-            print(f"----------------------- date_valid_to {date_valid_to}")
             logger.info(
                 f"__get_policy : last_date_covered : {last_date_covered}")
             logger.info(f"__get_policy : date_valid_to : {date_valid_to}")
-            policy_created, last_date_covered = self.create_contract_details_policies(
-                insuree, product, last_date_covered, date_valid_to, ccpd
+            policy_created, last_date_covered = policy_generator.generate(
+                insuree, product, last_date_covered, date_valid_to
             )
             if policy_created is not None and len(policy_created) > 0:
+                for policy in policy_created:
+                    coverage_index.add(insuree, policy)
                 policy_output += policy_created
         return policy_output
 
@@ -1361,256 +1467,22 @@ class ContractContributionPlanDetails(object):
         # TODO Policy with status - new open=32 in policy-be_py module
         logger.info(
             "create_contract_details_policies : --------- Start ---------")
-        policy_output = []
-        print(
-            f"------------------------ ContractContributionPlanDetails : create_contract_details_policies : last_date_covered : {last_date_covered}"
-        )
-
-        # Get the contract
-        policy_holder = ccpd.contract_details.contract.policy_holder
-        has_other_contracts = policy_holder.contract_set.exclude(
-            id=ccpd.contract_details.contract.id
-        ).exists()
-
-        logger.info(
-            f"create_contract_details_policies : product.insurance_period : {product.insurance_period}"
+        policy_generator = _PolicyGenerator(
+            contract=self.contract["contract"],
+            families_with_policy=set(
+                Policy.objects.filter(family=insuree.family).values_list(
+                    "family_id", flat=True
+                )[:1]
+            ),
         )
-        logger.info(
-            f"create_contract_details_policies : contract.parent : {ccpd.contract_details.contract.parent}"
+        policy_output, last_date_covered = policy_generator.generate(
+            insuree, product, last_date_covered, date_valid_to
         )
-        logger.info(
-            f"create_contract_details_policies : BU : last_date_covered : {last_date_covered}"
-        )
-
-        print("product.insurance_period : ", product.insurance_period)
-        print("contract.parent : ", ccpd.contract_details.contract.parent)
-        print("BU : last_date_covered : ", last_date_covered)
-
-        while last_date_covered < date_valid_to:
-            expiry_date = last_date_covered + relativedelta(
-                months=product.insurance_period
-            )
-            product_config = product.config_data
-            # Changing start date and end date of policy with insurance period 1 as per CAMU Requirement
-            if product.insurance_period == 1:
-                # desired_start_policy_day is a policy start day in month
-                desired_start_policy_day = 6
-                if product_config:
-                    last_date_to_create_payment = product_config.get(
-                        "PaymentEndDate", None
-                    )
-                    if last_date_to_create_payment:
-                        last_date_to_create_payment = datetime.strptime(
-                            last_date_to_create_payment, "%Y-%m-%d"
-                        ).date()
-                        last_date_day_to_create_payment = (
-                            last_date_to_create_payment.day
-                        )
-                        desired_start_policy_day = last_date_day_to_create_payment + 1
-
-                # desired_month_gap_policy_contract is a gap of policy from contract
-                # desired_month_gap_policy_contract = 2
-                desired_month_gap_policy_contract = 1
-                # if product.policy_waiting_period:
-                #     desired_month_gap_policy_contract = product.policy_waiting_period
-
-                # last_date_covered is the policy Start date
-                last_date_covered = last_date_covered.replace(
-                    day=desired_start_policy_day
-                )
-                last_date_covered = last_date_covered + relativedelta(
-                    months=desired_month_gap_policy_contract
-                )
-
-                # expiry_date is the policy End date
-                expiry_date = last_date_covered + relativedelta(
-                    months=product.insurance_period
-                )
-                expiry_date = expiry_date.replace(
-                    day=desired_start_policy_day - 1)
-
-            # Changing start date and end date of policy with insurance period 3 as per CAMU Requirement
-            if product.insurance_period == 3:
-                # desired_start_policy_day is a policy start day in month
-                desired_start_policy_day = 6
-                if product_config:
-                    last_date_to_create_payment = product_config.get(
-                        "PaymentEndDate", None
-                    )
-                    if last_date_to_create_payment:
-                        last_date_to_create_payment = datetime.strptime(
-                            last_date_to_create_payment, "%Y-%m-%d"
-                        ).date()
-                        last_date_day_to_create_payment = (
-                            last_date_to_create_payment.day
-                        )
-                        desired_start_policy_day = last_date_day_to_create_payment + 1
-                if ccpd.contract_details.contract.parent:
-                    # desired_month_gap_policy_contract is a gap of policy from contract
-                    desired_month_gap_policy_contract = 1
-                    # if product.policy_waiting_period:
-                    #     desired_month_gap_policy_contract = product.policy_waiting_period
-
-                    # last_date_covered is the policy Start date
-                    last_date_covered = last_date_covered.replace(
-                        day=desired_start_policy_day
-                    )
-                    last_date_covered = last_date_covered + relativedelta(
-                        months=desired_month_gap_policy_contract
-                    )
-
-                    # expiry_date is the policy End date
-                    expiry_date = last_date_covered + relativedelta(
-                        months=product.insurance_period + 1
-                    )
-                    expiry_date = expiry_date.replace(
-                        day=desired_start_policy_day - 1)
-                else:
-                    # desired_month_gap_policy_contract is a gap of policy from contract
-                    desired_month_gap_policy_contract = 3
-                    if product.policy_waiting_period:
-                        desired_month_gap_policy_contract = (
-                            product.policy_waiting_period
-                        )
-
-                    # last_date_covered is the policy Start date
-                    last_date_covered = last_date_covered.replace(
-                        day=desired_start_policy_day
-                    )
-                    last_date_covered = last_date_covered + relativedelta(
-                        months=desired_month_gap_policy_contract
-                    )
-
-                    # expiry_date is the policy End date
-                    expiry_date = last_date_covered + relativedelta(
-                        months=product.insurance_period
-                    )
-                    expiry_date = expiry_date.replace(
-                        day=desired_start_policy_day - 1)
-
-            if product.insurance_period == 12:
-                desired_start_policy_day = 6
-                if product_config:
-                    last_date_to_create_payment = product_config.get(
-                        "PaymentEndDate", None
-                    )
-                    if last_date_to_create_payment:
-                        last_date_to_create_payment = datetime.strptime(
-                            last_date_to_create_payment, "%Y-%m-%d"
-                        ).date()
-                        last_date_day_to_create_payment = (
-                            last_date_to_create_payment.day
-                        )
-                        desired_start_policy_day = last_date_day_to_create_payment + 1
-
-                desired_month_gap_policy_contract = 4
-                if product.policy_waiting_period:
-                    desired_month_gap_policy_contract = product.policy_waiting_period
-
-                print("desired_start_policy_day : ", desired_start_policy_day)
-                # last_date_covered is the policy Start date
-
-                # last_date_covered = last_date_covered.replace(
-                # day=desired_start_policy_day)
-                # last_date_covered = last_date_covered + relativedelta(
-                # months=desired_month_gap_policy_contract)
-
-                # last_date_covered = last_date_covered.replace(
-                # day=desired_start_policy_day)
-                last_date_covered = last_date_covered + relativedelta(
-                    months=desired_month_gap_policy_contract
-                )
-
-                if has_other_contracts:
-                    months_to_substract = desired_month_gap_policy_contract - 6
-                    last_date_covered = last_date_covered + relativedelta(
-                        months=months_to_substract
-                    )
-
-                last_date_covered = last_date_covered.replace(
-                    day=desired_start_policy_day
-                )
-                print("last_date_covered : ", last_date_covered)
-                # expiry_date is the policy End date
-
-                expiry_date = last_date_covered + relativedelta(
-                    months=product.insurance_period
-                )
-
-                # if the contract is the 1st one it should take 12 months - 3
-                # if the contract has parent then it should take 12 months \
-                # to substract
-                # if has_other_contracts:
-                #     # months_to_substract = product.insurance_period - 3
-                #     expiry_date = last_date_covered + relativedelta(
-                # months=months_to_substract)
-
-                expiry_date = expiry_date.replace(
-                    day=desired_start_policy_day - 1)
-
-                last_date_covered = self.__handle_twelve_month_first_policy(
-                    insuree, last_date_covered
-                )
-
-                print("=======>last_date_covered : ", last_date_covered)
-                print("=======>expiry_date : ", expiry_date)
-
-            logger.info(
-                f"create_contract_details_policies : AU : last_date_covered : {last_date_covered}"
-            )
-            logger.info(
-                f"create_contract_details_policies : expiry_date : {expiry_date}"
-            )
-
-            print("AU : last_date_covered : ", last_date_covered)
-            print("expiry_date : ", expiry_date)
-
-            # policy_status = self._get_policy_status(insuree, policy_holder)
-
-            # logger.info(f"=====> create_contract_details_policies : policy_status : {policy_status}")
-
-            cur_policy = Policy.objects.create(
-                **{
-                    "family": insuree.family,
-                    "is_valid": False,
-                    "product": product,
-                    "status": Policy.STATUS_LOCKED,
-                    "stage": Policy.STAGE_NEW,
-                    "enroll_date": last_date_covered,
-                    "start_date": last_date_covered,
-                    "validity_from": last_date_covered,
-                    "effective_date": last_date_covered,
-                    "expiry_date": expiry_date,
-                    "validity_to": None,
-                    "audit_user_id": -1,
-                }
-            )
-            last_date_covered = expiry_date
-            policy_output.append(cur_policy)
-
-            logger.info(f"=======++++++++++++ self.contract {self.contract}")
-
-            ContractPolicy.objects.create(
-                contract=self.contract["contract"],
-                policy=cur_policy,
-                insuree=insuree,
-                policy_holder=policy_holder,
-            )
-
+        policy_generator.save()
         logger.info(
             "create_contract_details_policies : --------- End ---------")
         return policy_output, last_date_covered
 
-    def __handle_twelve_month_first_policy(self, insuree, last_date_covered):
-        check_already_insuree_policy = Policy.objects.filter(
-            family=insuree.family
-        ).first()
-
-        if check_already_insuree_policy:
-            return last_date_covered
-
-        return last_date_covered + relativedelta(months=3)
-
     @check_authentication
     def contract_valuation(self, contract_contribution_plan_details):
         try:
@@ -1622,17 +1494,16 @@ class ContractContributionPlanDetails(object):
             ccpd_list = []
             total_amount = 0
             amendment = 0
+            valuation_engine = ValuationEngine(self.user)
+            ccpds_to_create = []
             for contract_details in contract_contribution_plan_details[
                 "contract_details"
             ]:
                 logger.info(
                     f"contract_valuation : contract_details : {contract_details}"
                 )
-                cpbd_list = ContributionPlanBundleDetails.objects.filter(
-                    contribution_plan_bundle__id=str(
-                        contract_details["contribution_plan_bundle"]
-                    ),
-                    is_deleted=False,
+                cpbd_list = valuation_engine.bundle_details(
+                    contract_details["contribution_plan_bundle"]
                 )
                 logger.info(f"contract_valuation : cpbd_list : {cpbd_list}")
                 amendment = contract_details["amendment"]
@@ -1670,7 +1541,7 @@ class ContractContributionPlanDetails(object):
                     print("-------------------- self.user DATA ----------------------")
                     print(self.user)
                     print("-------------------- self.user DATA ----------------------")
-                    rc = run_calculation_rules(ccpd, "create", self.user)
+                    rc = valuation_engine.run(ccpd, contract_details, "create")
                     print(
                         f"------------------------ ContractContributionPlanDetails : rc: {rc}"
                     )
@@ -1695,22 +1566,29 @@ class ContractContributionPlanDetails(object):
                     print(
                         f"***------------------ contract_details {contract_details}")
                     if contract_contribution_plan_details["save"]:
-                        ccpd_list, total_amount, ccpd_record = (
-                            self.__append_contract_cpd_to_list(
-                                ccpd=ccpd,
-                                cp=cpbd.contribution_plan,
-                                date_valid_from=contract_details[
-                                    "contract_date_valid_from"
-                                ],
-                                insuree_id=contract_details["insuree_id"],
-                                total_amount=total_amount,
-                                calculated_amount=calculated_amount,
-                                ccpd_list=ccpd_list,
-                                ccpd_record=ccpd_record,
-                            )
+                        ccpd.contribution_plan = cpbd.contribution_plan
+                        self.__set_ccpd_validity(
+                            ccpd=ccpd,
+                            date_valid_from=contract_details[
+                                "contract_date_valid_from"
+                            ],
                         )
-                    if "id" not in ccpd_record:
+                        ccpds_to_create.append(
+                            (ccpd, contract_details["insuree_id"], calculated_amount)
+                        )
+                    else:
                         ccpd_list.append(ccpd_record)
+            if ccpds_to_create:
+                # policies, contract policies and ccpd are created for the whole contract at once
+                created = self.create_ccpds(
+                    [(ccpd, insuree_id) for ccpd, insuree_id, _ in ccpds_to_create]
+                )
+                for (ccpd, _), (_, _, calculated_amount) in zip(created, ccpds_to_create):
+                    ccpd_record = model_to_dict(ccpd)
+                    ccpd_record["calculated_amount"] = calculated_amount
+                    uuid_string = f"{ccpd.id}"
+                    ccpd_record["id"], ccpd_record["uuid"] = (uuid_string, uuid_string)
+                    ccpd_list.append(ccpd_record)
             if amendment > 0:
                 amendment = float(amendment)
                 # get the payment from the previous version of the contract
@@ -1741,6 +1619,9 @@ class ContractContributionPlanDetails(object):
                 total_amount = float(total_amount) - float(received_amount)
             dict_representation["total_amount"] = total_amount
             dict_representation["contribution_plan_details"] = ccpd_list
+            logger.info(
+                f"contract_valuation : {valuation_engine.rule_invocations} calculation rule invocations"
+            )
             logger.info(f"contract_valuation : total_amount : {total_amount}")
             logger.info(f"contract_valuation : ccpd_list : {ccpd_list}")
             logger.info("contract_valuation : --------- End ---------")
@@ -1752,123 +1633,16 @@ class ContractContributionPlanDetails(object):
                 exception=exc,
             )
 
-    def __append_contract_cpd_to_list(
-        self,
-        ccpd,
-        cp,
-        date_valid_from,
-        insuree_id,
-        total_amount,
-        calculated_amount,
-        ccpd_list,
-        ccpd_record,
-    ):
-        """helper private function to gather results to the list
-        ccpd - contract contribution plan details
-        cp - contribution plan
-        return ccpd list and total amount
-        """
-        print(
-            f"------------------------ ContractContributionPlanDetails : __append_contract_cpd_to_list : ccpd : {ccpd}"
-        )
-        print(
-            f"------------------------ ContractContributionPlanDetails : __append_contract_cpd_to_list : cp : {cp}"
-        )
-        print(
-            f"------------------------ ContractContributionPlanDetails : __append_contract_cpd_to_list : date_valid_from : {date_valid_from}"
-        )
-        print(
-            f"------------------------ ContractContributionPlanDetails : __append_contract_cpd_to_list : insuree_id : {insuree_id}"
-        )
-        print(
-            f"------------------------ ContractContributionPlanDetails : __append_contract_cpd_to_list : total_amount : {total_amount}"
-        )
-        print(
-            f"------------------------ ContractContributionPlanDetails : __append_contract_cpd_to_list : calculated_amount : {calculated_amount}"
-        )
-        logger.info("__append_contract_cpd_to_list : --------- Start ---------")
-        from core import datetime, datetimedelta
-
+    def __set_ccpd_validity(self, ccpd, date_valid_from):
         # TODO - catch grace period from calculation rule if is defined
         #  grace_period = cp.calculation_rule etc
         #  length = cp.get_contribution_length(grace_period)
-        length = cp.get_contribution_length()
         ccpd.date_valid_from = date_valid_from
-
         # get the last day of the month data_valid_from and transform it to date_valid_to eg if data_valid_from is 01 feb 2025 then date_valid_to should be 28 feb 2025
         last_day = calendar.monthrange(
             date_valid_from.year, date_valid_from.month)[1]
         ccpd.date_valid_to = date_valid_from.replace(day=last_day)
-        # ccpd.date_valid_to = date_valid_from + datetimedelta(months=length)
         # TODO: calculate the number of CCPD to create in order to cover the contract length
-        ccpd_results = self.create_ccpd(ccpd, insuree_id)
-        ccpd_record = model_to_dict(ccpd)
-        ccpd_record["calculated_amount"] = calculated_amount
-        # TODO: support more that 2 CCPD
-        # case 1 - single contribution
-        if len(ccpd_results) == 1:
-            uuid_string = f"{ccpd_results[0].id}"
-            ccpd_record["id"], ccpd_record["uuid"] = (uuid_string, uuid_string)
-            ccpd_list.append(ccpd_record)
-        # case 2 - 2 contributions with 2 policies
-        else:
-            # there is additional contribution - we have to calculate/recalculate
-            total_amount = float(total_amount) - float(calculated_amount)
-            logger.info(
-                f"__append_contract_cpd_to_list : total_amount = {total_amount}"
-            )
-            for ccpd_result in ccpd_results:
-                logger.info(
-                    f"__append_contract_cpd_to_list : ccpd_result = {ccpd_result}"
-                )
-                length_ccpd = float(
-                    (ccpd_result.date_valid_to.year -
-                     ccpd_result.date_valid_from.year)
-                    * 12
-                    + (
-                        ccpd_result.date_valid_to.month
-                        - ccpd_result.date_valid_from.month
-                    )
-                )
-                logger.info(
-                    f"__append_contract_cpd_to_list : length_ccpd = {length_ccpd}"
-                )
-                periodicity = float(ccpd_result.contribution_plan.periodicity)
-                logger.info(
-                    f"__append_contract_cpd_to_list : periodicity = {periodicity}"
-                )
-                # time part of split as a fraction to count contribution value for that split period properly
-                part_time_period = length_ccpd / periodicity
-                logger.info(
-                    f"__append_contract_cpd_to_list : part_time_period = {part_time_period}"
-                )
-                # rc - result calculation
-                rc = run_calculation_rules(ccpd, "update", self.user)
-                if rc:
-                    logger.info(
-                        f"__append_contract_cpd_to_list : run_calculation_rules = {rc}"
-                    )
-                    calculated_amount = (
-                        float(rc[0][1]) * float(part_time_period)
-                        if rc[0][1] not in [None, False]
-                        else 0
-                    )
-                    total_amount = float(total_amount)
-                    total_amount += calculated_amount
-                    logger.info(
-                        f"__append_contract_cpd_to_list : for calculated_amount = {calculated_amount}"
-                    )
-                    logger.info(
-                        f"__append_contract_cpd_to_list : for total_amount = {total_amount}"
-                    )
-                ccpd_record = model_to_dict(ccpd_result)
-                ccpd_record["calculated_amount"] = calculated_amount
-                uuid_string = f"{ccpd_result.id}"
-                ccpd_record["id"], ccpd_record["uuid"] = (
-                    uuid_string, uuid_string)
-                ccpd_list.append(ccpd_record)
-        logger.info("__append_contract_cpd_to_list : --------- End ---------")
-        return ccpd_list, total_amount, ccpd_record
 
     @check_authentication
     def create_contribution(self, contract_contribution_plan_details):
@@ -1877,35 +1651,13 @@ class ContractContributionPlanDetails(object):
                 f"------------------------ ContractContributionPlanDetails : create_contribution : contract_contribution_plan_details : {contract_contribution_plan_details}"
             )
             dict_representation = {}
-            contribution_list = []
-            from core import datetime
-
-            now = datetime.datetime.now()
-            for ccpd in contract_contribution_plan_details["contribution_plan_details"]:
-                contract_details = ContractDetailsModel.objects.get(
-                    id=f"{ccpd['contract_details']}"
-                )
-                # create the contributions based on the ContractContributionPlanDetails
-                if ccpd["contribution"] is None:
-                    contribution = Premium.objects.create(
-                        **{
-                            "policy_id": ccpd["policy"],
-                            "amount": ccpd["calculated_amount"],
-                            "audit_user_id": -1,
-                            "pay_date": now,
-                            # TODO Temporary value pay_type - I have to get to know about this field what should be here
-                            #  also ask about audit_user_id and pay_date value
-                            "pay_type": " ",
-                        }
-                    )
-                    ccpd_object = ContractContributionPlanDetailsModel.objects.get(
-                        id=ccpd["id"]
-                    )
-                    ccpd_object.contribution = contribution
-                    ccpd_object.save(username=self.user.username)
-                    contribution_record = model_to_dict(contribution)
-                    contribution_list.append(contribution_record)
-                    dict_representation["contributions"] = contribution_list
+            contributions = self.__create_contributions(
+                contract_contribution_plan_details["contribution_plan_details"]
+            )
+            if contributions:
+                dict_representation["contributions"] = [
+                    model_to_dict(contribution) for contribution in contributions
+                ]
             return _output_result_success(dict_representation=dict_representation)
         except Exception as exc:
             return _output_exception(
@@ -1914,6 +1666,207 @@ class ContractContributionPlanDetails(object):
                 exception=exc,
             )
 
+    def __create_contributions(self, ccpd_records):
+        """
+        Create the premiums of the CCPD records without contribution with one
+        bulk insert and link them to their CCPDs with one bulk update (plus
+        history), so the number of queries doesn't depend on the contract size.
+        Returns the created premiums in the order of the records.
+        """
+        from core import datetime
+
+        now = datetime.datetime.now()
+        ccpd_records = list(ccpd_records)
+        contract_details_ids = {f"{ccpd['contract_details']}" for ccpd in ccpd_records}
+        existing_contract_details = {
+            f"{contract_details_id}"
+            for contract_details_id in ContractDetailsModel.objects.filter(
+                id__in=contract_details_ids
+            ).values_list("id", flat=True)
+        }
+        if contract_details_ids - existing_contract_details:
+            raise ContractDetailsModel.DoesNotExist(
+                f"ContractDetails matching query does not exist: {contract_details_ids - existing_contract_details}"
+            )
+        # create the contributions based on the ContractContributionPlanDetails
+        ccpd_records = [ccpd for ccpd in ccpd_records if ccpd["contribution"] is None]
+        if not ccpd_records:
+            return []
+        ccpd_objects = ContractContributionPlanDetailsModel.objects.in_bulk(
+            [ccpd["id"] for ccpd in ccpd_records]
+        )
+        contributions = [
+            Premium(
+                **{
+                    "policy_id": ccpd["policy"],
+                    "amount": ccpd["calculated_amount"],
+                    "audit_user_id": -1,
+                    "pay_date": now,
+                    # TODO Temporary value pay_type - I have to get to know about this field what should be here
+                    #  also ask about audit_user_id and pay_date value
+                    "pay_type": " ",
+                }
+            )
+            for ccpd in ccpd_records
+        ]
+        Premium.objects.bulk_create(contributions, batch_size=BULK_BATCH_SIZE)
+        ccpds_to_update = []
+        for ccpd, contribution in zip(ccpd_records, contributions):
+            ccpd_object = ccpd_objects[uuid.UUID(f"{ccpd['id']}")]
+            ccpd_object.contribution = contribution
+            ccpds_to_update.append(ccpd_object)
+        bulk_update_history_objects(
+            ContractContributionPlanDetailsModel,
+            ccpds_to_update,
+            ["contribution"],
+            self.user.username,
+        )
+        logger.info(
+            f"create_contribution : {len(contributions)} contributions created"
+        )
+        return contributions
+
+
+def set_waiting_period_for_insurees(insuree_ids, policy_holder_id):
+    """
+    Set-based counterpart of policyholder's get_and_set_waiting_period_for_insuree:
+    creates the missing InsureeWaitingPeriod rows of the policy holder contribution
+    plan for all the given insurees and aligns the contribution periodicity of the
+    existing ones, with a constant number of queries whatever the number of insurees.
+    """
+    from policyholder.models import PolicyHolderContributionPlan
+
+    from contract.models import InsureeWaitingPeriod
+
+    insuree_ids = set(insuree_ids)
+    if not insuree_ids:
+        return {"created": 0, "updated": 0}
+
+    policy_holder_contribution_plan = (
+        PolicyHolderContributionPlan.objects.filter(
+            policy_holder_id=policy_holder_id, is_deleted=False
+        )
+        .select_related("contribution_plan_bundle")
+        .first()
+    )
+    if not policy_holder_contribution_plan:
+        logger.info(
+            f"set_waiting_period_for_insurees : no contribution plan for policy holder {policy_holder_id}"
+        )
+        return {"created": 0, "updated": 0}
+
+    contribution_plan_bundle = policy_holder_contribution_plan.contribution_plan_bundle
+    periodicity = contribution_plan_bundle.periodicity
+    bundle_details = (
+        ContributionPlanBundleDetails.objects.filter(
+            contribution_plan_bundle=contribution_plan_bundle, is_deleted=False
+        )
+        .select_related("contribution_plan__benefit_plan")
+        .first()
+    )
+    waiting_period = 0
+    if bundle_details and bundle_details.contribution_plan.benefit_plan.policy_waiting_period:
+        waiting_period = bundle_details.contribution_plan.benefit_plan.policy_waiting_period
+    if periodicity == 12:
+        waiting_period = 0
+
+    existing = {
+        insuree_waiting_period.insuree_id: insuree_waiting_period
+        for insuree_waiting_period in InsureeWaitingPeriod.objects.filter(
+            policy_holder_contribution_plan=policy_holder_contribution_plan,
+            insuree_id__in=insuree_ids,
+        )
+    }
+    to_create = [
+        InsureeWaitingPeriod(
+            id=uuid.uuid4(),
+            policy_holder_contribution_plan=policy_holder_contribution_plan,
+            insuree_id=insuree_id,
+            waiting_period=waiting_period,
+            contribution_periodicity=periodicity,
+        )
+        for insuree_id in insuree_ids
+        if insuree_id not in existing
+    ]
+    to_update = []
+    for insuree_waiting_period in existing.values():
+        if insuree_waiting_period.contribution_periodicity != periodicity:
+            insuree_waiting_period.contribution_periodicity = periodicity
+            to_update.append(insuree_waiting_period)
+
+    InsureeWaitingPeriod.objects.bulk_create(
+        to_create, batch_size=BULK_BATCH_SIZE, ignore_conflicts=True
+    )
+    InsureeWaitingPeriod.objects.bulk_update(
+        to_update, ["contribution_periodicity"], batch_size=BULK_BATCH_SIZE
+    )
+    logger.info(
+        f"set_waiting_period_for_insurees : policy holder {policy_holder_id} : "
+        f"{len(to_create)} created, {len(to_update)} updated"
+    )
+    return {"created": len(to_create), "updated": len(to_update)}
+
+
+def terminate_expired_contracts(username, batch_size=BULK_BATCH_SIZE, dry_run=False):
+    """
+    Terminate the effective contracts whose validity has ended. The contracts are
+    selected with the (state, date_valid_to) index and walked by id in batches;
+    every batch is written with one bulk update and one bulk history insert.
+    With dry_run, only the number of contracts to terminate is computed.
+    Returns the number of contracts (to be) terminated and the elapsed time.
+    """
+    from core import datetime
+    from core.models import User
+
+    user = User.objects.filter(username=username).first()
+    if user is None:
+        raise ValueError(
+            f"terminate_expired_contracts : user '{username}' does not exist, "
+            f"set terminate_contracts_username in the contract module configuration"
+        )
+    start = time.perf_counter()
+    now = datetime.datetime.now()
+    expired_contracts = ContractModel.objects.filter(
+        state=ContractModel.STATE_EFFECTIVE, date_valid_to__lt=now
+    )
+    if dry_run:
+        terminated = expired_contracts.count()
+    else:
+        terminated = 0
+        last_id = None
+        while True:
+            batch = expired_contracts.order_by("id")
+            if last_id is not None:
+                batch = batch.filter(id__gt=last_id)
+            batch = list(batch[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            with transaction.atomic():
+                for contract in batch:
+                    # we can marked that contract as a terminated
+                    contract.state = ContractModel.STATE_TERMINATED
+                    contract.effective_amount = contract.amount
+                    contract.json_ext = _save_json_external(
+                        user_id=str(user.id),
+                        datetime=str(now),
+                        message=f"contract terminated - state {contract.state}",
+                    )
+                bulk_update_history_objects(
+                    ContractModel,
+                    batch,
+                    ["state", "effective_amount", "json_ext"],
+                    username,
+                    batch_size=batch_size,
+                )
+            terminated += len(batch)
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"terminate_expired_contracts : {terminated} contracts "
+        f"{'to terminate' if dry_run else 'terminated'} in {elapsed:.2f}s"
+    )
+    return {"terminated": terminated, "dry_run": dry_run, "elapsed": elapsed}
+
 
 # This function is used in payment module
 def get_policy_status(insuree, policy_holder):
@@ -2019,9 +1972,9 @@ class PaymentService(object):
             dict_representation["id"], dict_representation["uuid"] = (
                 p.id, p.uuid)
             if payment_details:
-                for payment_detail in payment_details:
-                    pd = PaymentDetail.objects.create(
-                        payment=Payment.objects.get(id=p.id),
+                pds = [
+                    PaymentDetail(
+                        payment=p,
                         audit_user_id=-1,
                         validity_from=now,
                         product_code=payment_detail["product_code"],
@@ -2029,6 +1982,10 @@ class PaymentService(object):
                         expected_amount=payment_detail["expected_amount"],
                         premium=payment_detail["premium"],
                     )
+                    for payment_detail in payment_details
+                ]
+                PaymentDetail.objects.bulk_create(pds, batch_size=BULK_BATCH_SIZE)
+                for pd in pds:
                     pd_record = model_to_dict(pd)
                     pd_record["id"] = pd.id
                     payment_list.append(pd_record)
@@ -2042,29 +1999,66 @@ class PaymentService(object):
 
     @check_authentication
     def collect_payment_details(self, contract_contribution_plan_details):
+        """
+        Payment detail lines of the CCPD records. The product codes, the insuree
+        chf_ids and the premiums are resolved for the whole list with one query
+        each, whatever the number of records.
+        """
+        contract_contribution_plan_details = list(contract_contribution_plan_details)
+        product_codes = _values_by_id(
+            ContributionPlan.objects.filter(
+                id__in={
+                    f"{ccpd['contribution_plan']}"
+                    for ccpd in contract_contribution_plan_details
+                }
+            ).values_list("id", "benefit_plan__code")
+        )
+        insurance_numbers = _values_by_id(
+            ContractDetailsModel.objects.filter(
+                id__in={
+                    f"{ccpd['contract_details']}"
+                    for ccpd in contract_contribution_plan_details
+                }
+            ).values_list("id", "insuree__chf_id")
+        )
+        contributions = {
+            f"{ccpd_object.id}": ccpd_object.contribution
+            for ccpd_object in ContractContributionPlanDetailsModel.objects.filter(
+                id__in={f"{ccpd['id']}" for ccpd in contract_contribution_plan_details}
+            ).select_related("contribution")
+        }
         payment_details_data = []
         for ccpd in contract_contribution_plan_details:
-            product_code = ContributionPlan.objects.get(
-                id=ccpd["contribution_plan"]
-            ).benefit_plan.code
-            insurance_number = ContractDetailsModel.objects.get(
-                id=ccpd["contract_details"]
-            ).insuree.chf_id
-            contribution = ContractContributionPlanDetailsModel.objects.get(
-                id=ccpd["id"]
-            ).contribution
-            expected_amount = ccpd["calculated_amount"]
             payment_details_data.append(
                 {
-                    "product_code": product_code,
-                    "insurance_number": insurance_number,
-                    "expected_amount": expected_amount,
-                    "premium": contribution,
+                    "product_code": _get_by_id(
+                        product_codes, ccpd["contribution_plan"], ContributionPlan
+                    ),
+                    "insurance_number": _get_by_id(
+                        insurance_numbers, ccpd["contract_details"], ContractDetailsModel
+                    ),
+                    "expected_amount": ccpd["calculated_amount"],
+                    "premium": _get_by_id(
+                        contributions, ccpd["id"], ContractContributionPlanDetailsModel
+                    ),
                 }
             )
         return payment_details_data
 
 
+def _values_by_id(values_list):
+    return {f"{object_id}": value for object_id, value in values_list}
+
+
+def _get_by_id(values, object_id, model):
+    # same failure as the .get() of a missing object
+    if f"{object_id}" not in values:
+        raise model.DoesNotExist(
+            f"{model.__name__} matching query does not exist: {object_id}"
+        )
+    return values[f"{object_id}"]
+
+
 class ContractToInvoiceService(object):
     def __init__(self, user):
         self.user = user
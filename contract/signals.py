@@ -1,13 +1,14 @@
 from core.service_signals import ServiceSignalBindType
 from policy.models import Policy
-from .config import get_message_approved_contract
-from .email_report import generate_report_for_employee_declaration
 from .models import Contract, ContractContributionPlanDetails
+from .schedules import product_schedules, get_product_schedule
+from .approval import ApprovalPipeline, ApprovalStage
+from .notifications import enqueue_payment_notification
 from core.signals import Signal, register_service_signal, bind_service_signal
-from django.db.models import Q
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models import Count, Exists, Max, OuterRef, Q
+from django.db.models.signals import post_delete, post_save
 from django.conf import settings
-from django.core.mail import send_mail, BadHeaderError, EmailMessage
 from django.dispatch import receiver
 from insuree.apps import InsureeConfig
 from insuree.signals import signal_before_insuree_policy_query
@@ -18,11 +19,13 @@ from policy.signals import signal_check_formal_sector_for_policy
 from policyholder.apps import PolicyholderConfig
 from policyholder.models import PolicyHolderUser, PolicyHolderInsuree
 from insuree.models import InsureePolicy, Insuree, Family
+from location.models import Location
+from product.models import Product
 
 import logging
-import calendar
 
-from .views import multi_contract, send_contract
+from .utils import location_department_index
+from .views import multi_contract
 
 logger = logging.getLogger("openimis." + __name__)
 
@@ -51,20 +54,76 @@ def on_contract_approve_signal(sender, **kwargs):
     logger.info(
         "on_contract_approve_signal : --------------------- Start ---------------------"
     )
-    user = kwargs["user"]
+    from core import datetime
+
     contract_to_approve = kwargs["contract"]
-    contract_details_list = kwargs["contract_details_list"]
-    contract_service = kwargs["service_object"]
-    payment_service = kwargs["payment_service"]
-    ccpd_service = kwargs["ccpd_service"]
     logger.info(
         f"on_contract_approve_signal : contract_to_approve = {contract_to_approve}"
     )
+    context = {
+        "user": kwargs["user"],
+        "contract": contract_to_approve,
+        "contract_details_list": kwargs["contract_details_list"],
+        "contract_service": kwargs["service_object"],
+        "payment_service": kwargs["payment_service"],
+        "ccpd_service": kwargs["ccpd_service"],
+        "now": datetime.datetime.now(),
+    }
+    pipeline = get_contract_approval_pipeline(contract_to_approve)
+    pipeline.run(context)
+    logger.info(f"on_contract_approve_signal : stage timings = {pipeline.timings}")
+    logger.info(
+        f"on_contract_approve_signal : approved_contract = {contract_to_approve}"
+    )
+    logger.info(
+        "on_contract_approve_signal : --------------------- End ---------------------"
+    )
+    return contract_to_approve
+
+
+def get_contract_approval_pipeline(contract):
+    return ApprovalPipeline(
+        contract,
+        [
+            ApprovalStage(
+                "contributions",
+                __approve_create_contributions,
+                Contract.ProcessStatus.APPROVAL_CONTRIBUTIONS_CREATED,
+                fields=["amount_due"],
+            ),
+            ApprovalStage(
+                "penalty",
+                __approve_evaluate_penalty,
+                Contract.ProcessStatus.APPROVAL_PENALTY_EVALUATED,
+                fields=["penalty_raised", "penalty_raised_date"],
+            ),
+            ApprovalStage(
+                "payment",
+                __approve_create_payment,
+                Contract.ProcessStatus.APPROVAL_PAYMENT_CREATED,
+            ),
+            ApprovalStage(
+                "approve",
+                __approve_save_contract,
+                Contract.ProcessStatus.APPROVAL_CONTRACT_APPROVED,
+            ),
+            ApprovalStage(
+                "notify",
+                __approve_notify,
+                Contract.ProcessStatus.APPROVAL_NOTIFIED,
+            ),
+        ],
+    )
+
+
+def __approve_create_contributions(context):
+    contract_to_approve = context["contract"]
     # contract valuation
-    contract_contribution_plan_details = contract_service.evaluate_contract_valuation(
-        contract_details_result=contract_details_list, save=True
+    contract_contribution_plan_details = context[
+        "contract_service"
+    ].evaluate_contract_valuation(
+        contract_details_result=context["contract_details_list"], save=True
     )
-    # contract_to_approve.amount_due = contract_contribution_plan_details["total_amount"]
     amount_due = contract_contribution_plan_details["total_amount"]
     logger.info(f"on_contract_approve_signal : amount_due = {amount_due}")
     if isinstance(amount_due, str):
@@ -72,215 +131,168 @@ def on_contract_approve_signal(sender, **kwargs):
     rounded_amount = round(amount_due)
     contract_to_approve.amount_due = rounded_amount
     logger.info(f"on_contract_approve_signal : rounded_amount = {rounded_amount}")
-    result = ccpd_service.create_contribution(contract_contribution_plan_details)
+    context["ccpd_service"].create_contribution(contract_contribution_plan_details)
+    context["contract_contribution_plan_details"] = contract_contribution_plan_details
+
+
+def __approval_contribution_plan_details(context):
+    # when resuming, the ccpd records are rebuilt from the stored ccpd and premiums
+    if "contract_contribution_plan_details" not in context:
+        contract_to_approve = context["contract"]
+        ccpd_list = []
+        for ccpd in ContractContributionPlanDetails.objects.filter(
+            contract_details__contract__id=contract_to_approve.id, is_deleted=False
+        ).select_related("contribution"):
+            ccpd_list.append(
+                {
+                    "id": f"{ccpd.id}",
+                    "contract_details": f"{ccpd.contract_details_id}",
+                    "contribution_plan": f"{ccpd.contribution_plan_id}",
+                    "policy": ccpd.policy_id,
+                    "contribution": ccpd.contribution_id,
+                    "calculated_amount": (
+                        ccpd.contribution.amount if ccpd.contribution else 0
+                    ),
+                }
+            )
+        context["contract_contribution_plan_details"] = {
+            "total_amount": contract_to_approve.amount_due,
+            "contribution_plan_details": ccpd_list,
+        }
+    return context["contract_contribution_plan_details"]
+
+
+def __approval_product(context):
+    if "product" not in context:
+        ccpdm = (
+            ContractContributionPlanDetails.objects.filter(
+                contract_details__contract__id=context["contract"].id,
+                is_deleted=False,
+            )
+            .select_related("contribution_plan__benefit_plan")
+            .first()
+        )
+        context["product"] = ccpdm.contribution_plan.benefit_plan
+    return context["product"]
 
-    from core import datetime
 
-    now = datetime.datetime.now()
+def __approve_evaluate_penalty(context):
+    contract_to_approve = context["contract"]
     # check and add penalty of the contract
-    ccpdm = ContractContributionPlanDetails.objects.filter(
-        contract_details__contract__id=contract_to_approve.id, is_deleted=False
-    ).first()
-    product_config = ccpdm.contribution_plan.benefit_plan.config_data
-    logger.info(
-        f"on_contract_approve_signal : product_id = {ccpdm.contribution_plan.benefit_plan.id}"
-    )
+    product = __approval_product(context)
+    logger.info(f"on_contract_approve_signal : product_id = {product.id}")
+    logger.info(f"on_contract_approve_signal : product_config = {product.config_data}")
 
-    logger.info(
-        f"on_contract_approve_signal : product_config = {ccpdm.contribution_plan.benefit_plan.config_data}"
+    contract_create_date = contract_to_approve.date_created.date()
+    declaration_window = get_product_schedule(product).declaration_window(
+        contract_create_date
     )
+    if declaration_window:
+        start_date_to_create_contract, last_date_to_create_contract = declaration_window
+        contract_valid_from_date = contract_to_approve.date_valid_from.date()
+        is_future_contract = False
+        if contract_valid_from_date.year > contract_create_date.year:
+            print("is_future_contract  =  True")
+            is_future_contract = True
+        elif (
+            contract_valid_from_date.year == contract_create_date.year
+            and contract_valid_from_date.month > contract_create_date.month
+        ):
+            print("is_future_contract  =  True")
+            is_future_contract = True
 
-    if product_config:
-        start_date_to_create_contract = product_config.get("declarationStartDate", None)
-        last_date_to_create_contract = product_config.get("declarationEndDate", None)
-
-        if start_date_to_create_contract and last_date_to_create_contract:
-            start_date_to_create_contract = datetime.datetime.strptime(
-                start_date_to_create_contract, "%Y-%m-%d"
-            ).date()
-            last_date_to_create_contract = datetime.datetime.strptime(
-                last_date_to_create_contract, "%Y-%m-%d"
-            ).date()
-
-            start_date_day_to_create_contract = start_date_to_create_contract.day
-            last_date_day_to_create_contract = last_date_to_create_contract.day
-
-            contract_create_date = contract_to_approve.date_created.date()
-            contract_valid_from_date = contract_to_approve.date_valid_from.date()
-            is_future_contract = False
-            if contract_valid_from_date.year > contract_create_date.year:
-                print("is_future_contract  =  True")
-                is_future_contract = True
-            elif (
-                contract_valid_from_date.year == contract_create_date.year
-                and contract_valid_from_date.month > contract_create_date.month
-            ):
-                print("is_future_contract  =  True")
-                is_future_contract = True
-
-            contract_create_date_day = contract_create_date.day
-            contract_create_date_month = contract_create_date.month
-            contract_create_date_year = contract_create_date.year
+        logger.info(
+            f"on_contract_approve_signal : start_date_to_create_contract = {start_date_to_create_contract}"
+        )
+        logger.info(
+            f"on_contract_approve_signal : last_date_to_create_contract = {last_date_to_create_contract}"
+        )
+        logger.info(
+            f"on_contract_approve_signal : contract_create_date = {contract_create_date}"
+        )
 
+        if (
+            start_date_to_create_contract < contract_create_date
+            and contract_create_date > last_date_to_create_contract
+            and is_future_contract is False
+        ):
             logger.info(
-                f"on_contract_approve_signal : start_date_to_create_contract = {start_date_to_create_contract}"
-            )
-            logger.info(
-                f"on_contract_approve_signal : last_date_to_create_contract = {last_date_to_create_contract}"
-            )
-            logger.info(
-                f"on_contract_approve_signal : contract_create_date = {contract_create_date}"
+                "on_contract_approve_signal : contract penalty applied ---------------------"
             )
+            contract_to_approve.penalty_raised = True
+            contract_to_approve.penalty_raised_date = context["now"]
 
-            if (
-                start_date_day_to_create_contract < last_date_day_to_create_contract
-                and start_date_day_to_create_contract < contract_create_date_day
-                and contract_create_date_day < last_date_day_to_create_contract
-            ):
-                logger.info(
-                    "on_contract_approve_signal : date day condition 1 ---------------------"
-                )
-                start_date_to_create_contract = start_date_to_create_contract.replace(
-                    day=start_date_day_to_create_contract,
-                    month=contract_create_date_month,
-                    year=contract_create_date_year,
-                )
-                _, last_day = calendar.monthrange(
-                    start_date_to_create_contract.year,
-                    start_date_to_create_contract.month,
-                )
-                if last_date_day_to_create_contract > last_day:
-                    last_date_day_to_create_contract = last_day
-                last_date_to_create_contract = last_date_to_create_contract.replace(
-                    day=last_date_day_to_create_contract,
-                    month=contract_create_date_month,
-                    year=contract_create_date_year,
-                )
-            elif (
-                start_date_day_to_create_contract < last_date_day_to_create_contract
-                and start_date_day_to_create_contract > contract_create_date_day
-                and contract_create_date_day < last_date_day_to_create_contract
-            ):
-                logger.info(
-                    "on_contract_approve_signal : date day condition 2 ---------------------"
-                )
-                start_date_to_create_contract = start_date_to_create_contract.replace(
-                    day=start_date_day_to_create_contract,
-                    month=contract_create_date_month,
-                    year=contract_create_date_year,
-                )
-                _, last_day = calendar.monthrange(
-                    start_date_to_create_contract.year,
-                    start_date_to_create_contract.month,
-                )
-                if last_date_day_to_create_contract > last_day:
-                    last_date_day_to_create_contract = last_day
-                last_date_to_create_contract = last_date_to_create_contract.replace(
-                    day=last_date_day_to_create_contract,
-                    month=contract_create_date_month,
-                    year=contract_create_date_year,
-                )
-            elif (
-                start_date_day_to_create_contract > last_date_day_to_create_contract
-                and start_date_day_to_create_contract < contract_create_date_day
-                and contract_create_date_day > last_date_day_to_create_contract
-            ):
-                logger.info(
-                    "on_contract_approve_signal : date day condition 3 ---------------------"
-                )
-                start_date_to_create_contract = start_date_to_create_contract.replace(
-                    day=start_date_day_to_create_contract,
-                    month=contract_create_date_month,
-                    year=contract_create_date_year,
-                )
-                if contract_create_date_month == 12:
-                    contract_create_date_month = 0
-                    contract_create_date_year += 1
-                last_date_to_create_contract = last_date_to_create_contract.replace(
-                    day=last_date_day_to_create_contract,
-                    month=contract_create_date_month + 1,
-                    year=contract_create_date_year,
-                )
-            elif (
-                start_date_day_to_create_contract > last_date_day_to_create_contract
-                and start_date_day_to_create_contract > contract_create_date_day
-                and contract_create_date_day < last_date_day_to_create_contract
-            ):
-                logger.info(
-                    "on_contract_approve_signal : date day condition 4 ---------------------"
-                )
-                last_date_to_create_contract = last_date_to_create_contract.replace(
-                    day=last_date_day_to_create_contract,
-                    month=contract_create_date_month,
-                    year=contract_create_date_year,
-                )
-                if contract_create_date_month == 1:
-                    contract_create_date_month = 13
-                    contract_create_date_year -= 1
-                start_date_to_create_contract = start_date_to_create_contract.replace(
-                    day=start_date_day_to_create_contract,
-                    month=contract_create_date_month - 1,
-                    year=contract_create_date_year,
-                )
 
-            logger.info(
-                f"on_contract_approve_signal : start_date_to_create_contract = {start_date_to_create_contract}"
-            )
-            logger.info(
-                f"on_contract_approve_signal : last_date_to_create_contract = {last_date_to_create_contract}"
-            )
-            logger.info(
-                f"on_contract_approve_signal : contract_create_date = {contract_create_date}"
-            )
-
-            if (
-                start_date_to_create_contract < contract_create_date
-                and contract_create_date > last_date_to_create_contract
-                and is_future_contract is False
-            ):
-                logger.info(
-                    "on_contract_approve_signal : contract penalty applied ---------------------"
-                )
-                contract_to_approve.penalty_raised = True
-                contract_to_approve.penalty_raised_date = now
-
-    result_payment = __create_payment(
-        contract_to_approve,
-        payment_service,
-        contract_contribution_plan_details,
-        product_config,
+def __approve_create_payment(context):
+    __create_payment(
+        context["contract"],
+        context["payment_service"],
+        __approval_contribution_plan_details(context),
+        __approval_product(context).config_data,
     )
+
+
+def __approve_save_contract(context):
+    contract_to_approve = context["contract"]
     # STATE_EXECUTABLE
-    contract_to_approve.date_approved = now
+    contract_to_approve.date_approved = context["now"]
     contract_to_approve.state = Contract.STATE_EXECUTABLE
-    approved_contract = __save_or_update_contract(
-        contract=contract_to_approve, user=user
-    )
-    email_contact_name = (
-        contract_to_approve.policy_holder.contact_name["contactName"]
-        if contract_to_approve.policy_holder.contact_name
-        and "contactName" in contract_to_approve.policy_holder.contact_name
-        else contract_to_approve.policy_holder.contact_name
-    )
-    email = __send_email_notify_payment(
-        contract_id=contract_to_approve.id,
-        code=contract_to_approve.code,
-        name=contract_to_approve.policy_holder.trade_name,
-        contact_name=email_contact_name,
-        amount_due=contract_to_approve.amount_due,
-        payment_reference=contract_to_approve.payment_reference,
-        email=contract_to_approve.policy_holder.email,
-        policy_holder_id=contract_to_approve.policy_holder_id,
-        contract_approved_date=now,
-    )
-    logger.info(f"on_contract_approve_signal : approved_contract = {approved_contract}")
-    logger.info(
-        "on_contract_approve_signal : --------------------- End ---------------------"
+    __save_or_update_contract(contract=contract_to_approve, user=context["user"])
+
+
+def __approve_notify(context):
+    contract_to_approve = context["contract"]
+    # the email and its attachments are rendered and sent by the outbox worker
+    enqueue_payment_notification(
+        contract_to_approve,
+        contract_approved_date=contract_to_approve.date_approved or context["now"],
     )
-    return approved_contract
 
 
 # additional filters for payment in 'contract' tab
+def __portal_access_cache(user):
+    # kept on the user object of the request, so it lives as long as the request
+    cache = getattr(user, "_contract_portal_access", None)
+    if cache is None:
+        cache = {"policy_holders": {}, "access": {}}
+        setattr(user, "_contract_portal_access", cache)
+    return cache
+
+
+def __has_portal_access(user, contract_id):
+    """
+    Whether the user is linked, in the policy holder user table, to the policy
+    holder of the contract. Cached per (user, policy holder) for the request.
+    """
+    cache = __portal_access_cache(user)
+    contract_id = f"{contract_id}"
+    if contract_id not in cache["policy_holders"]:
+        cache["policy_holders"][contract_id] = (
+            Contract.objects.filter(id=contract_id)
+            .values_list("policy_holder_id", flat=True)
+            .first()
+        )
+    policy_holder_id = cache["policy_holders"][contract_id]
+    if policy_holder_id is None:
+        return False
+    key = (user.id, f"{policy_holder_id}")
+    if key not in cache["access"]:
+        from core import datetime
+
+        now = datetime.datetime.now()
+        cache["access"][key] = (
+            PolicyHolderUser.objects.filter(
+                Q(policy_holder__id=policy_holder_id, user__id=user.id)
+            )
+            .filter(
+                Q(date_valid_from=None) | Q(date_valid_from__lte=now),
+                Q(date_valid_to=None) | Q(date_valid_to__gte=now),
+            )
+            .exists()
+        )
+    return cache["access"][key]
+
+
 def append_contract_filter(sender, **kwargs):
     user = kwargs.get("user", None)
     additional_filter = kwargs.get("additional_filter", None)
@@ -290,31 +302,22 @@ def append_contract_filter(sender, **kwargs):
             PolicyholderConfig.gql_query_payment_portal_perms
         ):
             contract_id = additional_filter["contract"]
-            contract_to_process = Contract.objects.filter(id=contract_id).first()
             # check if user is linked to ph in policy holder user table
             type_user = f"{user}"
             # related to user object output (i) or (t)
             # check if we have interactive user from current context
             if "(i)" in type_user:
-                from core import datetime
-
-                now = datetime.datetime.now()
-                ph_user = (
-                    PolicyHolderUser.objects.filter(
-                        Q(
-                            policy_holder__id=contract_to_process.policy_holder.id,
-                            user__id=user.id,
-                        )
-                    )
-                    .filter(
-                        Q(date_valid_from=None) | Q(date_valid_from__lte=now),
-                        Q(date_valid_to=None) | Q(date_valid_to__gte=now),
-                    )
-                    .first()
-                )
-                if ph_user or user.has_perms(PaymentConfig.gql_query_payments_perms):
+                if user.has_perms(
+                    PaymentConfig.gql_query_payments_perms
+                ) or __has_portal_access(user, contract_id):
+                    # EXISTS instead of joins over the payment details
                     return Q(
-                        payment_details__premium__contract_contribution_plan_details__contract_details__contract__id=contract_id
+                        Exists(
+                            PaymentDetail.objects.filter(
+                                payment_id=OuterRef("id"),
+                                premium__contract_contribution_plan_details__contract_details__contract__id=contract_id,
+                            )
+                        )
                     )
 
 
@@ -328,40 +331,29 @@ def append_contract_policy_insuree_filter(sender, **kwargs):
             InsureeConfig.gql_query_insuree_policy_perms
         ) or user.has_perms(PolicyholderConfig.gql_query_insuree_policy_portal_perms):
             contract_id = additional_filter["contract"]
-            contract_to_process = Contract.objects.filter(id=contract_id).first()
             # check if user is linked to ph in policy holder user table
             type_user = f"{user}"
             # related to user object output (i) or (t)
             # check if we have interactive user from current context
             if "(i)" in type_user:
-                from core import datetime
-
-                now = datetime.datetime.now()
-                ph_user = (
-                    PolicyHolderUser.objects.filter(
-                        Q(
-                            policy_holder__id=contract_to_process.policy_holder.id,
-                            user__id=user.id,
-                        )
-                    )
-                    .filter(
-                        Q(date_valid_from=None) | Q(date_valid_from__lte=now),
-                        Q(date_valid_to=None) | Q(date_valid_to__gte=now),
-                    )
-                    .first()
-                )
-                if ph_user or user.has_perms(
+                if user.has_perms(
                     InsureeConfig.gql_query_insuree_policy_perms
-                ):
-                    policies = list(
-                        ContractContributionPlanDetails.objects.filter(
-                            contract_details__contract__id=contract_id
-                        ).values_list("policy", flat=True)
-                    )
+                ) or __has_portal_access(user, contract_id):
+                    # policies of the contract starting in the contract validity,
+                    # evaluated by the database with the insuree policy query
                     return Q(
-                        start_date__gte=contract_to_process.date_valid_from,
-                        start_date__lte=contract_to_process.date_valid_to,
-                        policy__in=policies,
+                        Exists(
+                            ContractContributionPlanDetails.objects.filter(
+                                contract_details__contract__id=contract_id,
+                                contract_details__contract__date_valid_from__lte=OuterRef(
+                                    "start_date"
+                                ),
+                                contract_details__contract__date_valid_to__gte=OuterRef(
+                                    "start_date"
+                                ),
+                                policy_id=OuterRef("policy_id"),
+                            )
+                        )
                     )
 
 
@@ -386,121 +378,176 @@ signal_contract_approve.connect(
 signal_before_payment_query.connect(append_contract_filter)
 signal_before_insuree_policy_query.connect(append_contract_policy_insuree_filter)
 signal_check_formal_sector_for_policy.connect(formal_sector_policies)
+# keep the cached location tree used for contract codes and receipts up to date
+post_save.connect(
+    location_department_index.invalidate,
+    sender=Location,
+    dispatch_uid="contract_location_index_save",
+)
+post_delete.connect(
+    location_department_index.invalidate,
+    sender=Location,
+    dispatch_uid="contract_location_index_delete",
+)
+# compiled product date rules are dropped when a product changes
+post_save.connect(
+    product_schedules.invalidate,
+    sender=Product,
+    dispatch_uid="contract_product_schedules_save",
+)
+post_delete.connect(
+    product_schedules.invalidate,
+    sender=Product,
+    dispatch_uid="contract_product_schedules_delete",
+)
+
+
+# payment fields that can make a payment paid, other partial updates are skipped
+PAYMENT_ACTIVATION_FIELDS = {"expected_amount", "received_amount"}
 
 
 @receiver(post_save, sender=Payment, dispatch_uid="payment_signal_paid")
 def activate_contracted_policies(sender, instance, **kwargs):
-    logger.info("====  activate_contracted_policies  ====  start  ====")
+    """
+    Cheap guard on every payment save: the contract lookups only run for a paid
+    payment, in a celery task started once the transaction is committed.
+    """
+    update_fields = kwargs.get("update_fields")
+    if update_fields and not PAYMENT_ACTIVATION_FIELDS.intersection(update_fields):
+        return
     received_amount = instance.received_amount if instance.received_amount else 0
-    # check if payment is related to the contract
-    payment_detail = (
-        PaymentDetail.objects.filter(payment__id=int(instance.id))
-        .prefetch_related(
-            "premium__contract_contribution_plan_details__contract_details__contract"
+    if instance.expected_amount is None or instance.expected_amount > received_amount:
+        return
+    payment_id = instance.id
+    logger.info(
+        f"====  activate_contracted_policies  ====  payment {payment_id} paid  ===="
+    )
+    transaction.on_commit(lambda: __start_contract_activation(payment_id))
+
+
+def __start_contract_activation(payment_id):
+    from contract.tasks import activate_contracted_policies_async
+
+    try:
+        activate_contracted_policies_async.delay(payment_id)
+    except Exception as exc:
+        logger.error(
+            f"Failed to start the contract activation of payment {payment_id}: {exc}"
         )
-        .prefetch_related("premium__contract_contribution_plan_details")
-        .filter(premium__contract_contribution_plan_details__isnull=False)
+
+
+def payment_contract_summary(payment_id):
+    """
+    Contracts paid by a payment with their state, number of ccpd and contribution
+    plan periodicity, in one aggregated query, and the number of payment details
+    related to contract contributions.
+    """
+    paid_premiums = PaymentDetail.objects.filter(
+        payment__id=int(payment_id),
+        premium__contract_contribution_plan_details__isnull=False,
     )
-    if len(list(payment_detail)) > 0:
-        if instance.expected_amount <= received_amount:
-            contribution_list_id = [pd.premium.id for pd in payment_detail]
-            contract_list = Contract.objects.filter(
-                contractdetails__contractcontributionplandetails__contribution__id__in=contribution_list_id
-            ).distinct()
-            ccpd_number = (
-                ContractContributionPlanDetails.objects.prefetch_related(
-                    "contract_details__contract"
-                )
-                .filter(contract_details__contract__in=list(contract_list))
-                .count()
-            )
-            contract_plan_periodicity = (
-                ContractContributionPlanDetails.objects.prefetch_related(
-                    "contract_details__contract"
-                )
-                .filter(contract_details__contract__in=list(contract_list))
-                .first()
-            )
-            periodicity = (
-                contract_plan_periodicity.contribution_plan.periodicity
-                if contract_plan_periodicity.contribution_plan
-                else None
-            )
+    paid_contracts = ContractContributionPlanDetails.objects.filter(
+        contribution_id__in=paid_premiums.values("premium_id")
+    ).values("contract_details__contract_id")
+    contracts = list(
+        ContractContributionPlanDetails.objects.filter(
+            contract_details__contract_id__in=paid_contracts
+        )
+        .values("contract_details__contract_id", "contract_details__contract__state")
+        .annotate(
+            ccpd_count=Count("id"),
+            periodicity=Max("contribution_plan__periodicity"),
+        )
+        .order_by()
+    )
+    return contracts, paid_premiums.count() if contracts else 0
+
+
+def activate_paid_contracts(payment_id):
+    logger.info("====  activate_paid_contracts  ====  start  ====")
+    contracts, payment_detail_count = payment_contract_summary(payment_id)
+    ccpd_number = sum(contract["ccpd_count"] for contract in contracts)
+    logger.info(
+        f"====  activate_paid_contracts  ====  contracts  ====  {contracts}"
+    )
+    if not contracts or ccpd_number != payment_detail_count:
+        logger.info("====  activate_paid_contracts  ====  end  ====")
+        return []
+    executable_contract_ids = [
+        contract["contract_details__contract_id"]
+        for contract in contracts
+        if contract["contract_details__contract__state"] == Contract.STATE_EXECUTABLE
+    ]
+    periodicities = {
+        contract["contract_details__contract_id"]: contract["periodicity"]
+        for contract in contracts
+    }
+    # get the ccpd related to the executable contracts
+    ccpd_list = list(
+        ContractContributionPlanDetails.objects.select_related(
+            "contract_details__contract"
+        ).filter(contract_details__contract_id__in=executable_contract_ids)
+    )
+    # TODO support Split payment and check that
+    #  the payment match the value of all contributions
+
+    # Activate all employees. If the contact has to be activated but employee activation requires
+    # additional rules, intercept the signal on activate_contract_contribution_plan_detail
+    for ccpd in ccpd_list:
+        try:
             logger.info(
-                f"====  activate_contracted_policies  ====  periodicity  ====  {periodicity}"
+                f"====  activate_paid_contracts  ====  ccpd  ====  {ccpd}"
             )
-            logger.info(
-                f"====  activate_contracted_policies  ====  contribution_list_id  ====  {contribution_list_id}"
+            periodicity = periodicities[ccpd.contract_details.contract_id]
+            # assign_policy = False
+            # insuree_pd = PaymentDetail.objects.filter(insurance_number=ccpd.contract_details.insuree.chf_id,
+            #         premium__contract_contribution_plan_details__contract_details__contract__policy_holder=ccpd.contract_details.contract.policy_holder,
+            #         premium__contract_contribution_plan_details__isnull=False).all()
+
+            # if periodicity == 1 and len(insuree_pd) >= 3:
+            #     assign_policy = True
+            # elif periodicity == 3 and len(insuree_pd) >= 1:
+            #     assign_policy = True
+
+            # if assign_policy:
+            #     if ccpd.contract_details.insuree.status == "APPROVED" and ccpd.contract_details.insuree.document_status and ccpd.contract_details.insuree.biometrics_is_master:
+            #         PolicyHolderInsuree.objects.filter(policy_holder__uuid=ccpd.contract_details.contract.policy_holder.uuid, insuree_id=ccpd.contract_details.insuree.id).update(is_rights_enable_for_insuree=True, is_payment_done_by_policy_holder=True)
+            #         result = ContractActivationService.activate_contract_contribution_plan_detail(ccpd)
+            #         logger.info(f"====  activate_contracted_policies  ==== activate_contract_contribution_plan_detail result  ====  {result}")
+            #         if not result:
+            #             logger.info("Contract contribution plan detail ccpd.id not activated")
+            #         else:
+            #             Insuree.objects.filter(id=ccpd.contract_details.insuree.id).update(status="ACTIVE")
+            #             insuree = Insuree.objects.filter(id=ccpd.contract_details.insuree.id).first()
+            #             logger.info(f"====  activate_contracted_policies  ====  insuree.status  ====  {insuree.status}")
+            #             family_members = Insuree.objects.filter(family_id=insuree.family.id, legacy_id=None).all()
+            #             all_insuree = True
+            #             for member in family_members:
+            #                 if member.status == 'APPROVED':
+            #                     Insuree.objects.filter(id=member.id).update(status="ACTIVE")
+            #             for member in family_members:
+            #                 if member.status != insuree.status:
+            #                     all_insuree = False
+            #                     break
+            #             if all_insuree:
+            #                 Family.objects.filter(id=insuree.family.id).update(status=insuree.status)
+            #                 logger.info("====  activate_contracted_policies  ====  family.status  ====  ACTIVE")
+            #     else:
+            #         PolicyHolderInsuree.objects.filter(policy_holder__uuid=ccpd.contract_details.contract.policy_holder.uuid, insuree_id=ccpd.contract_details.insuree.id).update(is_payment_done_by_policy_holder=True)
+            #         logger.info("====  activate_contracted_policies  ====  PolicyHolderInsuree  ====  is_payment_done_by_policy_holder=True")
+            # else:
+            #     logger.info(f"Policy can not be assigned for {ccpd}")
+            # # result = ContractActivationService.activate_contract_contribution_plan_detail(ccpd)
+            # # if not result:
+            # #     logger.info("Contract contribution plan detail ccpd.id not activated")
+        except Exception as e:
+            logger.error(
+                f"Contract contribution plan detail ccpd not activated {e}"
             )
-
-            if ccpd_number == len(list(payment_detail)):
-                for contract in contract_list:
-                    if contract.state == Contract.STATE_EXECUTABLE:
-                        # get the ccpd related to the currently processing contract
-                        ccpd_list = list(
-                            ContractContributionPlanDetails.objects.prefetch_related(
-                                "contract_details__contract"
-                            ).filter(contract_details__contract=contract)
-                        )
-                        # TODO support Split payment and check that
-                        #  the payment match the value of all contributions
-
-                        # Activate all employees. If the contact has to be activated but employee activation requires
-                        # additional rules, intercept the signal on activate_contract_contribution_plan_detail
-                        for ccpd in ccpd_list:
-                            try:
-                                logger.info(
-                                    f"====  activate_contracted_policies  ====  ccpd  ====  {ccpd}"
-                                )
-                                pass
-                                # assign_policy = False
-                                # insuree_pd = PaymentDetail.objects.filter(insurance_number=ccpd.contract_details.insuree.chf_id,
-                                #         premium__contract_contribution_plan_details__contract_details__contract__policy_holder=ccpd.contract_details.contract.policy_holder,
-                                #         premium__contract_contribution_plan_details__isnull=False).all()
-
-                                # if periodicity == 1 and len(insuree_pd) >= 3:
-                                #     assign_policy = True
-                                # elif periodicity == 3 and len(insuree_pd) >= 1:
-                                #     assign_policy = True
-
-                                # if assign_policy:
-                                #     if ccpd.contract_details.insuree.status == "APPROVED" and ccpd.contract_details.insuree.document_status and ccpd.contract_details.insuree.biometrics_is_master:
-                                #         PolicyHolderInsuree.objects.filter(policy_holder__uuid=ccpd.contract_details.contract.policy_holder.uuid, insuree_id=ccpd.contract_details.insuree.id).update(is_rights_enable_for_insuree=True, is_payment_done_by_policy_holder=True)
-                                #         result = ContractActivationService.activate_contract_contribution_plan_detail(ccpd)
-                                #         logger.info(f"====  activate_contracted_policies  ==== activate_contract_contribution_plan_detail result  ====  {result}")
-                                #         if not result:
-                                #             logger.info("Contract contribution plan detail ccpd.id not activated")
-                                #         else:
-                                #             Insuree.objects.filter(id=ccpd.contract_details.insuree.id).update(status="ACTIVE")
-                                #             insuree = Insuree.objects.filter(id=ccpd.contract_details.insuree.id).first()
-                                #             logger.info(f"====  activate_contracted_policies  ====  insuree.status  ====  {insuree.status}")
-                                #             family_members = Insuree.objects.filter(family_id=insuree.family.id, legacy_id=None).all()
-                                #             all_insuree = True
-                                #             for member in family_members:
-                                #                 if member.status == 'APPROVED':
-                                #                     Insuree.objects.filter(id=member.id).update(status="ACTIVE")
-                                #             for member in family_members:
-                                #                 if member.status != insuree.status:
-                                #                     all_insuree = False
-                                #                     break
-                                #             if all_insuree:
-                                #                 Family.objects.filter(id=insuree.family.id).update(status=insuree.status)
-                                #                 logger.info("====  activate_contracted_policies  ====  family.status  ====  ACTIVE")
-                                #     else:
-                                #         PolicyHolderInsuree.objects.filter(policy_holder__uuid=ccpd.contract_details.contract.policy_holder.uuid, insuree_id=ccpd.contract_details.insuree.id).update(is_payment_done_by_policy_holder=True)
-                                #         logger.info("====  activate_contracted_policies  ====  PolicyHolderInsuree  ====  is_payment_done_by_policy_holder=True")
-                                # else:
-                                #     logger.info(f"Policy can not be assigned for {ccpd}")
-                                # # result = ContractActivationService.activate_contract_contribution_plan_detail(ccpd)
-                                # # if not result:
-                                # #     logger.info("Contract contribution plan detail ccpd.id not activated")
-                            except Exception as e:
-                                logger.error(
-                                    f"Contract contribution plan detail ccpd not activated {e}"
-                                )
-                        # contract.state = Contract.STATE_EFFECTIVE
-                        # __save_or_update_contract(contract, contract.user_updated)
-    logger.info("====  activate_contracted_policies  ====  end  ====")
+    # contract.state = Contract.STATE_EFFECTIVE
+    # __save_or_update_contract(contract, contract.user_updated)
+    logger.info("====  activate_paid_contracts  ====  end  ====")
+    return executable_contract_ids
 
 
 class ContractActivationService:
@@ -587,47 +634,3 @@ def __create_payment(contract, payment_service, contract_cpd, product_config=Non
     return payment_service.create(
         payment=payment_data, payment_details=payment_details_data
     )
-
-
-def __send_email_notify_payment(
-    contract_id,
-    code,
-    name,
-    contact_name,
-    amount_due,
-    payment_reference,
-    email,
-    policy_holder_id,
-    contract_approved_date,
-):
-    try:
-        email_message = EmailMessage(
-            subject="Contract payment notification",
-            body=get_message_approved_contract(
-                language=settings.LANGUAGE_CODE.split("-")[0],
-                code=code,
-                name=name,
-                contact_name=contact_name,
-                due_amount=amount_due,
-                payment_reference=payment_reference,
-            ),
-            from_email=settings.EMAIL_HOST_USER,
-            to=[email],
-        )
-        # Attach the PDF file
-        pdf_file = generate_report_for_employee_declaration(
-            contract_id, code, policy_holder_id, contract_approved_date
-        )
-        email_message.attach("payment_receipt.pdf", pdf_file, "application/pdf")
-        # Attach the Excel file
-        excel_file = send_contract(contract_id)
-        email_message.attach(
-            "employee_declaration.xlsx",
-            excel_file,
-            "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        )
-        # Send the email
-        email_message.send()
-        return True
-    except BadHeaderError:
-        return ValueError("Invalid header found.")
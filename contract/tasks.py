@@ -1,3 +1,4 @@
+import json
 import logging
 
 from celery import shared_task
@@ -9,57 +10,167 @@ from django.http import JsonResponse
 
 from contract.models import Contract, ContractContributionPlanDetails, ContractMutation
 from contract.services import Contract as ContractService
-from contract.services import ContractToInvoiceService
+from contract.services import ContractToInvoiceService, terminate_expired_contracts
 
 logger = logging.getLogger(__name__)
 
+APPROVAL_MAX_RETRIES = 3
 
-@shared_task
-def approve_contracts(user_id, contracts):
+
+def _chunks(contracts, max_parallel):
+    """
+    Split the contracts into at most `max_parallel` chunks of similar size, so
+    the fan-out never runs more than `max_parallel` subtasks for one request.
+    """
+    contracts = [f"{contract}" for contract in contracts]
+    if not contracts:
+        return []
+    chunk_count = max(1, min(max_parallel, len(contracts)))
+    return [contracts[i::chunk_count] for i in range(chunk_count)]
+
+
+def _run_contract_chunk(user_id, contracts, operation):
     user = User.objects.get(id=user_id)
     contract_service = ContractService(user=user)
+    results = []
     for contract in contracts:
-        output = contract_service.approve(contract={"id": contract})
+        try:
+            output = getattr(contract_service, operation)(contract={"id": contract})
+        except Exception as exc:
+            output = {"success": False, "detail": f"{exc}"}
+        success = bool(output) and output.get("success") is True
+        results.append(
+            {
+                "contract": contract,
+                "success": success,
+                "detail": "" if success else f"{(output or {}).get('detail', '')}",
+            }
+        )
+    return results
+
+
+@shared_task
+def approve_contract_chunk(user_id, contracts):
+    return _run_contract_chunk(user_id, contracts, "approve")
 
 
 @shared_task
-def approve_contract_async(user_id, contract_id, client_mutation_id=None):
+def counter_contract_chunk(user_id, contracts):
+    return _run_contract_chunk(user_id, contracts, "counter")
+
+
+@shared_task
+def aggregate_bulk_contract_results(chunk_results, user_id, operation, client_mutation_id=None):
+    """
+    Chord callback of the bulk operations: aggregates the per-contract results.
+    When the operation comes from a mutation, the processed contracts are linked
+    to its MutationLog (ContractMutation) and the failures are stored on it.
+    """
+    from core.models import MutationLog
+
+    results = [result for chunk in chunk_results for result in chunk]
+    failed = [result for result in results if not result["success"]]
+    summary = {
+        "operation": operation,
+        "total": len(results),
+        "succeeded": len(results) - len(failed),
+        "failed": failed,
+    }
+    logger.info(
+        f"bulk {operation} : {summary['succeeded']} succeeded, {len(failed)} failed"
+    )
+    if client_mutation_id:
+        mutation_log = MutationLog.objects.filter(
+            client_mutation_id=client_mutation_id
+        ).order_by("-request_date_time").first()
+        if mutation_log:
+            ContractMutation.objects.bulk_create(
+                [
+                    ContractMutation(contract_id=result["contract"], mutation=mutation_log)
+                    for result in results
+                    if result["success"]
+                ]
+            )
+            if failed:
+                MutationLog.objects.filter(id=mutation_log.id).update(
+                    status=MutationLog.ERROR, error=json.dumps(summary)
+                )
+    return summary
+
+
+def dispatch_bulk_contract_operation(user_id, contracts, operation, client_mutation_id=None):
     """
-    Asynchronous task to approve a single contract
+    Fan out a bulk approve/counter as a chord of per-chunk subtasks, capped by
+    ContractConfig.bulk_max_parallel_tasks, whose callback aggregates the results.
     """
+    from celery import chord
+
+    from contract.apps import ContractConfig
+
+    chunk_task = {
+        "approve": approve_contract_chunk,
+        "counter": counter_contract_chunk,
+    }[operation]
+    chunks = _chunks(contracts, ContractConfig.bulk_max_parallel_tasks)
+    if not chunks:
+        return None
+    return chord(chunk_task.s(f"{user_id}", chunk) for chunk in chunks)(
+        aggregate_bulk_contract_results.s(
+            f"{user_id}", operation, client_mutation_id=client_mutation_id
+        )
+    )
+
+
+@shared_task
+def approve_contracts(user_id, contracts, client_mutation_id=None):
+    dispatch_bulk_contract_operation(user_id, contracts, "approve", client_mutation_id)
+
+
+@shared_task(bind=True, max_retries=APPROVAL_MAX_RETRIES, default_retry_delay=60)
+def approve_contract_async(self, user_id, contract_id, client_mutation_id=None):
+    """
+    Asynchronous task to approve a single contract. The approval is checkpointed
+    stage by stage on the contract, so a retry resumes after the last completed
+    stage. Only failed stages and database connection errors are retried, the
+    other failures (permissions, contract state, validation) fail at once.
+    """
+    from contract.approval import is_retryable_approval_error
+
     try:
         user = User.objects.get(id=user_id)
         contract_service = ContractService(user=user)
 
         # Approve the contract
         output = contract_service.approve(contract={"id": contract_id})
+    except Exception as e:
+        logger.error(f"Error in approve_contract_async: {str(e)}")
+        if is_retryable_approval_error(e) and self.request.retries < self.max_retries:
+            raise self.retry(exc=e)
+        raise Exception(f"Error! {str(e)}")
 
-        if output["success"]:
-            contract = Contract.objects.get(id=contract_id)
+    if output["success"]:
+        contract = Contract.objects.get(id=contract_id)
 
-            # Create contract mutation if client_mutation_id is provided
-            if client_mutation_id:
-                ContractMutation.object_mutated(
-                    user,
-                    client_mutation_id=client_mutation_id,
-                    contract=contract
-                )
+        # Create contract mutation if client_mutation_id is provided
+        if client_mutation_id:
+            ContractMutation.object_mutated(
+                user,
+                client_mutation_id=client_mutation_id,
+                contract=contract
+            )
 
-            return None
-        else:
-            raise Exception(f"Error! {output['detail']}")
+        return None
 
-    except Exception as e:
-        logger.error(f"Error in approve_contract_async: {str(e)}")
-        raise Exception(f"Error! {str(e)}")
+    logger.error(f"Error in approve_contract_async: {output['detail']}")
+    error = Exception(f"Error! {output['detail']}")
+    if output.get("retryable") and self.request.retries < self.max_retries:
+        raise self.retry(exc=error)
+    raise error
 
 
 @shared_task
-def counter_contracts(user_id, contracts):
-    user = User.objects.get(id=user_id)
-    contract_service = ContractService(user=user)
-    for contract in contracts:
-        output = contract_service.counter(contract={"id": contract})
+def counter_contracts(user_id, contracts, client_mutation_id=None):
+    dispatch_bulk_contract_operation(user_id, contracts, "counter", client_mutation_id)
 
 
 @shared_task
@@ -117,44 +228,23 @@ def create_contract_async(user_id, contract_data, client_mutation_id=None):
         raise Exception(f"Error!: {str(e)}")
 
 
-@shared_task
-def update_contract_salaries_async(user_id, contract_id, file_data):
+@shared_task(bind=True)
+def update_contract_salaries_async(self, user_id, contract_id, file_data):
     """
-    Asynchronous task to update contract salaries from an Excel file
+    Asynchronous task to update contract salaries from an Excel (xlsx) or CSV file.
+    The file is read and applied chunk by chunk, see contract.salary_upload.
     """
     try:
-        import io
-        import logging
-
-        import pandas as pd
-        from core.models import User
-        from django.core.files.base import ContentFile
-        from django.db import transaction
-        from insuree.models import Insuree
-        from policyholder.gql.gql_mutations.create_mutations import (
-            get_and_set_waiting_period_for_insuree,
-        )
         from policyholder.models import PolicyHolder, PolicyHolderContributionPlan
 
-        from contract.models import Contract, ContractDetails
-        from contract.views import (
-            create_new_insuree_and_add_contract_details,
-            re_evaluate_contract_details,
-            update_salary,
-        )
+        from contract.salary_upload import SalaryUpload
+        from contract.views import re_evaluate_contract_details
 
-        logger = logging.getLogger(__name__)
-        # progress_recorder = ProgressRecorder()
+        progress_recorder = ProgressRecorder(self)
 
         # Get user
         user = User.objects.get(id=user_id)
         core_username = user.username
-        user_id_for_audit = user.id_for_audit
-
-        # Initialize counters
-        total_lines = 0
-        total_salaries_updated = 0
-        total_validation_errors = 0
 
         # Get contract and policy holder
         contract = Contract.objects.filter(id=contract_id).first()
@@ -177,169 +267,17 @@ def update_contract_salaries_async(user_id, contract_id, file_data):
         ph_cpb = PolicyHolderContributionPlan.objects.filter(
             policy_holder=policy_holder, is_deleted=False).first()
         cpb = ph_cpb.contribution_plan_bundle if ph_cpb else None
-        enrolment_type = cpb.name if cpb else None
 
         # set Process_status to processing_uploaded_data supposing that \
         # the file is uploaded and the data is being processed
         contract.process_status = Contract.ProcessStatus.PROCESSING_UPLOADED_DATA
         contract.save(username=core_username)
 
-        # Convert file data to pandas DataFrame
-        file_content = ContentFile(file_data)
-        df = pd.read_excel(file_content)
-        df.columns = [col.strip() for col in df.columns]
-
-        # Set total number of rows for progress tracking
-        # total_rows = len(df)
-        # progress_recorder.set_progress(
-        #     0, total_rows, "Starting salary updates...")
-
-        # Output data preparation
-        output = io.BytesIO()
-        writer = pd.ExcelWriter(output, engine="xlsxwriter")
-        processed_data = []
-
-        # Start transaction
-        with transaction.atomic():
-            # Get existing contract details
-            exist_contract_details = ContractDetails.objects.filter(
-                contract_id=contract_id, is_deleted=False
-            )
-
-            # Index contract details by chf_id
-            contract_details_by_chf_id = {
-                detail.insuree.chf_id: detail for detail in
-                exist_contract_details
-            }
-
-            confirmed_insurees = []
-            already_processed_chf_ids = []
-
-            # Process each row
-            for index, line in df.iterrows():
-                total_lines += 1
-                chf_id = line.get("Numéro CAMU temporaire")
-
-                if not chf_id or pd.isna(chf_id):
-                    insuree_name = line.get("Assuré")
-                    if not insuree_name or pd.isna(insuree_name):
-                        continue
-
-                    chf_id = create_new_insuree_and_add_contract_details(
-                        insuree_name,
-                        policy_holder,
-                        cpb,
-                        contract,
-                        user_id_for_audit,
-                        None,  # No request object in async task
-                        enrolment_type,
-                    )
-                    if not chf_id:
-                        continue
-
-                    # Refresh contract details after new insuree creation
-                    exist_contract_details = ContractDetails.objects.filter(
-                        contract_id=contract_id, is_deleted=False
-                    )
-                    contract_details_by_chf_id = {
-                        detail.insuree.chf_id: detail
-                        for detail in exist_contract_details
-                    }
-                if chf_id in already_processed_chf_ids:
-                    continue
-
-                already_processed_chf_ids.append(chf_id)
-                gross_salary = line.get("Gross Salary")
-                new_gross_salary = 0
-
-                if contract.use_bundle_contribution_plan_amount is False:
-                    if not gross_salary or pd.isna(gross_salary):
-                        continue
-                    new_gross_salary = int(gross_salary)
-                    if new_gross_salary <= 0:
-                        continue
-
-                if chf_id in contract_details_by_chf_id:
-                    contract_detail = contract_details_by_chf_id[chf_id]
-                    insuree = Insuree.objects.filter(chf_id=chf_id).first()
-
-                    if insuree:
-                        get_and_set_waiting_period_for_insuree(
-                            insuree.id, policy_holder.id
-                        )
-                    current_salary = (
-                        int(
-                            contract_detail
-                            .json_ext.get("calculation_rule", {})
-                            .get("income", 0)
-                        )
-                        if contract_detail.json_ext
-                        else 0
-                    )
-
-                    if current_salary == 0:
-                        contract_detail.json_ext = {
-                            "calculation_rule": {"rate": 0, "income": new_gross_salary}
-                        }
-
-                    confirmed_insurees.append(insuree)
-                    if current_salary != new_gross_salary:
-                        json_data = update_salary(
-                            contract_detail.json_ext, new_gross_salary
-                        )
-                        if json_data is None:
-                            raise ValueError(
-                                f"Failed to update salary for chf_id {chf_id}"
-                            )
-
-                        contract_detail.json_ext = json_data
-                        contract_detail.save(username=core_username)
-                        total_salaries_updated += 1
-                        status = "Success"
-                    else:
-                        status = "No Change"
-                else:
-                    total_validation_errors += 1
-                    status = "Error: Not Found"
-
-                line_data = line.to_dict()
-                line_data["Status"] = status
-                processed_data.append(line_data)
-
-                # Update progress after each row is processed
-                # progress_recorder.set_progress(
-                #     index + 1,
-                #     total_rows,
-                #     f"Processing row {index + 1} of {total_rows}"
-                # )
-
-            # Update confirmation status for contract details
-            contract_details = ContractDetails.objects.filter(
-                contract_id=contract_id,
-                is_deleted=False,
-                insuree__in=confirmed_insurees,
-            )
-
-            for contract_detail in contract_details:
-                if contract_detail.is_confirmed is False:
-                    contract_detail.is_confirmed = True
-                    contract_detail.save(username=core_username)
-
-            contract_details_excludes = ContractDetails.objects.filter(
-                contract_id=contract_id,
-                is_deleted=False,
-            ).exclude(insuree__in=confirmed_insurees)
-
-            for contract_detail_exclude in contract_details_excludes:
-                if contract_detail_exclude.is_confirmed is True:
-                    contract_detail_exclude.is_confirmed = False
-                    contract_detail_exclude.save(username=core_username)
-
-            # Create output Excel file
-            processed_df = pd.DataFrame(processed_data)
-            processed_df.to_excel(writer, index=False, header=True)
-            writer.save()
-            output.seek(0)
+        salary_upload = SalaryUpload(
+            contract, policy_holder, cpb, user, progress_recorder=progress_recorder
+        )
+        salary_upload.run(file_data)
+        total_validation_errors = salary_upload.total_validation_errors
 
         # Evaluate contract details if no errors
         if total_validation_errors == 0:
@@ -385,3 +323,42 @@ def update_contract_salaries_async(user_id, contract_id, file_data):
             "success": False,
             "message": str(e)
         }
+
+
+@shared_task
+def send_contract_notifications():
+    """
+    Worker of the contract notification outbox: renders and sends the pending
+    emails, see contract.notifications.
+    """
+    from contract.notifications import send_pending_notifications
+
+    sent = send_pending_notifications()
+    logger.info(f"send_contract_notifications : {sent} notifications sent")
+    return sent
+
+
+@shared_task(name="contract.tasks.terminate_expired_contracts")
+def terminate_expired_contracts_task(dry_run=False):
+    """
+    Daily termination of the expired effective contracts. The schedule is
+    declared in the deployment celery beat settings, see the README.
+    """
+    from contract.apps import ContractConfig
+
+    result = terminate_expired_contracts(
+        username=ContractConfig.terminate_contracts_username, dry_run=dry_run
+    )
+    logger.info(f"terminate_expired_contracts_task : {result}")
+    return result
+
+
+@shared_task
+def activate_contracted_policies_async(payment_id):
+    """
+    Contract side of a paid payment, started by the Payment post_save receiver
+    contract.signals.activate_contracted_policies.
+    """
+    from contract.signals import activate_paid_contracts
+
+    return [f"{contract_id}" for contract_id in activate_paid_contracts(payment_id)]
@@ -2,3 +2,15 @@
 # from .query_tests import *
 from .helpers import *
 from .helpers_tests import *
+from .export_tests import *
+from .salary_upload_tests import *
+from .schedules_tests import *
+from .approval_tests import *
+from .notification_tests import *
+from .bulk_tasks_tests import *
+from .payment_activation_tests import *
+from .contract_filter_tests import *
+from .effective_amount_tests import *
+from .query_plan_tests import *
+from .keyset_pagination_tests import *
+from .location_index_tests import *
@@ -0,0 +1,87 @@
+from unittest import mock
+
+from celery.exceptions import Retry
+from django.test import SimpleTestCase, TestCase
+
+from contract.approval import ApprovalPipeline, ApprovalStage, ApprovalStageError
+from contract.models import Contract
+from contract.tests.helpers import create_test_contract
+
+
+class ApprovalPipelineTest(TestCase):
+
+    def setUp(self):
+        self.contract = create_test_contract()
+        self.calls = []
+        self.fail_on = None
+
+    def _stage(self, name, checkpoint, fields=()):
+        def function(context):
+            self.calls.append(name)
+            if name == self.fail_on:
+                raise ValueError(f"{name} failed")
+            if name == "contributions":
+                context["contract"].amount_due = 1500
+        return ApprovalStage(name, function, checkpoint, fields=fields)
+
+    def _pipeline(self, contract):
+        return ApprovalPipeline(contract, [
+            self._stage("contributions", Contract.ProcessStatus.APPROVAL_CONTRIBUTIONS_CREATED, ["amount_due"]),
+            self._stage("payment", Contract.ProcessStatus.APPROVAL_PAYMENT_CREATED),
+            self._stage("notify", Contract.ProcessStatus.APPROVAL_NOTIFIED),
+        ])
+
+    def test_resumes_after_last_checkpoint(self):
+        self.fail_on = "payment"
+        pipeline = self._pipeline(self.contract)
+        with self.assertRaises(ApprovalStageError):
+            pipeline.run({"contract": self.contract})
+        stored = Contract.objects.get(id=self.contract.id)
+        self.assertEqual(Contract.ProcessStatus.APPROVAL_CONTRIBUTIONS_CREATED, stored.process_status)
+        self.assertEqual(1500, stored.amount_due)
+        self.assertIn("contributions", pipeline.timings)
+
+        self.fail_on = None
+        self.calls = []
+        pipeline = self._pipeline(stored)
+        self.assertTrue(pipeline.is_resumable())
+        pipeline.run({"contract": stored})
+        self.assertEqual(["payment", "notify"], self.calls)
+        self.assertEqual(["payment", "notify"], list(pipeline.timings))
+        stored = Contract.objects.get(id=self.contract.id)
+        self.assertEqual(Contract.ProcessStatus.APPROVAL_NOTIFIED, stored.process_status)
+        self.assertFalse(self._pipeline(stored).is_resumable())
+
+    def test_other_process_status_runs_all_stages(self):
+        self.contract.process_status = Contract.ProcessStatus.CREATED
+        self._pipeline(self.contract).run({"contract": self.contract})
+        self.assertEqual(["contributions", "payment", "notify"], self.calls)
+
+
+@mock.patch("contract.tasks.User")
+@mock.patch("contract.tasks.ContractService")
+class ApproveContractAsyncRetryTest(SimpleTestCase):
+
+    def _run(self):
+        from contract.tasks import approve_contract_async
+
+        with mock.patch.object(approve_contract_async, "retry", side_effect=Retry()) as retry:
+            with self.assertRaises(Exception) as raised:
+                approve_contract_async("1", "contract-id")
+        return retry, raised.exception
+
+    def test_failed_stage_is_retried(self, contract_service, user):
+        contract_service.return_value.approve.return_value = {
+            "success": False, "detail": "approval stage payment failed", "retryable": True,
+        }
+        retry, exception = self._run()
+        retry.assert_called_once()
+        self.assertIsInstance(exception, Retry)
+
+    def test_permanent_failure_is_not_retried(self, contract_service, user):
+        contract_service.return_value.approve.return_value = {
+            "success": False, "detail": "Unauthorized", "retryable": False,
+        }
+        retry, exception = self._run()
+        retry.assert_not_called()
+        self.assertIn("Unauthorized", f"{exception}")
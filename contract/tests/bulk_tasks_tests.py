@@ -0,0 +1,44 @@
+import uuid
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from contract.apps import ContractConfig
+from contract.tasks import _chunks, aggregate_bulk_contract_results, dispatch_bulk_contract_operation
+
+
+class BulkContractTasksTest(SimpleTestCase):
+
+    def test_chunks_are_capped(self):
+        contracts = [uuid.uuid4() for _ in range(500)]
+        chunks = _chunks(contracts, 8)
+        self.assertEqual(8, len(chunks))
+        self.assertEqual(sorted(f"{contract}" for contract in contracts), sorted(sum(chunks, [])))
+        self.assertLessEqual(max(map(len, chunks)) - min(map(len, chunks)), 1)
+        self.assertEqual(3, len(_chunks(contracts[:3], 8)))
+        self.assertEqual([], _chunks([], 8))
+
+    def test_aggregate_results(self):
+        summary = aggregate_bulk_contract_results(
+            [
+                [{"contract": "a", "success": True, "detail": ""}],
+                [
+                    {"contract": "b", "success": False, "detail": "not negotiable"},
+                    {"contract": "c", "success": True, "detail": ""},
+                ],
+            ],
+            "1",
+            "approve",
+        )
+        self.assertEqual(3, summary["total"])
+        self.assertEqual(2, summary["succeeded"])
+        self.assertEqual(["b"], [result["contract"] for result in summary["failed"]])
+
+    @mock.patch("celery.chord")
+    def test_dispatch_fans_out_one_subtask_per_chunk(self, chord):
+        with mock.patch.object(ContractConfig, "bulk_max_parallel_tasks", 4):
+            dispatch_bulk_contract_operation("1", [uuid.uuid4() for _ in range(50)], "counter", "mutation-1")
+        header = list(chord.call_args[0][0])
+        self.assertEqual(4, len(header))
+        callback = chord.return_value.call_args[0][0]
+        self.assertEqual("mutation-1", callback.kwargs["client_mutation_id"])
@@ -0,0 +1,69 @@
+from django.test import TestCase
+
+from contract.signals import append_contract_filter, append_contract_policy_insuree_filter
+from contract.models import Contract
+from contract.tests.helpers import create_test_contract, create_test_contract_details
+from contract.utils import filter_contract_insuree
+from insuree.models import InsureePolicy
+from payment.models import Payment
+
+
+class _InteractiveUser:
+
+    def __init__(self, id, admin):
+        self.id = id
+        self.admin = admin
+
+    def has_perms(self, perms):
+        return self.admin
+
+    def __str__(self):
+        return "(i) contract_filter_user"
+
+
+class ContractFilterTest(TestCase):
+
+    def setUp(self):
+        self.contract = create_test_contract()
+        self.additional_filter = {"contract": f"{self.contract.id}"}
+
+    def test_filters_are_subqueries(self):
+        user = _InteractiveUser(-1, admin=True)
+        # nothing is materialized while building the filters
+        with self.assertNumQueries(0):
+            payment_filter = append_contract_filter(None, user=user, additional_filter=self.additional_filter)
+            insuree_policy_filter = append_contract_policy_insuree_filter(
+                None, user=user, additional_filter=self.additional_filter
+            )
+        self.assertIn("EXISTS", str(Payment.objects.filter(payment_filter).query))
+        self.assertIn("EXISTS", str(InsureePolicy.objects.filter(insuree_policy_filter).query))
+        self.assertEqual(0, Payment.objects.filter(payment_filter).count())
+        self.assertEqual(0, InsureePolicy.objects.filter(insuree_policy_filter).count())
+
+    def test_portal_access_is_cached_for_the_request(self):
+        user = _InteractiveUser(-1, admin=False)
+        # policy holder of the contract and policy holder user lookups
+        with self.assertNumQueries(2):
+            self.assertIsNone(append_contract_filter(None, user=user, additional_filter=self.additional_filter))
+        with self.assertNumQueries(0):
+            self.assertIsNone(append_contract_filter(None, user=user, additional_filter=self.additional_filter))
+            self.assertIsNone(
+                append_contract_policy_insuree_filter(None, user=user, additional_filter=self.additional_filter)
+            )
+
+
+class ContractInsureeFilterTest(TestCase):
+
+    def test_contract_matched_once_per_insuree(self):
+        contract = create_test_contract()
+        contract_details = create_test_contract_details(contract=contract)
+        create_test_contract_details(
+            contract=contract,
+            insuree=contract_details.insuree,
+            contribution_plan_bundle=contract_details.contribution_plan_bundle,
+        )
+        create_test_contract_details(contract=create_test_contract())
+        contracts = Contract.objects.filter(filter_contract_insuree(contract_details.insuree.uuid))
+        self.assertEqual([contract.id], list(contracts.values_list("id", flat=True)))
+        self.assertEqual(1, contracts.count())
+        self.assertNotIn("DISTINCT", str(contracts.query))
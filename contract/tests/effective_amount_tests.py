@@ -0,0 +1,42 @@
+from django.db.models import F
+from django.test import TestCase
+
+from contract.models import Contract
+from contract.tests.helpers import create_test_contract
+from contract.utils import filter_amount_contract
+
+
+class ContractEffectiveAmountTest(TestCase):
+
+    def setUp(self):
+        amounts = {"amount_notified": 100, "amount_rectified": 200, "amount_due": 300}
+        self.draft = create_test_contract(custom_props={"code": "EA-DRAFT", "state": Contract.STATE_DRAFT, **amounts})
+        self.offer = create_test_contract(custom_props={"code": "EA-OFFER", "state": Contract.STATE_OFFER, **amounts})
+        self.effective = create_test_contract(
+            custom_props={"code": "EA-EFFECTIVE", "state": Contract.STATE_EFFECTIVE, **amounts}
+        )
+
+    def test_effective_amount_follows_state(self):
+        for contract in (self.draft, self.offer, self.effective):
+            contract.refresh_from_db()
+            self.assertEqual(contract.amount, contract.effective_amount)
+        self.draft.state = Contract.STATE_EXECUTABLE
+        self.draft.save(username=self.draft.user_updated.username)
+        self.draft.refresh_from_db()
+        self.assertEqual(300, self.draft.effective_amount)
+
+    def test_amount_range_filter(self):
+        codes = ["EA-DRAFT", "EA-OFFER", "EA-EFFECTIVE"]
+        contracts = Contract.objects.filter(code__in=codes)
+        self.assertEqual(
+            ["EA-OFFER"],
+            list(contracts.filter(filter_amount_contract(amount_from=150, amount_to=250)).values_list("code", flat=True)),
+        )
+        self.assertEqual(
+            {"EA-OFFER", "EA-EFFECTIVE"},
+            set(contracts.filter(filter_amount_contract(amount_from=150)).values_list("code", flat=True)),
+        )
+        self.assertEqual(
+            ["EA-EFFECTIVE", "EA-OFFER", "EA-DRAFT"],
+            list(contracts.alias(amount=F("effective_amount")).order_by("-amount").values_list("code", flat=True)),
+        )
@@ -0,0 +1,37 @@
+import io
+
+import pandas as pd
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from contract.tests.helpers import create_test_contract, create_test_contract_details
+from contract.views import EXPORT_HEADERS, send_contract
+
+
+class ContractDetailsExportTest(TestCase):
+
+    def test_export_rows_and_query_count(self):
+        contract = create_test_contract()
+        first = create_test_contract_details(
+            contract=contract, custom_props={"json_ext": {"calculation_rule": {"income": 1000}}}
+        )
+        for _ in range(4):
+            create_test_contract_details(
+                contract=contract,
+                contribution_plan_bundle=first.contribution_plan_bundle,
+                custom_props={"json_ext": {"calculation_rule": {"income": 1000}}},
+            )
+
+        with CaptureQueriesContext(connection) as queries:
+            excel_file = send_contract(contract.id)
+        # details cursor, bundle rates and policy holder insuree incomes
+        self.assertLessEqual(len(queries.captured_queries), 3)
+
+        df = pd.read_excel(io.BytesIO(excel_file))
+        self.assertEqual(EXPORT_HEADERS, list(df.columns))
+        self.assertEqual(5, len(df))
+        self.assertEqual(1000, df["Gross Salary"].iloc[0])
+
+    def test_export_without_details(self):
+        self.assertIsNone(send_contract(create_test_contract().id))
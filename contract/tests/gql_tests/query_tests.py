@@ -629,6 +629,42 @@ class ContractQueryTest(TestCase):
         converted_id = base64.b64decode(result['id']).decode('utf-8').split(':')[1]
         self.assertEqual(UUID(converted_id), id)
 
+    def test_contract_details_custom_field_data_is_batched(self):
+        from contribution_plan.models import ContributionPlanBundleDetails
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        for _ in range(3):
+            create_test_contract_details(
+                contract=self.test_contract,
+                contribution_plan_bundle=self.test_contract_details.contribution_plan_bundle,
+            )
+        query = F'''
+        {{
+            contractDetails(contract_Id: "{self.test_contract.id}") {{
+                edges {{
+                  node {{
+                    id
+                    customFieldData {{
+                      total
+                      employerContribution
+                      salaryShare
+                    }}
+                  }}
+                }}
+          }}
+        }}
+        '''
+        with CaptureQueriesContext(connection) as queries:
+            query_result = self.execute_query(query)
+        bundle_details_table = ContributionPlanBundleDetails._meta.db_table
+        bundle_details_queries = [q for q in queries.captured_queries if bundle_details_table in q['sql']]
+        self.assertEqual(1, len(bundle_details_queries))
+        edges = query_result['contractDetails']['edges']
+        self.assertEqual(4, len(edges))
+        for edge in edges:
+            self.assertIn('employerContribution', edge['node']['customFieldData'])
+
     def find_by_id_query(self, query_type, id, context=None):
         query = F'''
         {{
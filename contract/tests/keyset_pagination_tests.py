@@ -0,0 +1,98 @@
+import datetime
+
+from django.test import TestCase, override_settings
+
+from contract.gql.pagination import (
+    KeysetConnectionField,
+    approximate_count,
+    decode_keyset_cursor,
+    encode_keyset_cursor,
+    keyset_filter,
+    keyset_order,
+    keyset_order_by,
+)
+from contract.gql.gql_types import ContractGQLType
+from contract.models import Contract
+from contract.tests.helpers import create_test_contract
+
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+class KeysetPaginationTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        # nullable columns with NULLs and ties, to page through
+        cls.contracts = [
+            create_test_contract(custom_props={
+                "code": f"KEYSET-{i}",
+                "state": None if i == 3 else i % 2,
+                "date_payment_due": None if i % 3 == 0 else datetime.date(2011, 10, i % 2 + 1),
+            })
+            for i in range(7)
+        ]
+
+    def _queryset(self):
+        return Contract.objects.filter(code__startswith="KEYSET-")
+
+    def test_keyset_order(self):
+        self.assertEqual(["-date_created", "-id"], keyset_order(self._queryset()))
+        self.assertEqual(["code", "id"], keyset_order(self._queryset().order_by("code")))
+        self.assertEqual(["id"], keyset_order(self._queryset().order_by("id")))
+        self.assertEqual(["-state", "code", "-id"], keyset_order(self._queryset().order_by("-state", "code")))
+
+    def test_keyset_filter_matches_cursor(self):
+        with self.assertRaises(ValueError):
+            keyset_filter(Contract, ["-date_created", "-id"], ["d"])
+
+    def test_pages_follow_the_ordering(self):
+        orderings = ([], ["code"], ["-code"], ["date_payment_due"], ["-date_payment_due"], ["state", "-code"])
+        for ordering in orderings:
+            queryset = self._queryset().order_by(*ordering)
+            order = keyset_order(queryset)
+            order_by = keyset_order_by(Contract, order)
+            expected = list(queryset.order_by(*order_by).values_list("id", flat=True))
+            pages, cursor = [], None
+            while True:
+                page = queryset.order_by(*order_by)
+                if cursor:
+                    page = page.filter(keyset_filter(Contract, order, decode_keyset_cursor(cursor)))
+                page = list(page[:3])
+                if not page:
+                    break
+                pages.extend(contract.id for contract in page)
+                cursor = encode_keyset_cursor(page[-1], order)
+            self.assertEqual(expected, pages, ordering)
+            self.assertEqual(7, len(set(pages)), ordering)
+
+    def test_resolve_connection_pages(self):
+        connection = ContractGQLType._meta.connection
+        for ordering in (["-date_payment_due"], ["state", "-code"]):
+            queryset = self._queryset().order_by(*ordering)
+            pages, args = [], {"keyset": True, "first": 3}
+            while True:
+                result = KeysetConnectionField.resolve_connection(connection, args, queryset)
+                pages.extend(edge.node.id for edge in result.edges)
+                self.assertIsNone(result.length)
+                if not result.page_info.has_next_page:
+                    break
+                args = {**args, "after": result.page_info.end_cursor}
+            self.assertEqual(sorted(contract.id for contract in self.contracts), sorted(pages), ordering)
+            self.assertEqual(7, len(pages), ordering)
+
+    @override_settings(CACHES=LOCMEM_CACHE)
+    def test_resolve_connection_counts_on_request(self):
+        connection = ContractGQLType._meta.connection
+        args = {"keyset": True, "first": 2, "approximate_count": True}
+        result = KeysetConnectionField.resolve_connection(connection, args, self._queryset())
+        self.assertEqual(2, len(result.edges))
+        self.assertTrue(result.page_info.has_next_page)
+        self.assertEqual(7, result.length)
+
+    @override_settings(CACHES=LOCMEM_CACHE)
+    def test_approximate_count_is_cached(self):
+        self.assertEqual(7, approximate_count(self._queryset()))
+        create_test_contract(custom_props={"code": "KEYSET-NEW"})
+        with self.assertNumQueries(0):
+            self.assertEqual(7, approximate_count(self._queryset().order_by("code")))
+        self.assertEqual(1, approximate_count(self._queryset().filter(code="KEYSET-NEW")))
@@ -0,0 +1,47 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from contract.utils import LocationDepartmentIndex
+
+
+class _StubLocationIndex(LocationDepartmentIndex):
+
+    def __init__(self, tree, **kwargs):
+        super().__init__(**kwargs)
+        self.tree = tree
+        self.loads = 0
+
+    def _load(self):
+        self.loads += 1
+        return dict(self.tree)
+
+
+class LocationDepartmentIndexTest(SimpleTestCase):
+
+    def test_department_code_is_cached(self):
+        index = _StubLocationIndex({1: (None, "R", "Bouenza"), 2: (1, "D", "Madingou")})
+        self.assertEqual("BOA", index.department_code(2))
+        self.assertEqual("BOA", index.department_code(2))
+        self.assertEqual(1, index.loads)
+
+    def test_miss_is_not_cached(self):
+        # the department of the location is created later (e.g. by another worker)
+        index = _StubLocationIndex({2: (1, "D", "Madingou")})
+        self.assertIsNone(index.department_code(2))
+        index.tree[1] = (None, "R", "Bouenza")
+        self.assertEqual("BOA", index.department_code(2))
+
+    def test_renamed_region_is_seen_after_ttl(self):
+        # the region is renamed by another process, without the local signal
+        index = _StubLocationIndex({1: (None, "R", "Bouenza"), 2: (1, "D", "Madingou")}, ttl=60)
+        with mock.patch("contract.utils.time.monotonic", return_value=1000):
+            self.assertEqual("BOA", index.department_code(2))
+        index.tree[1] = (None, "R", "Brazzaville")
+        with mock.patch("contract.utils.time.monotonic", return_value=1030):
+            self.assertEqual("BOA", index.department_code(2))
+            self.assertEqual(["Madingou", "Bouenza"], index.names(2))
+        with mock.patch("contract.utils.time.monotonic", return_value=1060):
+            self.assertEqual("BZV", index.department_code(2))
+            self.assertEqual(["Madingou", "Brazzaville"], index.names(2))
+        self.assertEqual(2, index.loads)
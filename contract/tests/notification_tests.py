@@ -0,0 +1,123 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from django.core import mail
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from contract.models import ContractNotification
+from contract.notifications import (
+    NOTIFICATION_BUILDERS,
+    NOTIFICATION_MAX_ATTEMPTS,
+    build_payment_email,
+    enqueue_payment_notification,
+    send_pending_notifications,
+)
+from contract.tests.helpers import create_test_contract
+from core import datetime
+
+FILE_EMAIL_BACKEND = "django.core.mail.backends.filebased.EmailBackend"
+
+
+@mock.patch("contract.views.send_contract", return_value=b"xlsx")
+@mock.patch("contract.email_report.generate_report_for_employee_declaration", return_value=b"pdf")
+class ContractNotificationOutboxTest(TestCase):
+
+    def setUp(self):
+        self.email_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.email_dir.cleanup)
+        self.contract = create_test_contract()
+        self.contract.policy_holder.email = "employer@example.com"
+
+    def _enqueue(self, count=1):
+        with mock.patch("contract.tasks.send_contract_notifications.delay") as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                notifications = [
+                    enqueue_payment_notification(self.contract, datetime.datetime.now())
+                    for _ in range(count)
+                ]
+        self.assertEqual(count, delay.call_count)
+        return notifications
+
+    def _sent_files(self):
+        return os.listdir(self.email_dir.name)
+
+    def test_enqueue_only_writes_the_outbox(self, generate_report, send_contract):
+        notification = self._enqueue()[0]
+        self.assertEqual(ContractNotification.STATUS_PENDING, notification.status)
+        generate_report.assert_not_called()
+        send_contract.assert_not_called()
+
+    def test_batch_is_sent_over_one_connection(self, generate_report, send_contract):
+        self._enqueue(5)
+        with override_settings(EMAIL_BACKEND=FILE_EMAIL_BACKEND, EMAIL_FILE_PATH=self.email_dir.name):
+            with mock.patch("contract.notifications.get_connection", wraps=mail.get_connection) as get_connection:
+                sent = send_pending_notifications(batch_size=10)
+        self.assertEqual(5, sent)
+        self.assertEqual(1, get_connection.call_count)
+        # the file backend writes the messages of a connection to one file
+        self.assertEqual(1, len(self._sent_files()))
+        self.assertEqual(
+            5, ContractNotification.objects.filter(status=ContractNotification.STATUS_SENT).count()
+        )
+        self.assertEqual(0, send_pending_notifications())
+
+    def test_interleaved_workers_send_each_email_once(self, generate_report, send_contract):
+        self._enqueue(3)
+        second_worker = []
+
+        def build_with_second_worker(notification, connection=None):
+            # a second worker runs while the first one sends its batch
+            if not second_worker:
+                second_worker.append(send_pending_notifications(batch_size=10))
+            return build_payment_email(notification, connection=connection)
+
+        builders = {ContractNotification.TYPE_APPROVED_PAYMENT: build_with_second_worker}
+        with mock.patch.dict(NOTIFICATION_BUILDERS, builders):
+            first_worker = send_pending_notifications(batch_size=10)
+        self.assertEqual(3, first_worker)
+        self.assertEqual([0], second_worker)
+        self.assertEqual(3, len(mail.outbox))
+
+    def test_expired_claim_is_sent_again(self, generate_report, send_contract):
+        notification = self._enqueue()[0]
+        # claimed by a worker that crashed
+        ContractNotification.objects.filter(id=notification.id).update(
+            status=ContractNotification.STATUS_SENDING, attempts=1, claimed_until=timezone.now()
+        )
+        self.assertEqual(1, send_pending_notifications())
+        notification.refresh_from_db()
+        self.assertEqual(ContractNotification.STATUS_SENT, notification.status)
+        self.assertIsNone(notification.claimed_until)
+
+    def test_failed_notification_is_retried_then_failed(self, generate_report, send_contract):
+        notification = self._enqueue()[0]
+        generate_report.side_effect = ValueError("report failed")
+        with override_settings(EMAIL_BACKEND=FILE_EMAIL_BACKEND, EMAIL_FILE_PATH=self.email_dir.name):
+            for _ in range(NOTIFICATION_MAX_ATTEMPTS):
+                self.assertEqual(0, send_pending_notifications())
+        notification.refresh_from_db()
+        self.assertEqual(ContractNotification.STATUS_FAILED, notification.status)
+        self.assertEqual(NOTIFICATION_MAX_ATTEMPTS, notification.attempts)
+        self.assertEqual("report failed", notification.last_error)
+
+
+class ContractNotificationBenchmark(TestCase):
+
+    @unittest.skipUnless(os.environ.get("CONTRACT_BENCHMARK"), "set CONTRACT_BENCHMARK=1 to run benchmarks")
+    def test_benchmark_approval_notification_latency(self):
+        contract = create_test_contract()
+        with tempfile.TemporaryDirectory() as email_dir, override_settings(
+            EMAIL_BACKEND=FILE_EMAIL_BACKEND, EMAIL_FILE_PATH=email_dir
+        ):
+            with mock.patch("contract.tasks.send_contract_notifications.delay"):
+                start = time.perf_counter()
+                notification = enqueue_payment_notification(contract, datetime.datetime.now())
+                enqueued = time.perf_counter() - start
+            start = time.perf_counter()
+            build_payment_email(notification).send()
+            inline = time.perf_counter() - start
+        print(f"approval notification : enqueue {enqueued * 1000:.1f}ms, inline render and send {inline * 1000:.1f}ms")
@@ -0,0 +1,114 @@
+import datetime
+from types import SimpleNamespace
+from unittest import mock
+
+from contribution_plan.tests.helpers import create_test_contribution_plan
+from django.test import TestCase
+from insuree.test_helpers import create_test_insuree
+from payment.models import Payment, PaymentDetail
+from policy.test_helpers import create_test_policy
+from product.test_helpers import create_test_product
+
+from contract.models import Contract
+from contract.signals import activate_contracted_policies, activate_paid_contracts, payment_contract_summary
+from contract.tests.helpers import (
+    create_test_contract,
+    create_test_contract_contribution_plan_details,
+    create_test_contract_details,
+)
+
+
+class PaymentActivationGuardTest(TestCase):
+
+    def _payment(self, expected_amount, received_amount):
+        return SimpleNamespace(id=1, expected_amount=expected_amount, received_amount=received_amount)
+
+    @mock.patch("contract.tasks.activate_contracted_policies_async")
+    def test_unpaid_payment_is_skipped(self, task):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            activate_contracted_policies(None, self._payment(1000, 500))
+            activate_contracted_policies(None, self._payment(1000, None))
+        self.assertEqual([], callbacks)
+        task.delay.assert_not_called()
+
+    @mock.patch("contract.tasks.activate_contracted_policies_async")
+    def test_unrelated_partial_update_is_skipped(self, task):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            activate_contracted_policies(None, self._payment(1000, 1000), update_fields={"status"})
+        self.assertEqual([], callbacks)
+
+    @mock.patch("contract.tasks.activate_contracted_policies_async")
+    def test_paid_payment_is_deferred_to_task(self, task):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            activate_contracted_policies(
+                None, self._payment(1000, 1000), update_fields={"received_amount"}
+            )
+        self.assertEqual(1, len(callbacks))
+        task.delay.assert_called_once_with(1)
+
+    def test_summary_of_payment_without_contract(self):
+        create_test_contract()
+        with self.assertNumQueries(1):
+            contracts, payment_detail_count = payment_contract_summary(0)
+        self.assertEqual([], contracts)
+        self.assertEqual(0, payment_detail_count)
+
+
+class PaymentContractSummaryTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.executable_contract = create_test_contract(custom_props={"state": Contract.STATE_EXECUTABLE})
+        cls.effective_contract = create_test_contract(custom_props={"state": Contract.STATE_EFFECTIVE})
+        cls.payment = Payment.objects.create(
+            expected_amount=3000,
+            request_date=datetime.date(2021, 1, 1),
+            status=Payment.STATUS_CREATED,
+            audit_user_id=-1,
+        )
+        policy = create_test_policy(product=create_test_product("CTPAY"), insuree=create_test_insuree())
+        # each ccpd premium of both contracts is paid by a detail of the payment
+        for contract, periodicity, ccpd_count in (
+            (cls.executable_contract, 1, 2),
+            (cls.effective_contract, 3, 1),
+        ):
+            contribution_plan = create_test_contribution_plan(custom_props={"periodicity": periodicity})
+            for _ in range(ccpd_count):
+                ccpd = create_test_contract_contribution_plan_details(
+                    contribution_plan=contribution_plan,
+                    policy=policy,
+                    contract_details=create_test_contract_details(contract=contract),
+                )
+                PaymentDetail.objects.create(
+                    payment=cls.payment,
+                    premium=ccpd.contribution,
+                    expected_amount=1000,
+                    audit_user_id=-1,
+                )
+
+    def test_summary_per_contract(self):
+        with self.assertNumQueries(2):
+            contracts, payment_detail_count = payment_contract_summary(self.payment.id)
+        self.assertEqual(
+            sorted([
+                (self.executable_contract.id, Contract.STATE_EXECUTABLE, 2, 1),
+                (self.effective_contract.id, Contract.STATE_EFFECTIVE, 1, 3),
+            ]),
+            sorted(
+                (
+                    contract["contract_details__contract_id"],
+                    contract["contract_details__contract__state"],
+                    contract["ccpd_count"],
+                    contract["periodicity"],
+                )
+                for contract in contracts
+            ),
+        )
+        self.assertEqual(3, payment_detail_count)
+
+    def test_only_executable_contract_is_activated(self):
+        self.assertEqual([self.executable_contract.id], activate_paid_contracts(self.payment.id))
+
+    def test_partially_paid_contracts_are_not_activated(self):
+        PaymentDetail.objects.filter(payment=self.payment).first().delete()
+        self.assertEqual([], activate_paid_contracts(self.payment.id))
@@ -0,0 +1,75 @@
+import re
+import unittest
+
+from django.db import connection
+from django.test import TestCase
+
+from contract.models import Contract, ContractContributionPlanDetails, ContractDetails, ContractPolicy
+from contract.tests.helpers import create_test_contract, create_test_contract_details
+from contract.utils import filter_amount_contract
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "query plans are checked on PostgreSQL")
+class ContractQueryPlanTest(TestCase):
+    """
+    EXPLAIN of the hot contract queries. The test database is too small for the
+    planner to prefer an index on its own, so sequential scans are disabled for
+    the test transaction: a query still planned with a sequential scan has no
+    usable index.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.contract = create_test_contract(custom_props={"code": "PLAN-CONTRACT"})
+        cls.contract_details = create_test_contract_details(contract=cls.contract)
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def assertNoSeqScan(self, queryset, table):
+        plan = queryset.explain()
+        self.assertNotIn(f'Seq Scan on "{table}"', plan, msg=plan)
+
+    def assertIndexCond(self, queryset, column):
+        # a full scan of an unrelated index would also pass assertNoSeqScan
+        plan = queryset.explain()
+        self.assertRegex(plan, re.compile(rf'Index Cond: \(+"{column}" [<>]='), msg=plan)
+
+    def test_contract_queries(self):
+        self.assertNoSeqScan(
+            Contract.objects.filter(policy_holder_id=self.contract.policy_holder_id, is_deleted=False)
+            .order_by("-date_created"),
+            "tblContract",
+        )
+        self.assertNoSeqScan(Contract.objects.filter(code="PLAN-CONTRACT", is_deleted=False), "tblContract")
+        self.assertNoSeqScan(
+            Contract.objects.filter(state=Contract.STATE_EFFECTIVE, date_valid_to__lt=self.contract.date_created),
+            "tblContract",
+        )
+        self.assertIndexCond(
+            Contract.objects.filter(filter_amount_contract(amount_from=100)),
+            "EffectiveAmount",
+        )
+        self.assertIndexCond(
+            Contract.objects.filter(filter_amount_contract(amount_from=100, amount_to=1000)),
+            "EffectiveAmount",
+        )
+
+    def test_contract_details_queries(self):
+        self.assertNoSeqScan(
+            ContractDetails.objects.filter(contract_id=self.contract.id, is_confirmed=True, is_deleted=False),
+            "tblContractDetails",
+        )
+
+    def test_ccpd_queries(self):
+        self.assertNoSeqScan(
+            ContractContributionPlanDetails.objects.filter(
+                contract_details_id=self.contract_details.id, is_deleted=False
+            ),
+            "tblContractContributionPlanDetails",
+        )
+        self.assertNoSeqScan(ContractContributionPlanDetails.objects.filter(policy_id=1), "tblContractContributionPlanDetails")
+
+    def test_contract_policy_queries(self):
+        self.assertNoSeqScan(ContractPolicy.objects.filter(contract_id=self.contract.id), "tblContractPolicy")
@@ -0,0 +1,61 @@
+from unittest import mock
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from contract.models import ContractDetails
+from contract.salary_upload import XLS_SIGNATURE, SalaryUpload, count_salary_rows, iter_salary_chunks
+from contract.tests.helpers import create_test_contract, create_test_contract_details
+
+
+class SalaryUploadTest(TestCase):
+
+    def _csv(self, rows):
+        lines = ["Assuré;Numéro CAMU temporaire;Gross Salary"]
+        lines += [f"{name};{chf_id};{salary}" for name, chf_id, salary in rows]
+        return "\n".join(lines).encode("utf-8")
+
+    def test_csv_rows_are_read_in_chunks(self):
+        file_data = self._csv([("A B", f"{i:09d}", 1000 + i) for i in range(5)])
+        chunks = list(iter_salary_chunks(file_data, chunk_size=2))
+        self.assertEqual([2, 2, 1], [len(chunk) for chunk in chunks])
+        self.assertEqual("000000000", chunks[0][0]["Numéro CAMU temporaire"])
+        self.assertEqual(5, count_salary_rows(file_data))
+
+    def test_legacy_xls_is_read_with_pandas(self):
+        import pandas as pd
+
+        sheet = pd.DataFrame(
+            {" Assuré ": ["A B", None], "Numéro CAMU temporaire": ["000000001", None], "Gross Salary": [1500, None]}
+        )
+        with mock.patch("pandas.read_excel", return_value=sheet) as read_excel:
+            rows = [row for chunk in iter_salary_chunks(XLS_SIGNATURE + b"\0" * 504) for row in chunk]
+        read_excel.assert_called_once()
+        self.assertEqual(1, len(rows))
+        self.assertEqual("A B", rows[0]["Assuré"])
+        self.assertEqual(1500, rows[0]["Gross Salary"])
+
+    def test_salaries_are_updated_per_chunk(self):
+        contract = create_test_contract(custom_props={"use_bundle_contribution_plan_amount": False})
+        details = [
+            create_test_contract_details(
+                contract=contract, custom_props={"json_ext": {"calculation_rule": {"income": 100}}}
+            )
+            for _ in range(3)
+        ]
+        rows = [("A B", detail.insuree.chf_id, 2500) for detail in details]
+        rows.append(("A B", details[0].insuree.chf_id, 9999))  # duplicate, ignored
+        rows.append(("A B", "UNKNOWN", 2500))
+        upload = SalaryUpload(contract, contract.policy_holder, None, details[0].user_created)
+
+        chunk = next(iter_salary_chunks(self._csv(rows)))
+        with CaptureQueriesContext(connection) as queries:
+            upload.process_chunk(chunk)
+        # details lookup, user lookup, bulk update and bulk history insert
+        self.assertLessEqual(len(queries.captured_queries), 4)
+
+        self.assertEqual(3, upload.total_salaries_updated)
+        self.assertEqual(1, upload.total_validation_errors)
+        for detail in ContractDetails.objects.filter(contract=contract):
+            self.assertEqual(2500, detail.json_ext["calculation_rule"]["income"])
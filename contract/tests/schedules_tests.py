@@ -0,0 +1,96 @@
+import datetime
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase
+
+from contract.schedules import ProductSchedule, ProductScheduleCache
+
+
+def _product(insurance_period=1, policy_waiting_period=None, config_data=None, product_id=1):
+    return SimpleNamespace(
+        id=product_id,
+        validity_from=datetime.datetime(2024, 1, 1),
+        insurance_period=insurance_period,
+        policy_waiting_period=policy_waiting_period,
+        config_data=config_data,
+    )
+
+
+CONFIG = {
+    "PaymentEndDate": "2024-11-05",
+    "paymentEndDate": "2024-11-05",
+    "declarationStartDate": "2024-10-20",
+    "declarationEndDate": "2024-11-05",
+}
+
+
+class ProductScheduleTest(SimpleTestCase):
+
+    def test_policy_start_day(self):
+        self.assertEqual(6, ProductSchedule(_product(config_data=CONFIG)).policy_start_day)
+        self.assertEqual(6, ProductSchedule(_product()).policy_start_day)
+        config = {"PaymentEndDate": "2024-11-14"}
+        self.assertEqual(15, ProductSchedule(_product(config_data=config)).policy_start_day)
+
+    def test_policy_windows(self):
+        start = datetime.date(2024, 1, 1)
+        monthly = ProductSchedule(_product(1, config_data=CONFIG))
+        self.assertEqual(
+            (datetime.date(2024, 2, 6), datetime.date(2024, 3, 5)), monthly.policy_window(start)
+        )
+        quarterly = ProductSchedule(_product(3, config_data=CONFIG))
+        self.assertEqual(
+            (datetime.date(2024, 4, 6), datetime.date(2024, 7, 5)), quarterly.policy_window(start)
+        )
+        self.assertEqual(
+            (datetime.date(2024, 2, 6), datetime.date(2024, 6, 5)),
+            quarterly.policy_window(start, parent=True),
+        )
+        yearly = ProductSchedule(_product(12, policy_waiting_period=4, config_data=CONFIG))
+        self.assertEqual(
+            (datetime.date(2024, 5, 6), datetime.date(2025, 5, 5)), yearly.policy_window(start)
+        )
+        self.assertEqual(
+            (datetime.date(2024, 3, 6), datetime.date(2025, 3, 5)),
+            yearly.policy_window(start, has_other_contracts=True),
+        )
+        self.assertEqual(
+            [monthly.policy_window(start), monthly.policy_window(datetime.date(2024, 3, 5))],
+            monthly.policy_windows([start, datetime.date(2024, 3, 5)]),
+        )
+
+    def test_declaration_window(self):
+        schedule = ProductSchedule(_product(config_data=CONFIG))
+        # period spanning two months: 20th to the 5th of the next month
+        self.assertEqual(
+            (datetime.date(2025, 12, 20), datetime.date(2026, 1, 5)),
+            schedule.declaration_window(datetime.date(2025, 12, 25)),
+        )
+        self.assertEqual(
+            (datetime.date(2025, 12, 20), datetime.date(2026, 1, 5)),
+            schedule.declaration_window(datetime.date(2026, 1, 3)),
+        )
+        in_month = ProductSchedule(_product(config_data={
+            "declarationStartDate": "2024-10-01", "declarationEndDate": "2024-10-31",
+        }))
+        self.assertEqual(
+            (datetime.date(2025, 2, 1), datetime.date(2025, 2, 28)),
+            in_month.declaration_window(datetime.date(2025, 2, 10)),
+        )
+        self.assertIsNone(ProductSchedule(_product()).declaration_window(datetime.date(2025, 2, 10)))
+
+    def test_payment_due(self):
+        schedule = ProductSchedule(_product(config_data=CONFIG))
+        self.assertEqual(datetime.date(2025, 1, 5), schedule.payment_due(datetime.date(2024, 12, 1)))
+        self.assertIsNone(ProductSchedule(_product()).payment_due(datetime.date(2024, 12, 1)))
+
+    def test_cache_compiles_once_per_version(self):
+        cache = ProductScheduleCache()
+        product = _product(config_data=CONFIG)
+        schedule = cache.get(product)
+        self.assertIs(schedule, cache.get(product))
+        product.validity_from = datetime.datetime(2024, 6, 1)
+        self.assertIsNot(schedule, cache.get(product))
+        new_version = cache.get(product)
+        cache.invalidate()
+        self.assertIsNot(new_version, cache.get(product))
@@ -1 +1,6 @@
-from .services_tests import *
\ No newline at end of file
+from .services_tests import *
+from .code_allocator_tests import *
+from .forfait_distribution_tests import *
+from .valuation_engine_tests import *
+from .percentage_calculator_tests import *
+from .policy_coverage_tests import *
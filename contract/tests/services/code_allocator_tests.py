@@ -0,0 +1,81 @@
+import datetime
+import threading
+import unittest
+from unittest import mock
+
+from django.db import connection, connections
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from contract.models import Contract, ContractCodeCounter
+from contract.services import allocate_contract_codes
+from contract.tests.helpers import create_test_contract
+
+
+class ContractCodeAllocatorTest(TransactionTestCase):
+    department_code = "BZV"
+    date = datetime.date(2025, 3, 1)
+
+    def test_reserved_codes_are_consecutive(self):
+        first = allocate_contract_codes(self.department_code, self.date)
+        batch = allocate_contract_codes(self.department_code, self.date, count=3)
+        self.assertEqual(first, ["DBZV032025000001"])
+        self.assertEqual(batch, ["DBZV032025000002", "DBZV032025000003", "DBZV032025000004"])
+
+    def test_counters_are_independent_per_department_and_month(self):
+        allocate_contract_codes(self.department_code, self.date, count=5)
+        self.assertEqual(
+            allocate_contract_codes("PNR", self.date), ["DPNR032025000001"]
+        )
+        self.assertEqual(
+            allocate_contract_codes(self.department_code, datetime.date(2025, 4, 1)),
+            ["DBZV042025000001"],
+        )
+
+    def test_concurrent_allocation_returns_unique_codes(self):
+        workers, calls_per_worker = 8, 25
+        codes = []
+        lock = threading.Lock()
+
+        def worker():
+            try:
+                for _ in range(calls_per_worker):
+                    reserved = allocate_contract_codes(self.department_code, self.date)
+                    with lock:
+                        codes.extend(reserved)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(codes), workers * calls_per_worker)
+        self.assertEqual(len(set(codes)), len(codes))
+        self.assertEqual(
+            ContractCodeCounter.objects.get(department_code=self.department_code).last_value,
+            workers * calls_per_worker,
+        )
+
+    def test_row_lock_fallback_of_other_backends(self):
+        allocate_contract_codes(self.department_code, self.date)
+        with mock.patch.object(connection, "vendor", "microsoft"):
+            self.assertEqual(
+                allocate_contract_codes(self.department_code, self.date, count=2),
+                ["DBZV032025000002", "DBZV032025000003"],
+            )
+            self.assertEqual(allocate_contract_codes("PNR", self.date), ["DPNR032025000001"])
+        self.assertEqual(allocate_contract_codes(self.department_code, self.date), ["DBZV032025000004"])
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "single upsert on PostgreSQL only")
+    def test_allocation_cost_does_not_depend_on_contract_table_size(self):
+        with CaptureQueriesContext(connection) as empty_table:
+            allocate_contract_codes(self.department_code, self.date)
+        for _ in range(50):
+            create_test_contract(custom_props={"code": f"DBZV032025{Contract.objects.count():06d}"})
+        with CaptureQueriesContext(connection) as filled_table:
+            allocate_contract_codes(self.department_code, self.date)
+        self.assertEqual(len(empty_table.captured_queries), 1)
+        self.assertEqual(len(filled_table.captured_queries), 1)
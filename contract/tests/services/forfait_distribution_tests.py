@@ -0,0 +1,71 @@
+import os
+import time
+import unittest
+
+from django.test import TestCase
+
+from contract.bulk_utils import bulk_create_history_objects
+from contract.calculations import distribute_forfait_amount, split_amount
+from contract.models import ContractDetails
+from contract.tests.helpers import create_test_contract, create_test_contract_details
+
+
+class SplitAmountTest(unittest.TestCase):
+
+    def test_shares_sum_to_amount(self):
+        for amount, parts in [(100, 3), (1, 7), (0, 4), (999999, 50000), (10, 10)]:
+            shares = split_amount(amount, parts)
+            self.assertEqual(len(shares), parts)
+            self.assertEqual(sum(shares), amount)
+            self.assertLessEqual(max(shares) - min(shares), 1)
+
+    def test_remainder_goes_to_first_shares(self):
+        self.assertEqual(split_amount(100, 3), [34, 33, 33])
+        self.assertEqual(split_amount(11, 4), [3, 3, 3, 2])
+
+    def test_no_parts(self):
+        self.assertEqual(split_amount(100, 0), [])
+
+
+class DistributeForfaitAmountTest(TestCase):
+
+    def _create_details(self, count):
+        template = create_test_contract_details(contract=create_test_contract())
+        details = [
+            ContractDetails(
+                contract_id=template.contract_id,
+                insuree_id=template.insuree_id,
+                contribution_plan_bundle_id=template.contribution_plan_bundle_id,
+                json_ext={},
+            )
+            for _ in range(count - 1)
+        ]
+        bulk_create_history_objects(ContractDetails, details, template.user_created.username)
+        return template.contract_id
+
+    def test_distribution_is_persisted_with_history(self):
+        contract_id = self._create_details(7)
+        details = list(ContractDetails.objects.filter(contract_id=contract_id).order_by("date_created", "id"))
+        history_before = ContractDetails.history.filter(contract_id=contract_id).count()
+
+        # user lookup, one bulk update and one bulk history insert
+        with self.assertNumQueries(3):
+            shares = distribute_forfait_amount(details, 1000, details[0].user_created.username)
+
+        stored = ContractDetails.objects.filter(contract_id=contract_id)
+        self.assertEqual(sum(shares), 1000)
+        self.assertEqual(sum(cd.json_ext["forfait_rule"]["total"] for cd in stored), 1000)
+        self.assertTrue(all(cd.is_confirmed for cd in stored))
+        self.assertEqual(
+            ContractDetails.history.filter(contract_id=contract_id).count(), history_before + 7
+        )
+
+    @unittest.skipUnless(os.environ.get("CONTRACT_BENCHMARK"), "set CONTRACT_BENCHMARK=1 to run benchmarks")
+    def test_benchmark(self):
+        for count in (1000, 10000, 50000):
+            contract_id = self._create_details(count)
+            details = list(ContractDetails.objects.filter(contract_id=contract_id))
+            start = time.perf_counter()
+            distribute_forfait_amount(details, 12345678, details[0].user_created.username)
+            elapsed = time.perf_counter() - start
+            print(f"distribute_forfait_amount : {count} details in {elapsed:.2f}s")
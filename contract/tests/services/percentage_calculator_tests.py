@@ -0,0 +1,69 @@
+import os
+import random
+import time
+import unittest
+
+import numpy as np
+
+from contract.calculations import (
+    custom_round_array,
+    percentage_contribution,
+    percentage_contributions,
+)
+from contract.utils import custom_round
+
+
+def scalar_percentage_contribution(ei, ercp, eecp):
+    # row by row rule as it was implemented before the vectorized calculator
+    employer_contribution = (ei * ercp / 100) if ercp and ei is not None else 0.0
+    salary_share = (ei * eecp / 100) if eecp and ei is not None else 0.0
+    total = salary_share + employer_contribution
+    return {
+        "total": custom_round(total),
+        "employerContribution": custom_round(employer_contribution),
+        "salaryShare": custom_round(salary_share),
+    }
+
+
+class PercentageCalculatorTest(unittest.TestCase):
+
+    def test_custom_round_parity(self):
+        values = [28294.63, 7355.257, 8075.931500000001, 0.5, 0.49, -1.5, -1.4, 0.0, 12.0, -0.05]
+        rng = random.Random(42)
+        values += [rng.uniform(-1e6, 1e6) for _ in range(10000)]
+        self.assertEqual(custom_round_array(values).tolist(), [custom_round(v) for v in values])
+
+    def test_contribution_parity(self):
+        rng = random.Random(7)
+        incomes = [float(rng.randint(0, 5000000)) for _ in range(5000)] + [0.0, 150000.0]
+        rates = [(rng.choice([0, 4, 4.5, 8, 12.25]), rng.choice([0, 2.5, 4, 6.2])) for _ in incomes]
+        result = percentage_contributions(incomes, [r[0] for r in rates], [r[1] for r in rates])
+        for i, (income, (ercp, eecp)) in enumerate(zip(incomes, rates)):
+            expected = scalar_percentage_contribution(income, ercp, eecp)
+            self.assertEqual(
+                expected,
+                {key: int(column[i]) for key, column in result.items()},
+            )
+            self.assertEqual(expected, percentage_contribution(income, ercp, eecp))
+
+    def test_single_row(self):
+        self.assertEqual(
+            percentage_contribution(100000, 8, 4),
+            {"total": 12000, "employerContribution": 8000, "salaryShare": 4000},
+        )
+
+    @unittest.skipUnless(os.environ.get("CONTRACT_BENCHMARK"), "set CONTRACT_BENCHMARK=1 to run benchmarks")
+    def test_benchmark(self):
+        size = 200000
+        incomes = np.random.default_rng(1).integers(0, 5000000, size).astype(float)
+        start = time.perf_counter()
+        for income in incomes.tolist():
+            scalar_percentage_contribution(income, 8, 4)
+        scalar_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        percentage_contributions(incomes, 8, 4)
+        vector_elapsed = time.perf_counter() - start
+        print(
+            f"percentage_contributions : {size} rows scalar {scalar_elapsed:.3f}s "
+            f"vectorized {vector_elapsed:.3f}s ({size / vector_elapsed:.0f} rows/s)"
+        )
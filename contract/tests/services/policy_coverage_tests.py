@@ -0,0 +1,89 @@
+import datetime
+
+from django.test import TestCase
+
+from contract.services import _PolicyCoverageIndex
+from insuree.test_helpers import create_test_insuree
+from policy.models import Policy
+from policy.test_helpers import create_test_policy
+from product.test_helpers import create_test_product
+
+
+class PolicyCoverageIndexTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.insuree = create_test_insuree()
+        cls.product = create_test_product("CTCOV")
+        cls.policies = [
+            create_test_policy(
+                cls.product,
+                cls.insuree,
+                custom_props={
+                    "start_date": datetime.date(2021, month, 1),
+                    "expiry_date": datetime.date(2021, month + 2, 1),
+                },
+            )
+            for month in (7, 1, 4)
+        ]
+
+    def _index(self, date_valid_from, date_valid_to):
+        return _PolicyCoverageIndex(
+            insurees=[self.insuree],
+            products=[self.product],
+            date_valid_from=date_valid_from,
+            date_valid_to=date_valid_to,
+        )
+
+    def test_lookup_matches_database_filter(self):
+        with self.assertNumQueries(1):
+            index = self._index(datetime.date(2021, 1, 1), datetime.date(2021, 12, 31))
+        for date_valid_from, date_valid_to in [
+            (datetime.date(2021, 2, 15), datetime.date(2021, 5, 1)),
+            (datetime.date(2021, 6, 1), datetime.date(2021, 6, 30)),
+            (datetime.datetime(2021, 3, 1), datetime.datetime(2021, 7, 1)),
+        ]:
+            expected = list(
+                Policy.objects.filter(
+                    product=self.product,
+                    family__head_insuree=self.insuree,
+                    start_date__lte=date_valid_to,
+                    expiry_date__gte=date_valid_from,
+                ).order_by("start_date")
+            )
+            with self.assertNumQueries(0):
+                covering = index.covering(self.insuree, self.product, date_valid_from, date_valid_to)
+            self.assertEqual(expected, covering)
+
+    def test_added_policies_are_sorted(self):
+        index = self._index(datetime.date(2021, 1, 1), datetime.date(2021, 12, 31))
+        generated = Policy(
+            family=self.insuree.family,
+            product=self.product,
+            start_date=datetime.date(2021, 5, 15),
+            expiry_date=datetime.date(2021, 6, 15),
+        )
+        index.add(self.insuree, generated)
+        covering = index.covering(
+            self.insuree, self.product, datetime.date(2021, 1, 1), datetime.date(2021, 12, 31)
+        )
+        self.assertEqual(
+            sorted(policy.start_date for policy in covering),
+            [policy.start_date for policy in covering],
+        )
+        self.assertIn(generated, covering)
+
+    def test_member_policy_covers_the_head(self):
+        index = self._index(datetime.date(2021, 1, 1), datetime.date(2021, 12, 31))
+        member = create_test_insuree(with_family=False, custom_props={"family": self.insuree.family})
+        generated = Policy(
+            family=member.family,
+            product=self.product,
+            start_date=datetime.date(2021, 10, 1),
+            expiry_date=datetime.date(2021, 12, 1),
+        )
+        index.add(member, generated)
+        covering = index.covering(
+            self.insuree, self.product, datetime.date(2021, 10, 15), datetime.date(2021, 11, 15)
+        )
+        self.assertEqual([generated], covering)
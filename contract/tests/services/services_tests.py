@@ -1,13 +1,20 @@
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from contract.services import Contract as ContractService, ContractDetails as ContractDetailsService, \
-    ContractContributionPlanDetails as ContractContributionPlanDetailsService
-from contract.models import Contract, ContractDetails, ContractContributionPlanDetails
+    ContractContributionPlanDetails as ContractContributionPlanDetailsService, PaymentService, \
+    set_waiting_period_for_insurees, terminate_expired_contracts
+from contract.models import Contract, ContractDetails, ContractContributionPlanDetails, InsureeWaitingPeriod, \
+    ContractPolicy
 from core.test_helpers import create_test_technical_user
-from policyholder.tests.helpers import create_test_policy_holder, create_test_policy_holder_insuree
+from policyholder.tests.helpers import create_test_policy_holder, create_test_policy_holder_insuree, \
+    create_test_policy_holder_contribution_plan
 from contribution_plan.tests.helpers import create_test_contribution_plan, \
     create_test_contribution_plan_bundle, create_test_contribution_plan_bundle_details
 from policy.test_helpers import create_test_policy
 from core.models import User
+from policyholder.models import PolicyHolderInsuree
+from contract.tests.helpers import create_test_contract
 from calculation.services import get_parameters, get_rule_details, get_rule_name, get_linked_class
 
 
@@ -296,6 +303,225 @@ class ServiceTestContract(TestCase):
         )
 
 
+    def test_update_from_ph_insuree_bulk(self):
+        from core import datetime
+        contract = Contract(
+            code="MTEST-BULK",
+            policy_holder=self.policy_holder,
+            date_valid_from=datetime.datetime(2021, 1, 1),
+            date_valid_to=datetime.datetime(2023, 6, 30),
+        )
+        contract.save(username=self.user.username)
+        contract_details = {
+            "contract_id": contract.id,
+            "policy_holder_id": str(self.policy_holder.id),
+            "amendment": 0,
+        }
+        # contract, policy holder insurees, user, details insert and history insert
+        with self.assertNumQueries(5):
+            response = self.contract_details_service.update_from_ph_insuree(
+                contract_details=contract_details
+            )
+        created = ContractDetails.objects.filter(contract_id=contract.id)
+        history_count = ContractDetails.history.filter(contract_id=contract.id).count()
+        created_count = created.count()
+        # tear down the test data
+        created.delete()
+        Contract.objects.filter(id=contract.id).delete()
+
+        self.assertTrue(response["success"])
+        self.assertEqual(self.number_of_insuree, len(response["data"]))
+        self.assertEqual(self.number_of_insuree, created_count)
+        self.assertEqual(self.number_of_insuree, history_count)
+        self.assertEqual(str(contract.date_valid_from), str(response["data"][0]["contract_date_valid_from"]))
+
+
+    def test_set_waiting_period_for_insurees(self):
+        policy_holder_contribution_plan = create_test_policy_holder_contribution_plan(
+            policy_holder=self.policy_holder,
+            contribution_plan_bundle=self.contribution_plan_bundle,
+        )
+        insuree_ids = list(
+            PolicyHolderInsuree.objects.filter(policy_holder=self.policy_holder)
+            .values_list("insuree_id", flat=True)
+        )
+        result = set_waiting_period_for_insurees(insuree_ids, self.policy_holder.id)
+        self.assertEqual(len(insuree_ids), result["created"])
+        # a second run only touches the existing rows, never duplicates them
+        with self.assertNumQueries(3):
+            result = set_waiting_period_for_insurees(insuree_ids, self.policy_holder.id)
+        self.assertEqual(0, result["created"])
+        self.assertEqual(
+            len(insuree_ids),
+            InsureeWaitingPeriod.objects.filter(
+                policy_holder_contribution_plan=policy_holder_contribution_plan
+            ).count(),
+        )
+
+
+    def _create_contract_ccpds(self, code):
+        from core import datetime
+        contract = Contract(
+            code=code,
+            policy_holder=self.policy_holder,
+            date_valid_from=datetime.datetime(2021, 1, 1),
+            date_valid_to=datetime.datetime(2021, 12, 31),
+        )
+        contract.save(username=self.user.username)
+        self.contract_details_service.update_from_ph_insuree(contract_details={
+            "contract_id": contract.id,
+            "policy_holder_id": str(self.policy_holder.id),
+            "amendment": 0,
+        })
+        details = list(ContractDetails.objects.filter(contract_id=contract.id).order_by("insuree_id"))
+        ccpds = [
+            (
+                ContractContributionPlanDetails(
+                    contract_details_id=detail.id,
+                    contribution_plan=self.contribution_plan,
+                    date_valid_from=datetime.datetime(2021, 1, 1),
+                    date_valid_to=datetime.datetime(2021, 1, 31),
+                ),
+                detail.insuree_id,
+            )
+            for detail in details
+        ]
+        service = ContractContributionPlanDetailsService(self.user, contract={"contract": contract})
+        return contract, details, service.create_ccpds(ccpds)
+
+    def test_create_ccpds_bulk(self):
+        contract, details, results = self._create_contract_ccpds("MTEST-CCPDS")
+
+        self.assertEqual(len(details), len(results))
+        for (ccpd, policies), detail in zip(results, details):
+            self.assertEqual(detail.id, ccpd.contract_details_id)
+            self.assertTrue(policies)
+            self.assertEqual(policies[0].id, ccpd.policy_id)
+        self.assertEqual(
+            len(details),
+            ContractContributionPlanDetails.objects.filter(contract_details__contract_id=contract.id).count(),
+        )
+        # the generated policies are linked to the contract
+        result_policy_ids = {policy.id for _, policies in results for policy in policies}
+        contract_policy_ids = set(ContractPolicy.objects.filter(contract=contract).values_list("policy_id", flat=True))
+        self.assertTrue(contract_policy_ids)
+        self.assertTrue(contract_policy_ids <= result_policy_ids)
+
+
+    def test_create_contribution_query_count(self):
+        _, _, results = self._create_contract_ccpds("MTEST-PREMIUMS")
+        records = [
+            {
+                "id": str(ccpd.id),
+                "contract_details": str(ccpd.contract_details_id),
+                "policy": ccpd.policy_id,
+                "contribution": None,
+                "calculated_amount": 100 + index,
+            }
+            for index, (ccpd, _) in enumerate(results)
+        ]
+        # the number of queries doesn't depend on the number of ccpd
+        query_counts = []
+        for chunk in (records[:1], records[1:]):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.contract_contribution_plan_details_service.create_contribution(
+                    {"contribution_plan_details": chunk}
+                )
+            self.assertTrue(response["success"])
+            self.assertEqual(len(chunk), len(response["data"]["contributions"]))
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+        ccpds = ContractContributionPlanDetails.objects.filter(
+            id__in=[record["id"] for record in records]
+        ).select_related("contribution")
+        self.assertEqual(
+            sorted(record["calculated_amount"] for record in records),
+            sorted(int(ccpd.contribution.amount) for ccpd in ccpds),
+        )
+        self.assertTrue(all(ccpd.contribution.policy_id == ccpd.policy_id for ccpd in ccpds))
+
+
+    def test_collect_payment_details_query_count(self):
+        _, details, results = self._create_contract_ccpds("MTEST-PAYMENT")
+        records = [
+            {
+                "id": str(ccpd.id),
+                "contract_details": str(ccpd.contract_details_id),
+                "contribution_plan": str(ccpd.contribution_plan_id),
+                "policy": ccpd.policy_id,
+                "contribution": None,
+                "calculated_amount": 100,
+            }
+            for ccpd, _ in results
+        ]
+        self.contract_contribution_plan_details_service.create_contribution(
+            {"contribution_plan_details": records}
+        )
+        payment_service = PaymentService(self.user)
+        # product codes, chf_ids and premiums are one query each
+        with self.assertNumQueries(3):
+            payment_details = payment_service.collect_payment_details(records)
+
+        chf_ids = {str(detail.id): detail.insuree.chf_id for detail in details}
+        self.assertEqual(len(records), len(payment_details))
+        for record, payment_detail in zip(records, payment_details):
+            self.assertEqual(self.contribution_plan.benefit_plan.code, payment_detail["product_code"])
+            self.assertEqual(chf_ids[record["contract_details"]], payment_detail["insurance_number"])
+            self.assertEqual(100, payment_detail["expected_amount"])
+            self.assertIsNotNone(payment_detail["premium"])
+
+
+    def test_terminate_expired_contracts(self):
+        from core import datetime, datetimedelta
+        expired = [
+            create_test_contract(
+                policy_holder=self.policy_holder,
+                custom_props={
+                    "code": f"MTEST-EXPIRED-{i}",
+                    "state": Contract.STATE_EFFECTIVE,
+                    "date_valid_to": datetime.datetime(2020, 1, 31),
+                },
+            )
+            for i in range(3)
+        ]
+        running = create_test_contract(
+            policy_holder=self.policy_holder,
+            custom_props={
+                "code": "MTEST-RUNNING",
+                "state": Contract.STATE_EFFECTIVE,
+                "date_valid_to": datetime.datetime.now() + datetimedelta(days=30),
+            },
+        )
+
+        dry_run = terminate_expired_contracts(self.user.username, dry_run=True)
+        self.assertTrue(dry_run["dry_run"])
+        self.assertGreaterEqual(dry_run["terminated"], len(expired))
+        self.assertEqual(
+            len(expired),
+            Contract.objects.filter(id__in=[c.id for c in expired], state=Contract.STATE_EFFECTIVE).count(),
+        )
+
+        # batches smaller than the number of contracts
+        result = terminate_expired_contracts(self.user.username, batch_size=2)
+        self.assertEqual(dry_run["terminated"], result["terminated"])
+        for contract in Contract.objects.filter(id__in=[c.id for c in expired]):
+            self.assertEqual(Contract.STATE_TERMINATED, contract.state)
+            self.assertEqual(
+                f"contract terminated - state {Contract.STATE_TERMINATED}",
+                contract.json_ext["comments"][0]["msg"],
+            )
+            self.assertEqual(1, contract.history.filter(state=Contract.STATE_TERMINATED).count())
+        running.refresh_from_db()
+        self.assertEqual(Contract.STATE_EFFECTIVE, running.state)
+        self.assertEqual(0, terminate_expired_contracts(self.user.username)["terminated"])
+
+
+    def test_terminate_expired_contracts_unknown_user(self):
+        with self.assertRaisesMessage(ValueError, "terminate_contracts_username"):
+            terminate_expired_contracts("no-such-contract-user", dry_run=True)
+
+
 class CalculationContractTest(TestCase):
     user = None
 
@@ -0,0 +1,33 @@
+from unittest import mock
+
+from django.test import TestCase
+
+from contract.calculations import ValuationEngine
+from contract.models import ContractContributionPlanDetails
+
+
+class ValuationEngineTest(TestCase):
+
+    def _ccpd(self, contribution_plan_id):
+        return ContractContributionPlanDetails(contribution_plan_id=contribution_plan_id)
+
+    @mock.patch("contract.calculations.run_calculation_rules", return_value=[("rule", 25)])
+    def test_rules_run_once_per_signature(self, run_calculation_rules):
+        engine = ValuationEngine(user=None)
+        details = [
+            {"id": str(i), "json_ext": {"calculation_rule": {"income": 500 if i % 2 else 400}}}
+            for i in range(10)
+        ]
+        results = [engine.run(self._ccpd("cp-1"), cd) for cd in details]
+        results += [engine.run(self._ccpd("cp-2"), cd) for cd in details]
+
+        self.assertEqual(4, run_calculation_rules.call_count)
+        self.assertEqual(4, engine.rule_invocations)
+        self.assertTrue(all(rc == [("rule", 25)] for rc in results))
+
+    @mock.patch("contract.calculations.run_calculation_rules", return_value=[("rule", 25)])
+    def test_details_without_calculation_input_are_not_grouped(self, run_calculation_rules):
+        engine = ValuationEngine(user=None)
+        for i in range(3):
+            engine.run(self._ccpd("cp-1"), {"id": str(i)})
+        self.assertEqual(3, run_calculation_rules.call_count)
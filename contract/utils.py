@@ -1,11 +1,14 @@
 import json
 import logging
+import threading
+import time
+import unicodedata
 from datetime import datetime, timedelta
 from datetime import datetime as dt
 
 from contribution_plan.models import ContributionPlanBundleDetails
 from core.models import User
-from django.db.models import Q
+from django.db.models import Exists, OuterRef, Q
 from django.http import Http404, JsonResponse
 from insuree.abis_api import create_abis_insuree
 from insuree.dms_utils import (
@@ -27,112 +30,253 @@ from report.apps import ReportConfig
 from report.services import generate_report, get_report_definition
 from workflow.workflow_stage import insuree_add_to_workflow
 
-from contract.models import Contract, ContractContributionPlanDetails, ContractDetails
+from contract.models import (
+    Contract,
+    ContractContributionPlanDetails,
+    ContractDetails,
+    ContractDetailsMutation,
+    ContractMutation,
+)
+from contract.schedules import get_product_schedule
 
 logger = logging.getLogger(__name__)
 
+# Map of department names to codes
+DEPARTMENT_CODES = {
+    "BOUENZA": "BOA",
+    "CUVETTE": "CVT",
+    "CUVETTE-OUEST": "CVO",
+    "KOUILOU": "KLO",
+    "LEKOUMOU": "LKM",
+    "LIKOUALA": "LKA",
+    "NIARI": "NRI",
+    "PLATEAUX": "PTX",
+    "POOL": "POL",
+    "SANGHA": "SGH",
+    "POINTE-NOIRE": "PNR",
+    "BRAZZAVILLE": "BZV",
+    "DJOUE-LEFINI": "DJL",
+    "NKENI-ALIMA": "NKA",
+    "CONGO-OUBANGUI": "COB",
+}
+
+
+def normalize_location_name(name):
+    # remove accents and convert to uppercase
+    return "".join(
+        c for c in unicodedata.normalize("NFD", name or "")
+        if unicodedata.category(c) != "Mn"
+    ).upper()
+
+
+NORMALIZED_DEPARTMENT_CODES = [
+    (normalize_location_name(dept_name), code)
+    for dept_name, code in DEPARTMENT_CODES.items()
+]
+
+
+def match_department_code(location_name):
+    loc_name = normalize_location_name(location_name)
+    for dept_name, code in NORMALIZED_DEPARTMENT_CODES:
+        if dept_name in loc_name or loc_name in dept_name:
+            return code
+    return None
 
-def resolve_custom_field(detail):
-    try:
-        cpb = detail.contribution_plan_bundle
-        cpbd = ContributionPlanBundleDetails.objects.filter(
-            contribution_plan_bundle=cpb, is_deleted=False
-        ).first()
-        conti_plan = cpbd.contribution_plan if cpbd else None
-        ercp = 0
-        eecp = 0
-        if conti_plan and conti_plan.json_ext:
-            json_data = conti_plan.json_ext
-            calculation_rule = json_data.get("calculation_rule")
-            if calculation_rule:
-                ercp = float(calculation_rule.get("employerContribution", 0.0))
-                eecp = float(calculation_rule.get("employeeContribution", 0.0))
-
-        # Uncommented lines can be used if needed for future logic
-        # insuree = self.insuree
-        # policy_holder = self.contract.policy_holder
-        # phn_json = PolicyHolderInsuree.objects.filter(
-        #     insuree_id=insuree.id,
-        #     policy_holder__code=policy_holder.code,
-        #     policy_holder__date_valid_to__isnull=True,
-        #     policy_holder__is_deleted=False,
-        #     date_valid_to__isnull=True,
-        #     is_deleted=False
-        # ).first()
-        # if phn_json and phn_json.json_ext:
-        #     json_data = phn_json.json_ext
-        #     ei = float(json_data.get('calculation_rule', {}).get('income', 0))
-        self_json = detail.json_ext if detail.json_ext else None
-        ei = 0.0
-        if self_json:
-            ei = float(self_json.get(
-                "calculation_rule", {}).get("income", 0.0))
-
-        # Use integer arithmetic to avoid floating-point issues
-        employer_contribution = (
-            ei * ercp / 100) if ercp and ei is not None else 0.0
-        salary_share = (ei * eecp / 100) if eecp and ei is not None else 0.0
-        total = salary_share + employer_contribution
-
-        response = {
-            "total": custom_round(total),
-            "employerContribution": custom_round(employer_contribution),
-            "salaryShare": custom_round(salary_share),
-        }
 
-        return response
-    except Exception as e:
-        response = {
-            "total": 0,
-            "employerContribution": None,
-            "salaryShare": 0,
+LOCATION_INDEX_TTL = 300
+
+
+class LocationDepartmentIndex:
+    """
+    Process level copy of the location tree (id -> parent, type, name) so that
+    the department of a location and its parent chain are resolved in memory.
+    The tree is loaded lazily with one query and dropped by `invalidate`,
+    which is connected to the Location save/delete signals. The copy is per
+    process: a location changed in another worker (renamed or moved region)
+    is only seen here once the tree, and the department codes found in it,
+    expire after `ttl` seconds, or when a department lookup misses.
+    """
+
+    def __init__(self, ttl=LOCATION_INDEX_TTL):
+        self._lock = threading.Lock()
+        self._ttl = ttl
+        self._nodes = None
+        self._loaded_at = None
+        self._department_codes = {}
+
+    def invalidate(self, *args, **kwargs):
+        with self._lock:
+            self._nodes = None
+            self._department_codes = {}
+
+    def _expired(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at >= self._ttl
+
+    def _load(self):
+        from location.models import Location
+
+        return {
+            location_id: (parent_id, location_type, name)
+            for location_id, parent_id, location_type, name in Location.objects.values_list(
+                "id", "parent_id", "type", "name"
+            )
         }
-        return response
+
+    def _get_nodes(self, location_id=None, reload=False):
+        with self._lock:
+            # reload when the location has been created after the index was built
+            if reload or self._nodes is None or self._expired() or (
+                location_id is not None and location_id not in self._nodes
+            ):
+                self._nodes = self._load()
+                self._loaded_at = time.monotonic()
+                self._department_codes = {}
+            return self._nodes
+
+    def chain(self, location_id, reload=False):
+        """Return the (id, type, name) of the location and all its parents."""
+        nodes = self._get_nodes(location_id, reload=reload)
+        chain = []
+        while location_id is not None and location_id in nodes:
+            parent_id, location_type, name = nodes[location_id]
+            chain.append((location_id, location_type, name))
+            if parent_id == location_id or len(chain) > len(nodes):
+                break
+            location_id = parent_id
+        return chain
+
+    def names(self, location_id):
+        return [name for _, _, name in self.chain(location_id)]
+
+    def _find_department_code(self, location_id, reload=False):
+        for _, location_type, name in self.chain(location_id, reload=reload):
+            if location_type == "R":
+                return match_department_code(name)
+        return None
+
+    def department_code(self, location_id):
+        # the cached codes are dropped with the tree when it expires
+        self._get_nodes()
+        if location_id in self._department_codes:
+            return self._department_codes[location_id]
+        department_code = self._find_department_code(location_id)
+        if department_code is None and location_id is not None:
+            # the tree may be stale (changed by another process): reload once
+            department_code = self._find_department_code(location_id, reload=True)
+        # misses are not cached, the location may still be completed later
+        if department_code is not None:
+            self._department_codes[location_id] = department_code
+        return department_code
+
+
+location_department_index = LocationDepartmentIndex()
+
+
+CUSTOM_FIELD_ERROR = {
+    "total": 0,
+    "employerContribution": None,
+    "salaryShare": 0,
+}
+
+
+def _detail_income(detail):
+    self_json = detail.json_ext if detail.json_ext else None
+    ei = 0.0
+    if self_json:
+        ei = float(self_json.get("calculation_rule", {}).get("income", 0.0))
+    return ei
+
+
+def resolve_custom_fields(details):
+    """
+    custom field (employer contribution, salary share and total) of a list of
+    contract details. The contribution plan rates are loaded once per bundle and
+    the amounts are computed with the vectorized percentage calculator.
+    """
+    from contract.calculations import contribution_rates, percentage_contribution_rows
+
+    rates_by_bundle = {}
+    rows, incomes, employer_rates, employee_rates = [], [], [], []
+    for index, detail in enumerate(details):
+        try:
+            bundle_id = detail.contribution_plan_bundle_id
+            if bundle_id not in rates_by_bundle:
+                cpbd = (
+                    ContributionPlanBundleDetails.objects.filter(
+                        contribution_plan_bundle_id=bundle_id, is_deleted=False
+                    )
+                    .select_related("contribution_plan")
+                    .first()
+                )
+                rates_by_bundle[bundle_id] = contribution_rates(
+                    cpbd.contribution_plan if cpbd else None
+                )
+            ercp, eecp = rates_by_bundle[bundle_id]
+            incomes.append(_detail_income(detail))
+            employer_rates.append(ercp)
+            employee_rates.append(eecp)
+            rows.append(index)
+        except Exception:
+            continue
+    responses = [dict(CUSTOM_FIELD_ERROR) for _ in details]
+    for index, response in zip(
+        rows, percentage_contribution_rows(incomes, employer_rates, employee_rates)
+    ):
+        responses[index] = response
+    return responses
+
+
+def resolve_custom_field(detail):
+    return resolve_custom_fields([detail])[0]
 
 
 def filter_amount_contract(arg="amount_from", arg2="amount_to", **kwargs):
+    """
+    Amount range filter on the stored Contract.effective_amount (the amount of
+    the contract in its current state), a range scan on its index.
+    """
     amount_from = kwargs.get(arg)
     amount_to = kwargs.get(arg2)
+    amount_filter = Q()
+    if amount_from:
+        amount_filter &= Q(effective_amount__gte=amount_from)
+    if amount_to:
+        amount_filter &= Q(effective_amount__lte=amount_to)
+    return amount_filter
 
-    status_notified = [1, 2]
-    status_rectified = [4, 11, 3]
-    status_due = [5, 6, 7, 8, 9, 10]
 
-    # scenario - only amount_to set
-    if not amount_from and amount_to:
-        return (
-            Q(amount_notified__lte=amount_to, state__in=status_notified)
-            | Q(amount_rectified__lte=amount_to, state__in=status_rectified)
-            | Q(amount_due__lte=amount_to, state__in=status_due)
+def filter_contract_insuree(insuree):
+    """
+    Contracts having a detail of the insuree (uuid). A correlated EXISTS instead
+    of a join over the details, so a contract is matched at most once.
+    """
+    return Q(
+        Exists(
+            ContractDetails.objects.filter(contract_id=OuterRef("id"), insuree__uuid=insuree)
         )
+    )
 
-    # scenario - only amount_from set
-    if amount_from and not amount_to:
-        return (
-            Q(amount_notified__gte=amount_from, state__in=status_notified)
-            | Q(amount_rectified__gte=amount_from, state__in=status_rectified)
-            | Q(amount_due__gte=amount_from, state__in=status_due)
-        )
 
-    # scenario - both filters set
-    if amount_from and amount_to:
-        return (
-            Q(
-                amount_notified__gte=amount_from,
-                amount_notified__lte=amount_to,
-                state__in=status_notified,
-            )
-            | Q(
-                amount_rectified__gte=amount_from,
-                amount_rectified__lte=amount_to,
-                state__in=status_rectified,
+def filter_contract_client_mutation_id(client_mutation_id):
+    return Q(
+        Exists(
+            ContractMutation.objects.filter(
+                contract_id=OuterRef("id"),
+                mutation__client_mutation_id=client_mutation_id,
             )
-            | Q(
-                amount_due__gte=amount_from,
-                amount_due__lte=amount_to,
-                state__in=status_due,
+        )
+    )
+
+
+def filter_contract_details_client_mutation_id(client_mutation_id):
+    return Q(
+        Exists(
+            ContractDetailsMutation.objects.filter(
+                contract_detail_id=OuterRef("id"),
+                mutation__client_mutation_id=client_mutation_id,
             )
         )
+    )
 
 
 def get_period_date(contract_date_valid_from):
@@ -176,13 +320,15 @@ def generate_report_for_contract_receipt(contract_id, info):
         print(
             f"==================================== policy_holder {policy_holder}")
 
-        locations = policy_holder.locations
+        location_names = location_department_index.names(
+            policy_holder.locations_id
+        ) + [""] * 4
         location = {
             "adresse": policy_holder.address["address"],
-            "quartier": locations.name,
-            "arrondissement": locations.parent.name,
-            "ville": locations.parent.parent.name,
-            "department": locations.parent.parent.parent.name,
+            "quartier": location_names[0],
+            "arrondissement": location_names[1],
+            "ville": location_names[2],
+            "department": location_names[3],
         }
         print(f"==================================== location {location}")
         # for location in policy_holder.locations:
@@ -222,9 +368,9 @@ def generate_report_for_contract_receipt(contract_id, info):
                 # if user.i_user.districts:
                 #     user_location = user.i_user.districts[0].location.name
 
-                for detail in contract_details:
+                custom_fields = resolve_custom_fields(list(contract_details))
+                for detail, customField in zip(contract_details, custom_fields):
                     jsonExt = detail.json_ext
-                    customField = resolve_custom_field(detail)
                     if jsonExt is None:
                         jsonExt = {"calculation_rule": {"income": 0}}
                     print(
@@ -460,23 +606,30 @@ def get_period_from_date(date_value):
         return None
 
 
-def get_payment_product_config(payment):
-    logger.debug("====  get_payment_product_config  : Start  ====")
+def get_payment_product(payment):
     payment_details = PaymentDetail.objects.filter(
         payment=payment, legacy_id__isnull=True
-    ).first()
+    ).select_related("premium").first()
     if payment_details:
         ccpd = ContractContributionPlanDetails.objects.filter(
             contribution__id=payment_details.premium.id
-        ).first()
+        ).select_related("contribution_plan__benefit_plan").first()
         if ccpd:
-            product_config = ccpd.contribution_plan.benefit_plan.config_data
-            # product_config : {'paymentEndDate': '2024-11-05', 'sanctionAmount': 5000000, 'firstPenaltyRate': 3, 'paymentStartDate': '2024-10-20', 'secondPenaltyRate': 3, 'declarationEndDate': '2024-11-05', 'declarationStartDate': '2024-10-20'}
-            logger.debug(
-                f"====  get_payment_product_config  : product_config : {product_config}  ===="
-            )
-            logger.debug("====  get_payment_product_config  : End  ====")
-            return product_config
+            return ccpd.contribution_plan.benefit_plan
+    return None
+
+
+def get_payment_product_config(payment):
+    logger.debug("====  get_payment_product_config  : Start  ====")
+    product = get_payment_product(payment)
+    if product:
+        product_config = product.config_data
+        # product_config : {'paymentEndDate': '2024-11-05', 'sanctionAmount': 5000000, 'firstPenaltyRate': 3, 'paymentStartDate': '2024-10-20', 'secondPenaltyRate': 3, 'declarationEndDate': '2024-11-05', 'declarationStartDate': '2024-10-20'}
+        logger.debug(
+            f"====  get_payment_product_config  : product_config : {product_config}  ===="
+        )
+        logger.debug("====  get_payment_product_config  : End  ====")
+        return product_config
     logger.debug("====  get_payment_product_config  : End  ====")
     return None
 
@@ -506,20 +659,15 @@ def get_next_month_limit_date(cpb_date, contract_date):
 def get_due_payment_date(contract):
     payment = Payment.objects.filter(contract=contract).first()
     payment_due_date = None
-    if payment:
-        product_config = get_payment_product_config(payment)
-        payment_end_date = product_config.get("paymentEndDate")
-        contract_date_valid_to = contract.date_valid_from
-        # now = datetime.now().date()
-        payment_due_date = get_next_month_limit_date(
-            payment_end_date, contract_date_valid_to
-        )
-    logger.info("************************************************************")
-    logger.info(
-        f"config_payment_end_date  : {product_config['paymentEndDate']}")
-    logger.info(f"payment_due_date  : {payment_due_date}")
-    logger.info(f"contract_date_valid_to  : {contract_date_valid_to}")
-    logger.info("************************************************************")
+    product = get_payment_product(payment) if payment else None
+    if product:
+        schedule = get_product_schedule(product)
+        payment_due_date = schedule.payment_due(contract.date_valid_from)
+        logger.info("************************************************************")
+        logger.info(f"config_payment_end_day  : {schedule.payment_end_day}")
+        logger.info(f"payment_due_date  : {payment_due_date}")
+        logger.info(f"contract_date_valid_from  : {contract.date_valid_from}")
+        logger.info("************************************************************")
     return payment_due_date
 
 
@@ -1,12 +1,12 @@
 import io
 import json
 import logging
+import tempfile
 
-import pandas as pd
 from celery.result import AsyncResult
 from contribution_plan.models import ContributionPlanBundleDetails
 from django.db import transaction
-from django.http import HttpResponse, JsonResponse
+from django.http import FileResponse, JsonResponse
 from insuree.models import Insuree
 from openIMIS.celery import app
 from policyholder.models import (
@@ -17,77 +17,128 @@ from policyholder.models import (
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
+from contract.calculations import (
+    contribution_rates,
+    contribution_rates_by_bundle,
+    distribute_forfait_amount,
+    percentage_contribution,
+    percentage_contribution_rows,
+)
 from contract.models import Contract, ContractDetails
-from contract.utils import create_new_insuree_and_add_contract_details, custom_round
+from contract.utils import create_new_insuree_and_add_contract_details
 
 logger = logging.getLogger(__name__)
 
 HEADER_INCOME = "income"
-
-
-def generate_multi_contract_excel_data(contract_detail):
-    try:
-        contract_detail = get_contract_custom_field_data(contract_detail)
-        contract_data = {
-            "Assuré": (
-                contract_detail["insuree"]["lastName"]
-                + " "
-                + contract_detail["insuree"]["otherNames"]
-                if contract_detail.get("insuree")
-                else ""
-            ),
-            "Numéro CAMU": (
-                str(contract_detail["insuree"]["camu_number"])
-                if contract_detail.get("insuree")
-                and contract_detail["insuree"].get("camu_number")
-                else ""
-            ),
-            "Numéro CAMU temporaire": (
-                contract_detail["insuree"]["chfId"]
-                if contract_detail.get("insuree")
-                and contract_detail["insuree"].get("chfId")
-                else ""
-            ),
-            "Ensemble du plan de contribution": (
-                contract_detail["contributionPlanBundle"]["code"]
-                + " - "
-                + contract_detail["contributionPlanBundle"]["name"]
-                if contract_detail.get("contributionPlanBundle")
-                and contract_detail["contributionPlanBundle"].get("code")
-                and contract_detail["contributionPlanBundle"].get("name")
-                else ""
-            ),
-            "Gross Salary": (
-                str(contract_detail["jsonExt"]["calculation_rule"]["income"])
-                if contract_detail.get("jsonExt")
-                and contract_detail["jsonExt"].get("calculation_rule")
-                and contract_detail["jsonExt"]["calculation_rule"].get("income")
-                else ""
-            ),
-            "Cotisation de l'employeur": (
-                str(contract_detail["customField"]["employerContribution"])
-                if contract_detail.get("customField")
-                and contract_detail["customField"].get("employerContribution")
-                else ""
-            ),
-            "Cotisation des employés": (
-                str(contract_detail["customField"]["salaryShare"])
-                if contract_detail.get("customField")
-                and contract_detail["customField"].get("salaryShare")
-                else ""
-            ),
-            "Total": (
-                str(contract_detail["customField"]["total"])
-                if contract_detail.get("customField")
-                and contract_detail["customField"].get("total")
-                else ""
-            ),
-        }
-        logger.info(contract_data)
-
-        return contract_data
-    except Exception as e:
-        return None
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_HEADERS = [
+    "Assuré",
+    "Numéro CAMU",
+    "Numéro CAMU temporaire",
+    "Ensemble du plan de contribution",
+    "Gross Salary",
+    "Cotisation de l'employeur",
+    "Cotisation des employés",
+    "Total",
+]
+XLSX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def _export_row(detail, custom_field):
+    insuree = detail.insuree
+    cpb = detail.contribution_plan_bundle
+    json_ext = detail.json_ext or {}
+    income = (json_ext.get("calculation_rule") or {}).get("income")
+    return [
+        insuree.last_name + " " + insuree.other_names if insuree else "",
+        "",
+        insuree.chf_id if insuree and insuree.chf_id else "",
+        cpb.code + " - " + cpb.name if cpb and cpb.code and cpb.name else "",
+        str(income) if income else "",
+        str(custom_field["employerContribution"]) if custom_field["employerContribution"] else "",
+        str(custom_field["salaryShare"]) if custom_field["salaryShare"] else "",
+        str(custom_field["total"]) if custom_field["total"] else "",
+    ]
+
+
+def _export_chunk_rows(details, policy_holder, rates_by_bundle):
+    missing_bundles = {
+        detail.contribution_plan_bundle_id
+        for detail in details
+        if detail.contribution_plan_bundle_id not in rates_by_bundle
+    }
+    if missing_bundles:
+        rates_by_bundle.update(contribution_rates_by_bundle(missing_bundles))
+    incomes_by_insuree = {}
+    for insuree_id, json_ext in (
+        PolicyHolderInsuree.objects.filter(
+            insuree_id__in={detail.insuree_id for detail in details},
+            policy_holder__code=policy_holder.code,
+            policy_holder__date_valid_to__isnull=True,
+            policy_holder__is_deleted=False,
+            date_valid_to__isnull=True,
+            is_deleted=False,
+        )
+        .order_by("pk")
+        .values_list("insuree_id", "json_ext")
+    ):
+        if insuree_id not in incomes_by_insuree:
+            incomes_by_insuree[insuree_id] = (
+                float(json_ext.get("calculation_rule", {}).get("income", 0.0))
+                if json_ext
+                else 0
+            )
+    rates = [rates_by_bundle[detail.contribution_plan_bundle_id] for detail in details]
+    custom_fields = percentage_contribution_rows(
+        [incomes_by_insuree.get(detail.insuree_id, 0) for detail in details],
+        [rate[0] for rate in rates],
+        [rate[1] for rate in rates],
+    )
+    for detail, custom_field in zip(details, custom_fields):
+        try:
+            yield _export_row(detail, custom_field)
+        except Exception as e:
+            logger.error(f"contract details export : skipping {detail.id} : {e}")
+
+
+def iter_contract_details_export_rows(contract_details):
+    """
+    Rows of the employee declaration export, in the EXPORT_HEADERS columns.
+    The details are read with a server side
+    cursor joined to insuree, bundle and policy holder; the contribution rates and
+    the policy holder insuree incomes are loaded per chunk of details.
+    """
+    contract_details = contract_details.select_related(
+        "insuree", "contribution_plan_bundle", "contract__policy_holder"
+    ).order_by("pk")
+    rates_by_bundle = {}
+    chunk = []
+    for detail in contract_details.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        chunk.append(detail)
+        if len(chunk) == EXPORT_CHUNK_SIZE:
+            yield from _export_chunk_rows(chunk, chunk[0].contract.policy_holder, rates_by_bundle)
+            chunk = []
+    if chunk:
+        yield from _export_chunk_rows(chunk, chunk[0].contract.policy_holder, rates_by_bundle)
+
+
+def write_contract_details_xlsx(output, contract_details):
+    """
+    Write the employee declaration export to a file-like object with xlsxwriter in
+    constant memory mode (rows are flushed as they are written).
+    Returns the number of rows written.
+    """
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(output, {"constant_memory": True})
+    worksheet = workbook.add_worksheet()
+    worksheet.write_row(0, 0, EXPORT_HEADERS)
+    row_count = 0
+    for row in iter_contract_details_export_rows(contract_details):
+        row_count += 1
+        worksheet.write_row(row_count, 0, row)
+    workbook.close()
+    return row_count
 
 
 def multi_contract(request, contract_id):
@@ -99,23 +150,18 @@ def multi_contract(request, contract_id):
     if is_confirmed:
         contract_details = contract_details.filter(is_confirmed=True)
 
-    all_contract_data = []
-    for detail in contract_details:
-        # contract_data = get_contract_custom_field_data(detail)
-        contract_data = generate_multi_contract_excel_data(detail)
-        if contract_data:
-            all_contract_data.append(contract_data)
-    if not all_contract_data:
+    output = tempfile.TemporaryFile()
+    if not write_contract_details_xlsx(output, contract_details):
+        output.close()
         return None
-    # Create a DataFrame from all the contract data
-    df = pd.DataFrame(all_contract_data)
-    response = HttpResponse(
-        content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    output.seek(0)
+    # FileResponse streams the spooled workbook in blocks and closes the file
+    return FileResponse(
+        output,
+        as_attachment=True,
+        filename="multiple_contracts.xlsx",
+        content_type=XLSX_CONTENT_TYPE,
     )
-    response["Content-Disposition"] = 'attachment; filename="multiple_contracts.xlsx"'
-    # Write DataFrame to response as an Excel file
-    df.to_excel(response, index=False, header=True)
-    return response
 
 
 # def resolve_custom_field(detail):
@@ -178,15 +224,7 @@ def get_contract_custom_field_data(detail):
         contribution_plan_bundle=cpb, is_deleted=False
     ).first()
     conti_plan = cpbd.contribution_plan if cpbd else None
-    ercp = 0.0
-    eecp = 0.0
-
-    if conti_plan and conti_plan.json_ext:
-        json_data = conti_plan.json_ext
-        calculation_rule = json_data.get("calculation_rule")
-        if calculation_rule:
-            ercp = float(calculation_rule.get("employerContribution", 0.0))
-            eecp = float(calculation_rule.get("employeeContribution", 0.0))
+    ercp, eecp = contribution_rates(conti_plan)
 
     insuree = detail.insuree
     policy_holder = detail.contract.policy_holder
@@ -204,20 +242,7 @@ def get_contract_custom_field_data(detail):
         json_data = phn_json.json_ext
         ei = float(json_data.get("calculation_rule", {}).get("income", 0.0))
 
-    employer_contribution = (
-        ei * ercp / 100) if ercp and ei is not None else 0.0
-    salary_share = (ei * eecp / 100) if eecp and ei is not None else 0.0
-    total = salary_share + employer_contribution
-
-    custom_field_data = {
-        "total": custom_round(total) if total is not None else 0,
-        "employerContribution": (
-            custom_round(employer_contribution)
-            if employer_contribution is not None
-            else 0
-        ),
-        "salaryShare": custom_round(salary_share) if salary_share is not None else 0,
-    }
+    custom_field_data = percentage_contribution(ei, ercp, eecp)
 
     contract_data = {
         "id": detail.id,
@@ -251,17 +276,9 @@ def get_contract_custom_field_data(detail):
 
 def send_contract(contract_id):
     contract_details = ContractDetails.objects.filter(contract_id=contract_id)
-    all_contract_data = []
-    for detail in contract_details:
-        contract_data = generate_multi_contract_excel_data(detail)
-        if contract_data:
-            all_contract_data.append(contract_data)
-    if not all_contract_data:
-        return None
-    df = pd.DataFrame(all_contract_data)
     excel_buffer = io.BytesIO()
-    df.to_excel(excel_buffer, index=False, header=True)
-    excel_buffer.seek(0)
+    if not write_contract_details_xlsx(excel_buffer, contract_details):
+        return None
     return excel_buffer.getvalue()
 
 
@@ -355,39 +372,22 @@ def update_forfait_rule(contract_id, rounded_amount, core_username):
 
     print(f"====> contract_id: {contract_id}")
 
-    contract_details_to_update = ContractDetails.objects.filter(
-        contract_id=contract_id, is_confirmed=True, is_deleted=False
+    contract_details_to_update = list(
+        ContractDetails.objects.filter(
+            contract_id=contract_id, is_confirmed=True, is_deleted=False
+        ).order_by("date_created", "id")
     )
 
     if not contract_details_to_update:
         logger.info("=====> No contract details to update")
         return
 
-    forfait_total = 0
-
-    total_contract_detail = len(contract_details_to_update)
-
-    forfait_total = rounded_amount / total_contract_detail
-
-    print(f"====> forfait_total: {forfait_total}")
-
-    for contract_detail in contract_details_to_update:
-        try:
-            print(f"====> contract_detail: {contract_detail}")
-            contract_detail.json_ext = {
-                "calculation_rule": {"rate": 0, "income": 0},
-                "forfait_rule": {
-                    "total": round(forfait_total),
-                    "employerContribution": 0,
-                    "salaryShare": 0,
-                },
-            }
-            contract_detail.save(username=core_username)
-        except Exception as e:
-            logger.error(f"====> Error updating contract detail: {e}")
-
-    logger.info(
-        f"====> contract_details_to_update: {contract_details_to_update}")
+    try:
+        distribute_forfait_amount(
+            contract_details_to_update, rounded_amount, core_username
+        )
+    except Exception as e:
+        logger.error(f"====> Error updating contract details: {e}")
 
 
 def update_salary(parsed_json, new_income):
@@ -432,4 +432,7 @@ def task_status(request, task_id):
         "ready": result.ready(),
         "successful": result.successful(),
     }
+    if result.state == "PROGRESS" and isinstance(result.info, dict):
+        # progress reported by celery_progress' ProgressRecorder
+        data["progress"] = result.info
     return JsonResponse(data)
@@ -32,6 +32,7 @@ setup(
         'openimis-be-insuree',
         'openimis-be-policy',
         'openimis-be-calculation',
+        'numpy',
     ],
     classifiers=[
         'Environment :: Web Environment',